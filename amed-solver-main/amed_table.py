@@ -0,0 +1,233 @@
+"""Export the predictions of a trained AMED predictor as a static per-step
+table, and evaluate the FID gap between the table and the predictor."""
+
+import os
+import json
+import click
+import tqdm
+import numpy as np
+import torch
+import dnnlib
+from torch_utils import distributed as dist
+from solver_utils import get_schedule
+from training.networks import SETTING_KEYS, AMED_table
+from sample import parse_int_list, load_predictor, setup_solver, generate_batch, save_images
+from fid import calculate_inception_stats, calculate_fid_from_inception_stats
+
+#----------------------------------------------------------------------------
+# Wrapper for the AMED predictor that accumulates its predictions per step,
+# and per class label if `label_dim` is given. The statistics stay on the
+# device until the end of the calibration run.
+
+class PredictionRecorder(torch.nn.Module):
+    def __init__(self, AMED_predictor, t_steps, label_dim=0):
+        super().__init__()
+        self.predictor = AMED_predictor
+        self.t_steps = t_steps
+        num_intervals = len(t_steps) - 1
+        device = t_steps.device
+        self.sums = torch.zeros([num_intervals, 3], dtype=torch.float64, device=device)
+        self.counts = torch.zeros([num_intervals], dtype=torch.float64, device=device)
+        self.class_sums = torch.zeros([label_dim, num_intervals, 3], dtype=torch.float64, device=device) if label_dim else None
+        self.class_counts = torch.zeros([label_dim, num_intervals], dtype=torch.float64, device=device) if label_dim else None
+
+    def forward(self, unet_bottleneck, t_cur, t_next, class_labels=None):
+        output = self.predictor(unet_bottleneck, t_cur, t_next, class_labels=class_labels)
+        output = list(output) if isinstance(output, tuple) else [output]
+        ones = torch.ones_like(output[0])
+        if len(output) == 1:
+            r, scale_dir, scale_time = output[0], ones, ones
+        elif len(output) == 2:
+            r, scale_dir, scale_time = (output[0], ones, output[1]) if self.predictor.scale_time else (output[0], output[1], ones)
+        else:
+            r, scale_dir, scale_time = output
+
+        # Accumulate the predictions of every sample at its step.
+        batch_size = r.shape[0]
+        values = torch.cat([r.reshape(-1, 1), scale_dir.reshape(-1, 1), scale_time.reshape(-1, 1)], dim=1).to(torch.float64)
+        step = (t_cur.reshape(-1, 1) - self.t_steps[:-1].reshape(1, -1)).abs().argmin(dim=1).expand(batch_size)
+        self.sums.index_add_(0, step, values)
+        self.counts.index_add_(0, step, torch.ones_like(values[:, 0]))
+        if class_labels is not None and self.class_sums is not None:
+            label_idx = class_labels.argmax(dim=1) if class_labels.dim() == 2 else class_labels.long()
+            flat_idx = label_idx * self.counts.shape[0] + step
+            self.class_sums.view(-1, 3).index_add_(0, flat_idx, values)
+            self.class_counts.view(-1).index_add_(0, flat_idx, torch.ones_like(values[:, 0]))
+        return r, scale_dir, scale_time
+
+    def all_reduce(self):
+        for x in [self.sums, self.counts, self.class_sums, self.class_counts]:
+            if x is not None:
+                torch.distributed.all_reduce(x)
+
+    def get_table(self, settings, net=None):
+        mean = self.sums / self.counts.clamp(min=1).unsqueeze(-1)
+        table = dict(settings=settings, num_samples=int(self.counts.min()), t_steps=self.t_steps.tolist())
+        table.update(r=mean[:, 0].tolist(), scale_dir=mean[:, 1].tolist(), scale_time=mean[:, 2].tolist())
+        if self.class_sums is not None:
+            # Classes without calibration samples fall back to the overall mean.
+            class_mean = self.class_sums / self.class_counts.clamp(min=1).unsqueeze(-1)
+            class_mean = torch.where(self.class_counts.unsqueeze(-1) > 0, class_mean, mean.unsqueeze(0))
+            table.update(class_r=class_mean[..., 0].tolist(), class_scale_dir=class_mean[..., 1].tolist(), class_scale_time=class_mean[..., 2].tolist())
+
+        # Expanded schedule for the diffusers plugin: every step is split into
+        # [t_cur, t_mid, t_next] and the scales only apply at t_mid.
+        t_steps = self.t_steps.to(torch.float64)
+        sigmas, scale_dirs, scale_times = [t_steps[0]], [1.], [1.]
+        for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):
+            r, scale_dir, scale_time = mean[i].tolist()
+            sigmas += [(t_next ** r) * (t_cur ** (1 - r)), t_next]
+            scale_dirs += [scale_dir, 1.]
+            scale_times += [scale_time, 1.]
+        sigmas = torch.stack(sigmas)
+        table.update(sigmas=sigmas.tolist(), scale_dirs=scale_dirs, scale_times=scale_times)
+        if hasattr(net, 'sigma_inv'):           # models with discrete time steps
+            table['timesteps'] = [round(t.item()) for t in (1000 * net.sigma_inv(sigmas.to(torch.float32)) - 1)]
+        return table
+
+#----------------------------------------------------------------------------
+
+@click.group()
+def main():
+    """Static AMED schedules for deployment without the AMED predictor.
+
+    Examples:
+
+    \b
+    # Export the mean predictions over 1000 calibration samples, per class label
+    torchrun --standalone --nproc_per_node=1 amed_table.py export --predictor_path=0 \\
+        --seeds=100000-100999 --per_class --out=exps/cifar10-table.json
+
+    \b
+    # Sample with the table instead of the predictor
+    torchrun --standalone --nproc_per_node=1 sample.py --predictor_path=exps/cifar10-table.json --seeds=0-49999
+
+    \b
+    # Compare the FID of the predictor and the table
+    torchrun --standalone --nproc_per_node=1 amed_table.py eval --predictor_path=0 \\
+        --table=exps/cifar10-table.json --ref=https://nvlabs-fi-cdn.nvidia.com/edm/fid-refs/cifar10-32x32.npz
+    """
+
+#----------------------------------------------------------------------------
+
+@main.command()
+@click.option('--predictor_path',          help='Path to trained AMED instructor', metavar='DIR',                   type=str, required=True)
+@click.option('--seeds',                   help='Calibration seeds (e.g. 1,2,5-10)', metavar='LIST',                type=parse_int_list, default='100000-100999', show_default=True)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--per_class',               help='Also export the mean predictions per class label',                 is_flag=True)
+@click.option('--out',                     help='Where to save the table', metavar='JSON',                          type=str, required=True)
+
+def export(predictor_path, seeds, max_batch_size, per_class, out, device=torch.device('cuda')):
+    """Export the mean predictions of an AMED predictor on calibration samples."""
+    dist.init()
+    num_batches = ((len(seeds) - 1) // (max_batch_size * dist.get_world_size()) + 1) * dist.get_world_size()
+    all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
+    rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
+
+    # Rank 0 goes first.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
+    AMED_predictor = load_predictor(predictor_path, device)
+    if isinstance(AMED_predictor, AMED_table):
+        raise click.ClickException('Expected a trained AMED predictor, got an AMED table')
+    net, sampler_fn, solver_kwargs, sample_captions = setup_solver(AMED_predictor, device)
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
+
+    # Record the predictions along the sampling trajectories.
+    t_steps = get_schedule(AMED_predictor.num_steps, net.sigma_min, net.sigma_max, device=device, schedule_type=AMED_predictor.schedule_type, \
+                           schedule_rho=AMED_predictor.schedule_rho, net=net)
+    label_dim = net.label_dim if per_class and net.label_dim and solver_kwargs['model_source'] != 'ldm' else 0
+    if per_class and not label_dim:
+        dist.print0('The model is not class-conditional, only the overall mean is exported.')
+    recorder = PredictionRecorder(AMED_predictor, t_steps, label_dim=label_dim)
+    solver_kwargs['AMED_predictor'] = recorder
+    dist.print0(f'Running the AMED predictor on {len(seeds)} calibration samples...')
+    for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
+        torch.distributed.barrier()
+        if len(batch_seeds) == 0:
+            continue
+        generate_batch(net, sampler_fn, batch_seeds, solver_kwargs, sample_captions, device)
+
+    # Save the table.
+    recorder.all_reduce()
+    if dist.get_rank() == 0:
+        settings = {key: getattr(AMED_predictor, key, None) for key in SETTING_KEYS}
+        table = recorder.get_table(settings, net=net)
+        for i, (r, scale_dir, scale_time) in enumerate(zip(table['r'], table['scale_dir'], table['scale_time'])):
+            print(f'Step: {i} | r: {r:.4f} | scale_dir: {scale_dir:.4f} | scale_time: {scale_time:.4f}')
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, 'wt') as f:
+            json.dump(table, f, indent=2)
+        print(f'Saved the AMED table to "{out}"')
+    torch.distributed.barrier()
+    dist.print0('Done.')
+
+#----------------------------------------------------------------------------
+
+@main.command()
+@click.option('--predictor_path',          help='Path to trained AMED instructor', metavar='DIR',                   type=str, required=True)
+@click.option('--table',                   help='Path to the exported AMED table', metavar='JSON',                  type=str, required=True)
+@click.option('--ref', 'ref_path',         help='Dataset reference statistics ', metavar='NPZ|URL',                 type=str, required=True)
+@click.option('--seeds',                   help='Random seeds (e.g. 1,2,5-10)', metavar='LIST',                     type=parse_int_list, default='0-49999', show_default=True)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--outdir',                  help='Where to save the output images', metavar='DIR',                   type=str, default='./samples/table_eval', show_default=True)
+
+def eval(predictor_path, table, ref_path, seeds, max_batch_size, outdir, device=torch.device('cuda')):
+    """Sample with the AMED predictor and the AMED table from the same seeds and report the FID gap."""
+    torch.multiprocessing.set_start_method('spawn')
+    dist.init()
+    num_batches = ((len(seeds) - 1) // (max_batch_size * dist.get_world_size()) + 1) * dist.get_world_size()
+    all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
+    rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
+
+    # Rank 0 goes first.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
+    AMED_predictor = load_predictor(predictor_path, device)
+    static_predictor = load_predictor(table, device)
+    for key in SETTING_KEYS:
+        if getattr(static_predictor, key) != getattr(AMED_predictor, key, None):
+            raise click.ClickException(f'AMED table "{table}" was exported with {key}={getattr(static_predictor, key)}, got {getattr(AMED_predictor, key, None)}')
+    net, sampler_fn, solver_kwargs, sample_captions = setup_solver(AMED_predictor, device)
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
+
+    dist.print0(f'Loading dataset reference statistics from "{ref_path}"...')
+    ref = None
+    if dist.get_rank() == 0:
+        with dnnlib.util.open_url(ref_path) as f:
+            ref = dict(np.load(f))
+
+    fids = dict()
+    for name, predictor in [('dynamic', AMED_predictor), ('static', static_predictor)]:
+        image_dir = os.path.join(outdir, name)
+        kwargs = dict(solver_kwargs, AMED_predictor=predictor)
+        dist.print0(f'Generating {len(seeds)} images to "{image_dir}"...')
+        for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
+            torch.distributed.barrier()
+            if len(batch_seeds) == 0:
+                continue
+            images = generate_batch(net, sampler_fn, batch_seeds, kwargs, sample_captions, device)
+            save_images(images, batch_seeds, image_dir)
+        torch.distributed.barrier()
+
+        mu, sigma = calculate_inception_stats(image_path=image_dir, num_expected=len(seeds), max_batch_size=max_batch_size)
+        if dist.get_rank() == 0:
+            fids[name] = calculate_fid_from_inception_stats(mu, sigma, ref['mu'], ref['sigma'])
+        torch.distributed.barrier()
+
+    if dist.get_rank() == 0:
+        print(f'FID (AMED predictor): {fids["dynamic"]:g}')
+        print(f'FID (AMED table)    : {fids["static"]:g}')
+        print(f'FID gap             : {fids["static"] - fids["dynamic"]:+g}')
+    torch.distributed.barrier()
+    dist.print0('Done.')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
@@ -5,17 +5,20 @@
 # You should have received a copy of the license along with this
 # work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
 
-"""Tool for creating ZIP/PNG based datasets."""
+"""Tool for creating ZIP/PNG based or memory-mapped datasets."""
 
 import functools
 import gzip
 import io
 import json
+import multiprocessing
 import os
 import pickle
 import re
+import shutil
 import sys
 import tarfile
+import time
 import zipfile
 from pathlib import Path
 from typing import Callable, Optional, Tuple, Union
@@ -54,7 +57,7 @@ def is_image_ext(fname: Union[str, Path]) -> bool:
 
 #----------------------------------------------------------------------------
 
-def open_image_folder(source_dir, *, max_images: Optional[int]):
+def open_image_folder(source_dir, *, max_images: Optional[int], select: Optional[Callable[[int], bool]] = None):
     input_images = [str(f) for f in sorted(Path(source_dir).rglob('*')) if is_image_ext(f) and os.path.isfile(f)]
     arch_fnames = {fname: os.path.relpath(fname, source_dir).replace('\\', '/') for fname in input_images}
     max_idx = maybe_min(len(input_images), max_images)
@@ -77,15 +80,16 @@ def open_image_folder(source_dir, *, max_images: Optional[int]):
 
     def iterate_images():
         for idx, fname in enumerate(input_images):
-            img = np.array(PIL.Image.open(fname))
-            yield dict(img=img, label=labels.get(arch_fnames.get(fname)))
+            if select is None or select(idx):
+                img = np.array(PIL.Image.open(fname))
+                yield dict(img=img, label=labels.get(arch_fnames.get(fname)), idx=idx)
             if idx >= max_idx - 1:
                 break
     return max_idx, iterate_images()
 
 #----------------------------------------------------------------------------
 
-def open_image_zip(source, *, max_images: Optional[int]):
+def open_image_zip(source, *, max_images: Optional[int], select: Optional[Callable[[int], bool]] = None):
     with zipfile.ZipFile(source, mode='r') as z:
         input_images = [str(f) for f in sorted(z.namelist()) if is_image_ext(f)]
         max_idx = maybe_min(len(input_images), max_images)
@@ -101,16 +105,17 @@ def open_image_zip(source, *, max_images: Optional[int]):
     def iterate_images():
         with zipfile.ZipFile(source, mode='r') as z:
             for idx, fname in enumerate(input_images):
-                with z.open(fname, 'r') as file:
-                    img = np.array(PIL.Image.open(file))
-                yield dict(img=img, label=labels.get(fname))
+                if select is None or select(idx):
+                    with z.open(fname, 'r') as file:
+                        img = np.array(PIL.Image.open(file))
+                    yield dict(img=img, label=labels.get(fname), idx=idx)
                 if idx >= max_idx - 1:
                     break
     return max_idx, iterate_images()
 
 #----------------------------------------------------------------------------
 
-def open_lmdb(lmdb_dir: str, *, max_images: Optional[int]):
+def open_lmdb(lmdb_dir: str, *, max_images: Optional[int], select: Optional[Callable[[int], bool]] = None):
     import cv2  # pyright: ignore [reportMissingImports] # pip install opencv-python
     import lmdb  # pyright: ignore [reportMissingImports] # pip install lmdb
 
@@ -120,6 +125,10 @@ def open_lmdb(lmdb_dir: str, *, max_images: Optional[int]):
     def iterate_images():
         with lmdb.open(lmdb_dir, readonly=True, lock=False).begin(write=False) as txn:
             for idx, (_key, value) in enumerate(txn.cursor()):
+                if select is not None and not select(idx):
+                    if idx >= max_idx - 1:
+                        break
+                    continue
                 try:
                     try:
                         img = cv2.imdecode(np.frombuffer(value, dtype=np.uint8), 1)
@@ -128,7 +137,7 @@ def open_lmdb(lmdb_dir: str, *, max_images: Optional[int]):
                         img = img[:, :, ::-1] # BGR => RGB
                     except IOError:
                         img = np.array(PIL.Image.open(io.BytesIO(value)))
-                    yield dict(img=img, label=None)
+                    yield dict(img=img, label=None, idx=idx)
                     if idx >= max_idx - 1:
                         break
                 except:
@@ -138,7 +147,7 @@ def open_lmdb(lmdb_dir: str, *, max_images: Optional[int]):
 
 #----------------------------------------------------------------------------
 
-def open_cifar10(tarball: str, *, max_images: Optional[int]):
+def open_cifar10(tarball: str, *, max_images: Optional[int], select: Optional[Callable[[int], bool]] = None):
     images = []
     labels = []
 
@@ -162,7 +171,8 @@ def open_cifar10(tarball: str, *, max_images: Optional[int]):
 
     def iterate_images():
         for idx, img in enumerate(images):
-            yield dict(img=img, label=int(labels[idx]))
+            if select is None or select(idx):
+                yield dict(img=img, label=int(labels[idx]), idx=idx)
             if idx >= max_idx - 1:
                 break
 
@@ -170,7 +180,7 @@ def open_cifar10(tarball: str, *, max_images: Optional[int]):
 
 #----------------------------------------------------------------------------
 
-def open_mnist(images_gz: str, *, max_images: Optional[int]):
+def open_mnist(images_gz: str, *, max_images: Optional[int], select: Optional[Callable[[int], bool]] = None):
     labels_gz = images_gz.replace('-images-idx3-ubyte.gz', '-labels-idx1-ubyte.gz')
     assert labels_gz != images_gz
     images = []
@@ -192,7 +202,8 @@ def open_mnist(images_gz: str, *, max_images: Optional[int]):
 
     def iterate_images():
         for idx, img in enumerate(images):
-            yield dict(img=img, label=int(labels[idx]))
+            if select is None or select(idx):
+                yield dict(img=img, label=int(labels[idx]), idx=idx)
             if idx >= max_idx - 1:
                 break
 
@@ -255,19 +266,19 @@ def make_transform(
 
 #----------------------------------------------------------------------------
 
-def open_dataset(source, *, max_images: Optional[int]):
+def open_dataset(source, *, max_images: Optional[int], select: Optional[Callable[[int], bool]] = None):
     if os.path.isdir(source):
         if source.rstrip('/').endswith('_lmdb'):
-            return open_lmdb(source, max_images=max_images)
+            return open_lmdb(source, max_images=max_images, select=select)
         else:
-            return open_image_folder(source, max_images=max_images)
+            return open_image_folder(source, max_images=max_images, select=select)
     elif os.path.isfile(source):
         if os.path.basename(source) == 'cifar-10-python.tar.gz':
-            return open_cifar10(source, max_images=max_images)
+            return open_cifar10(source, max_images=max_images, select=select)
         elif os.path.basename(source) == 'train-images-idx3-ubyte.gz':
-            return open_mnist(source, max_images=max_images)
+            return open_mnist(source, max_images=max_images, select=select)
         elif file_ext(source) == 'zip':
-            return open_image_zip(source, max_images=max_images)
+            return open_image_zip(source, max_images=max_images, select=select)
         else:
             assert False, 'unknown archive type'
     else:
@@ -275,7 +286,12 @@ def open_dataset(source, *, max_images: Optional[int]):
 
 #----------------------------------------------------------------------------
 
-def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None], Callable[[], None]]:
+# Zip members get a fixed timestamp so that converting the same dataset twice
+# gives the same archive, byte for byte.
+
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def open_dest(dest: str, resume: bool = False) -> Tuple[str, Callable[[str, Union[bytes, str]], None], Callable[[], None]]:
     dest_ext = file_ext(dest)
 
     if dest_ext == 'zip':
@@ -283,7 +299,9 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
             os.makedirs(os.path.dirname(dest), exist_ok=True)
         zf = zipfile.ZipFile(file=dest, mode='w', compression=zipfile.ZIP_STORED)
         def zip_write_bytes(fname: str, data: Union[bytes, str]):
-            zf.writestr(fname, data)
+            zinfo = zipfile.ZipInfo(fname, date_time=ZIP_DATE_TIME)
+            zinfo.external_attr = 0o600 << 16 # same as writestr(fname, data)
+            zf.writestr(zinfo, data)
         return '', zip_write_bytes, zf.close
     else:
         # If the output folder already exists, check that is is
@@ -293,7 +311,7 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
         # necessary as folder_write_bytes() also mkdirs, but it's better
         # to give an error message earlier in case the dest folder
         # somehow cannot be created.
-        if os.path.isdir(dest) and len(os.listdir(dest)) != 0:
+        if not resume and os.path.isdir(dest) and len(os.listdir(dest)) != 0:
             raise click.ClickException('--dest folder must be empty')
         os.makedirs(dest, exist_ok=True)
 
@@ -305,6 +323,155 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
                 fout.write(data)
         return dest, folder_write_bytes, lambda: None
 
+#----------------------------------------------------------------------------
+# Memory-mapped output: the images are appended to images.bin as uint8 CHW,
+# the labels are saved to labels.npy and the shape to dataset.json, see
+# MemmapDataset in training/dataset.py.
+
+def open_memmap_dest(dest: str, resume: bool = False) -> Tuple[Callable[[bytes, dict], None], Callable[[list], None]]:
+    if not resume and os.path.isdir(dest) and len(os.listdir(dest)) != 0:
+        raise click.ClickException('--dest folder must be empty')
+    os.makedirs(dest, exist_ok=True)
+    fout = open(os.path.join(dest, 'images.bin'), 'wb')
+    image_shape = None
+    num_images = 0
+
+    def memmap_write_image(data: bytes, attrs: dict):
+        nonlocal image_shape, num_images
+        shape = [attrs['channels'], attrs['height'], attrs['width']]
+        image_shape = shape if image_shape is None else image_shape
+        assert shape == image_shape and len(data) == np.prod(shape)
+        fout.write(data)
+        num_images += 1
+
+    def memmap_close(labels: list):
+        fout.close()
+        if len(labels) > 0 and all(x is not None for x in labels):
+            labels = np.array(labels)
+            np.save(os.path.join(dest, 'labels.npy'), labels.astype({1: np.int64, 2: np.float32}[labels.ndim]))
+        with open(os.path.join(dest, 'dataset.json'), 'w') as f:
+            json.dump({'format': 'memmap', 'dtype': 'uint8', 'shape': [num_images] + (image_shape or [])}, f)
+    return memmap_write_image, memmap_close
+
+#----------------------------------------------------------------------------
+# Crop, resize and encode one image: an uncompressed PNG, or raw uint8 CHW
+# for memory-mapped output. 'attrs' is None if the transform skipped it.
+
+def convert_image(image: dict, transform_image: Callable[[np.ndarray], Optional[np.ndarray]], memmap: bool) -> dict:
+    img = transform_image(image['img'])
+    if img is None:
+        return dict(label=image['label'], attrs=None, data=None)
+    channels = img.shape[2] if img.ndim == 3 else 1
+    attrs = {'width': img.shape[1], 'height': img.shape[0], 'channels': channels}
+    if memmap:
+        img = img[np.newaxis] if img.ndim == 2 else img.transpose(2, 0, 1) # HWC => CHW
+        data = np.ascontiguousarray(img, dtype=np.uint8).tobytes()
+    else:
+        img = PIL.Image.fromarray(img, {1: 'L', 3: 'RGB'}[channels])
+        image_bits = io.BytesIO()
+        img.save(image_bits, format='png', compress_level=0, optimize=False)
+        data = image_bits.getvalue()
+    return dict(label=image['label'], attrs=attrs, data=data)
+
+#----------------------------------------------------------------------------
+# Error check to require uniform image attributes across the whole dataset.
+
+def check_image_attrs(dataset_attrs: Optional[dict], cur_image_attrs: dict, archive_fname: str) -> dict:
+    if dataset_attrs is None:
+        dataset_attrs = cur_image_attrs
+        width = dataset_attrs['width']
+        height = dataset_attrs['height']
+        if width != height:
+            raise click.ClickException(f'Image dimensions after scale and crop are required to be square.  Got {width}x{height}')
+        if dataset_attrs['channels'] not in [1, 3]:
+            raise click.ClickException('Input images must be stored as RGB or grayscale')
+        if width != 2 ** int(np.floor(np.log2(width))):
+            raise click.ClickException('Image width/height after scale and crop are required to be power-of-two')
+    elif dataset_attrs != cur_image_attrs:
+        err = [f'  dataset {k}/cur image {k}: {dataset_attrs[k]}/{cur_image_attrs[k]}' for k in dataset_attrs.keys()]
+        raise click.ClickException(f'Image {archive_fname} attributes must be equal across all images of the dataset.  Got:\n' + '\n'.join(err))
+    return dataset_attrs
+
+#----------------------------------------------------------------------------
+# Parallel conversion. The source images are split into chunks of
+# consecutive indices, and every worker process converts its share of the
+# chunks into shard files under `<dest>.parts/`. Completed shards survive an
+# interrupted run and are reused with --resume. The shards are then read
+# back in order and written to the destination by the main process exactly
+# like the serial path, so both give the same output, byte for byte.
+
+def get_shard_path(parts_dir: str, chunk_idx: int) -> str:
+    return os.path.join(parts_dir, f'chunk-{chunk_idx:06d}.pkl')
+
+def convert_worker(source: str, max_images: Optional[int], transform: Optional[str], resolution: Tuple[Optional[int], Optional[int]],
+                   memmap: bool, parts_dir: str, chunk_size: int, chunks: list):
+    PIL.Image.init()
+    chunks = set(chunks)
+    _num_files, input_iter = open_dataset(source, max_images=max_images, select=lambda idx: idx // chunk_size in chunks)
+    transform_image = make_transform(transform, *resolution)
+
+    def save_shard(chunk_idx, items):
+        shard_path = get_shard_path(parts_dir, chunk_idx)
+        with open(shard_path + '.tmp', 'wb') as f:
+            pickle.dump(items, f)
+        os.replace(shard_path + '.tmp', shard_path) # atomic, the shard is either complete or missing
+        chunks.discard(chunk_idx)
+
+    # Images that fail to decode are not yielded and leave no entry in the shard.
+    cur_chunk, items = None, []
+    for image in input_iter:
+        chunk_idx = image['idx'] // chunk_size
+        if chunk_idx != cur_chunk:
+            if cur_chunk is not None:
+                save_shard(cur_chunk, items)
+            cur_chunk, items = chunk_idx, []
+        items.append(convert_image(image, transform_image, memmap))
+    if cur_chunk is not None:
+        save_shard(cur_chunk, items)
+    for chunk_idx in sorted(chunks):
+        save_shard(chunk_idx, [])
+
+def convert_parallel(source: str, max_images: Optional[int], transform: Optional[str], resolution: Tuple[Optional[int], Optional[int]],
+                     memmap: bool, parts_dir: str, workers: int, chunk_size: int, resume: bool):
+    num_files, _input_iter = open_dataset(source, max_images=max_images)
+    num_chunks = (num_files - 1) // chunk_size + 1 if num_files > 0 else 0
+    make_transform(transform, *resolution) # fail early on invalid options
+
+    # The shards of an interrupted run can only be reused with the same options.
+    config = dict(source=os.path.abspath(source), num_files=num_files, transform=transform, resolution=list(resolution), memmap=memmap, chunk_size=chunk_size)
+    config_path = os.path.join(parts_dir, 'config.json')
+    if os.path.isdir(parts_dir) and not resume:
+        raise click.ClickException(f'Found the shards of an interrupted conversion in {parts_dir}, use --resume to continue it or remove them')
+    if os.path.isfile(config_path):
+        with open(config_path, 'r') as f:
+            if json.load(f) != config:
+                raise click.ClickException(f'Cannot resume from {parts_dir}, it was created with different options')
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(config_path + '.tmp', 'w') as f:
+        json.dump(config, f)
+    os.replace(config_path + '.tmp', config_path)
+
+    todo = [chunk_idx for chunk_idx in range(num_chunks) if not os.path.isfile(get_shard_path(parts_dir, chunk_idx))]
+    print(f'Converting {len(todo)} of {num_chunks} chunks with {workers} workers...')
+    procs = []
+    for rank in range(min(workers, len(todo))):
+        args = (source, max_images, transform, resolution, memmap, parts_dir, chunk_size, todo[rank::workers])
+        procs.append(multiprocessing.Process(target=convert_worker, args=args, daemon=True))
+        procs[-1].start()
+    with tqdm(initial=num_chunks - len(todo), total=num_chunks, unit='chunk') as pbar:
+        while any(proc.is_alive() for proc in procs):
+            time.sleep(1)
+            num_done = sum(os.path.isfile(get_shard_path(parts_dir, chunk_idx)) for chunk_idx in range(num_chunks))
+            pbar.update(num_done - pbar.n)
+    if any(proc.exitcode != 0 for proc in procs):
+        raise click.ClickException('A conversion worker failed, rerun with --resume to continue')
+
+    def iterate_shards():
+        for chunk_idx in range(num_chunks):
+            with open(get_shard_path(parts_dir, chunk_idx), 'rb') as f:
+                yield from pickle.load(f)
+    return num_files, iterate_shards()
+
 #----------------------------------------------------------------------------
 
 @click.command()
@@ -313,13 +480,19 @@ def open_dest(dest: str) -> Tuple[str, Callable[[str, Union[bytes, str]], None],
 @click.option('--max-images', help='Maximum number of images to output', metavar='INT', type=int)
 @click.option('--transform',  help='Input crop/resize mode', metavar='MODE',            type=click.Choice(['center-crop', 'center-crop-wide']))
 @click.option('--resolution', help='Output resolution (e.g., 512x512)', metavar='WxH',  type=parse_tuple)
+@click.option('--workers',    help='Number of conversion processes', metavar='INT',     type=click.IntRange(min=1), default=1, show_default=True)
+@click.option('--chunk-size', help='Images per shard of a parallel conversion', metavar='INT', type=click.IntRange(min=1), default=1000, show_default=True)
+@click.option('--resume',     help='Resume an interrupted parallel conversion',         is_flag=True)
 
 def main(
     source: str,
     dest: str,
     max_images: Optional[int],
     transform: Optional[str],
-    resolution: Optional[Tuple[int, int]]
+    resolution: Optional[Tuple[int, int]],
+    workers: int,
+    chunk_size: int,
+    resume: bool
 ):
     """Convert an image dataset into a dataset archive usable with StyleGAN2 ADA PyTorch.
 
@@ -337,10 +510,13 @@ def main(
     \b
     --dest /path/to/dir                 Save output files under /path/to/dir
     --dest /path/to/dataset.zip         Save output files into /path/to/dataset.zip
+    --dest /path/to/dataset.mmap        Save a memory-mapped array under /path/to/dataset.mmap
 
-    The output dataset format can be either an image folder or an uncompressed zip archive.
-    Zip archives makes it easier to move datasets around file servers and clusters, and may
-    offer better training performance on network file systems.
+    The output dataset format can be either an image folder, an uncompressed zip archive
+    or a memory-mapped array. Zip archives makes it easier to move datasets around file
+    servers and clusters, and may offer better training performance on network file systems.
+    Memory-mapped arrays store the images as raw uint8 [N, C, H, W], so they are loaded
+    without decoding; the labels are stored in 'labels.npy'.
 
     Images within the dataset archive will be stored as uncompressed PNG.
     Uncompresed PNGs can be efficiently decoded in the training loop.
@@ -378,6 +554,12 @@ def main(
     \b
     python dataset_tool.py --source LSUN/raw/cat_lmdb --dest /tmp/lsun_cat \\
         --transform=center-crop-wide --resolution=512x384
+
+    Use --workers=N to decode, crop, resize and encode the images in N processes.
+    The workers write shards of --chunk-size images under <dest>.parts/, which are
+    then written to --dest in order, so the output is identical to --workers=1. If
+    the conversion is interrupted, rerun the same command with --resume to reuse
+    the completed shards.
     """
 
     PIL.Image.init()
@@ -385,11 +567,20 @@ def main(
     if dest == '':
         raise click.ClickException('--dest output filename or directory must not be an empty string')
 
-    num_files, input_iter = open_dataset(source, max_images=max_images)
-    archive_root_dir, save_bytes, close_dest = open_dest(dest)
-
+    memmap = file_ext(dest.rstrip('/')) == 'mmap'
     if resolution is None: resolution = (None, None)
-    transform_image = make_transform(transform, *resolution)
+    parts_dir = dest.rstrip('/') + '.parts'
+    if memmap:
+        write_image, close_memmap = open_memmap_dest(dest, resume=resume)
+    else:
+        archive_root_dir, save_bytes, close_dest = open_dest(dest, resume=resume)
+
+    if workers > 1 or resume:
+        num_files, input_iter = convert_parallel(source, max_images, transform, resolution, memmap, parts_dir, workers, chunk_size, resume)
+    else:
+        num_files, input_iter = open_dataset(source, max_images=max_images)
+        transform_image = make_transform(transform, *resolution)
+        input_iter = (convert_image(image, transform_image, memmap) for image in input_iter)
 
     dataset_attrs = None
 
@@ -398,39 +589,29 @@ def main(
         idx_str = f'{idx:08d}'
         archive_fname = f'{idx_str[:5]}/img{idx_str}.png'
 
-        # Apply crop and resize.
-        img = transform_image(image['img'])
-        if img is None:
+        # Skipped by the crop transform.
+        if image['attrs'] is None:
             continue
+        dataset_attrs = check_image_attrs(dataset_attrs, image['attrs'], archive_fname)
 
-        # Error check to require uniform image attributes across
-        # the whole dataset.
-        channels = img.shape[2] if img.ndim == 3 else 1
-        cur_image_attrs = {'width': img.shape[1], 'height': img.shape[0], 'channels': channels}
-        if dataset_attrs is None:
-            dataset_attrs = cur_image_attrs
-            width = dataset_attrs['width']
-            height = dataset_attrs['height']
-            if width != height:
-                raise click.ClickException(f'Image dimensions after scale and crop are required to be square.  Got {width}x{height}')
-            if dataset_attrs['channels'] not in [1, 3]:
-                raise click.ClickException('Input images must be stored as RGB or grayscale')
-            if width != 2 ** int(np.floor(np.log2(width))):
-                raise click.ClickException('Image width/height after scale and crop are required to be power-of-two')
-        elif dataset_attrs != cur_image_attrs:
-            err = [f'  dataset {k}/cur image {k}: {dataset_attrs[k]}/{cur_image_attrs[k]}' for k in dataset_attrs.keys()]
-            raise click.ClickException(f'Image {archive_fname} attributes must be equal across all images of the dataset.  Got:\n' + '\n'.join(err))
+        # Append the raw image to the memory-mapped array.
+        if memmap:
+            write_image(image['data'], image['attrs'])
+            labels.append(image['label'])
+            continue
 
         # Save the image as an uncompressed PNG.
-        img = PIL.Image.fromarray(img, {1: 'L', 3: 'RGB'}[channels])
-        image_bits = io.BytesIO()
-        img.save(image_bits, format='png', compress_level=0, optimize=False)
-        save_bytes(os.path.join(archive_root_dir, archive_fname), image_bits.getbuffer())
+        save_bytes(os.path.join(archive_root_dir, archive_fname), image['data'])
         labels.append([archive_fname, image['label']] if image['label'] is not None else None)
 
-    metadata = {'labels': labels if all(x is not None for x in labels) else None}
-    save_bytes(os.path.join(archive_root_dir, 'dataset.json'), json.dumps(metadata))
-    close_dest()
+    if memmap:
+        close_memmap(labels)
+    else:
+        metadata = {'labels': labels if all(x is not None for x in labels) else None}
+        save_bytes(os.path.join(archive_root_dir, 'dataset.json'), json.dumps(metadata))
+        close_dest()
+    if workers > 1 or resume:
+        shutil.rmtree(parts_dir)
 
 #----------------------------------------------------------------------------
 
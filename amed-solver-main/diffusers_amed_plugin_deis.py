@@ -0,0 +1,238 @@
+# Copyright 2024 FLAIR Lab and The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# DISCLAIMER: check https://arxiv.org/abs/2204.13902 and https://github.com/qsh-zh/deis for more info
+# The codebase is modified based on https://github.com/huggingface/diffusers/blob/main/src/diffusers/schedulers/scheduling_deis_multistep.py
+
+from typing import List, Union
+
+import json
+import torch
+import numpy as np
+
+from diffusers import DEISMultistepScheduler as DefaultDEIS
+from solver_utils import deis_update
+
+class DEISMultistepScheduler(DefaultDEIS):
+
+    def set_timesteps(
+        self,
+        num_inference_steps: int = None,
+        device: Union[str, torch.device] = None,
+        timesteps: List[float] = None,
+    ):
+        """
+        Sets the discrete timesteps used for the diffusion chain (to be run before inference).
+
+        Args:
+            num_inference_steps (`int`):
+                The number of diffusion steps used when generating samples with a pre-trained model.
+            device (`str` or `torch.device`, *optional*):
+                The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            timesteps (`List[int]`, *optional*):
+                The AMED timesteps [t_0, t_mid_0, t_1, t_mid_1, ..., t_N] ending with the last timestep.
+        """
+        self.model_sigmas = None
+        if timesteps is None:
+            super().set_timesteps(num_inference_steps, device)
+            return
+
+        assert hasattr(self, "scale_dirs"), "scale_dirs must be set before calling set_timesteps"
+        assert hasattr(self, "scale_times"), "scale_times must be set before calling set_timesteps"
+        all_sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+        self.sigmas = torch.from_numpy(all_sigmas[timesteps])
+        self.timesteps = torch.tensor(timesteps[:-1]).to(device=device, dtype=torch.int64) # Ignore the last 0
+
+        # Scale odd-indexed components of self.sigmas by self.scale_times and retrieve timesteps from scaled sigmas
+        for i in range(len(self.scale_times)):
+            if i % 2 == 1:
+                sigma_target = self.sigmas[i] * self.scale_times[i]
+                sigmas_source = torch.tensor(all_sigmas[timesteps[i+1]+1:timesteps[i-1]])
+                self.timesteps[i] = timesteps[i+1] + 1 + torch.argmin(torch.abs(sigmas_source - sigma_target)).data
+
+        # The model is evaluated at the scaled sigmas while the steps are taken between the unscaled ones
+        self.model_sigmas = torch.from_numpy(all_sigmas[self.timesteps.cpu().numpy()])
+
+        self.num_inference_steps = len(timesteps)
+        self.model_outputs = [None,] * self.config.solver_order
+        self.lower_order_nums = 0
+
+        # add an index counter for schedulers that allow duplicated timesteps
+        self._step_index = None
+        self._begin_index = None
+        self.sigmas = self.sigmas.to("cpu")  # to avoid too much CPU/GPU communication
+
+    def load_amed_table(self, table: Union[str, dict]) -> List[int]:
+        """
+        Loads a static AMED table exported by `amed_table.py export` and sets `scale_dirs`, `scale_times` and
+        `deis_mode`. The samplers in `solvers_amed.py` do not lower the order at the final steps, so the scheduler
+        should be created with `lower_order_final=False` to reproduce them.
+
+        Args:
+            table (`str` or `dict`):
+                The path to the exported JSON file, or its content.
+
+        Returns:
+            `List[int]`: The timesteps to pass to `set_timesteps`.
+        """
+        if isinstance(table, str):
+            with open(table, "r") as f:
+                table = json.load(f)
+        self.scale_dirs = table["scale_dirs"]
+        self.scale_times = table["scale_times"]
+        self.deis_mode = table.get("settings", {}).get("deis_mode") or "tab"
+        if "timesteps" in table:
+            return table["timesteps"]
+
+        # Retrieve the timesteps nearest to the exported sigmas
+        all_sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+        return [int(np.argmin(np.abs(all_sigmas - sigma))) for sigma in table["sigmas"]]
+
+    def get_model_sigma(self) -> torch.FloatTensor:
+        if getattr(self, "model_sigmas", None) is None:
+            return self.sigmas[self.step_index]
+        return self.model_sigmas[self.step_index]
+
+    def scale_model_input(self, sample: torch.FloatTensor, *args, **kwargs) -> torch.FloatTensor:
+        """
+        Rescales the sample at the current sigma to the (scaled) sigma at which the model is evaluated, so that the
+        model input matches the one of the EDM-wrapped model in `solvers_amed.py`.
+
+        Args:
+            sample (`torch.FloatTensor`):
+                The input sample.
+            timestep (`int`, *optional*):
+                The current timestep in the diffusion chain.
+
+        Returns:
+            `torch.FloatTensor`:
+                A scaled input sample.
+        """
+        if getattr(self, "model_sigmas", None) is None:
+            return sample
+        if self.step_index is None:
+            self._init_step_index(args[0] if len(args) > 0 else kwargs["timestep"])
+        alpha_t, _ = self._sigma_to_alpha_sigma_t(self.sigmas[self.step_index])
+        alpha_model, _ = self._sigma_to_alpha_sigma_t(self.get_model_sigma())
+        return sample * (alpha_model / alpha_t).to(sample.device)
+
+    def convert_model_output(
+        self,
+        model_output: torch.FloatTensor,
+        *args,
+        sample: torch.FloatTensor = None,
+        **kwargs,
+    ) -> torch.FloatTensor:
+        """
+        Converts the model output at the (scaled) model sigma to the equivalent output at the current sigma before the
+        conversion of the parent scheduler, as the EDM-wrapped model in `solvers_amed.py`.
+        """
+        if getattr(self, "model_sigmas", None) is not None:
+            if sample is None:
+                sample = args[1]
+            sigma, sigma_model = self.sigmas[self.step_index], self.get_model_sigma()
+            if self.config.prediction_type == "epsilon":
+                model_output = model_output * (sigma_model / sigma).to(model_output.device)
+            elif self.config.prediction_type == "v_prediction":
+                alpha_t, sigma_t = self._sigma_to_alpha_sigma_t(sigma.to(sample.device))
+                alpha_model, sigma_model = self._sigma_to_alpha_sigma_t(sigma_model.to(sample.device))
+                x0_pred = alpha_model * (sample * alpha_model / alpha_t) - sigma_model * model_output
+                model_output = (alpha_t * sample - x0_pred) / sigma_t
+        return super().convert_model_output(model_output, *args, sample=sample, **kwargs)
+
+    def amed_deis_update(
+        self,
+        model_output_list: List[torch.FloatTensor],
+        sample: torch.FloatTensor,
+        order: int,
+    ) -> torch.FloatTensor:
+        """
+        One step of the DEIS of `solver_utils.py` with the update direction scaled by `self.scale_dirs`. The sample is
+        converted to the EDM space, where the model outputs (noise predictions) are the gradients of the sampling ODE.
+
+        Args:
+            model_output_list (`List[torch.FloatTensor]`):
+                The converted model outputs, the current one last.
+            sample (`torch.FloatTensor`):
+                The sample at the beginning of the step.
+            order (`int`):
+                The order of the step.
+
+        Returns:
+            `torch.FloatTensor`:
+                The sample at the end of the step.
+        """
+        sigmas = self.sigmas.to(device=sample.device, dtype=sample.dtype)
+        sigma_prev_list = [sigmas[self.step_index - j] for j in reversed(range(order))]
+        sigma_t, sigma_s = sigmas[self.step_index + 1], sigmas[self.step_index]
+        alpha_t, _ = self._sigma_to_alpha_sigma_t(sigma_t)
+        alpha_s, _ = self._sigma_to_alpha_sigma_t(sigma_s)
+        x_t = deis_update(
+            sample / alpha_s,
+            model_output_list[-order:],
+            sigma_prev_list,
+            sigma_t,
+            order,
+            deis_mode=getattr(self, "deis_mode", "tab"),
+            scale=self.scale_dirs[self.step_index],
+        )
+        return alpha_t * x_t
+
+    def deis_first_order_update(
+        self,
+        model_output: torch.FloatTensor,
+        *args,
+        sample: torch.FloatTensor = None,
+        **kwargs,
+    ) -> torch.FloatTensor:
+        """
+        One step for the first-order DEIS (equivalent to DDIM) with the update direction scaled by AMED.
+        """
+        if getattr(self, "model_sigmas", None) is None:
+            return super().deis_first_order_update(model_output, *args, sample=sample, **kwargs)
+        if sample is None:
+            sample = args[2]
+        return self.amed_deis_update([model_output], sample, 1)
+
+    def multistep_deis_second_order_update(
+        self,
+        model_output_list: List[torch.FloatTensor],
+        *args,
+        sample: torch.FloatTensor = None,
+        **kwargs,
+    ) -> torch.FloatTensor:
+        """
+        One step for the second-order multistep DEIS with the update direction scaled by AMED.
+        """
+        if getattr(self, "model_sigmas", None) is None:
+            return super().multistep_deis_second_order_update(model_output_list, *args, sample=sample, **kwargs)
+        if sample is None:
+            sample = args[2]
+        return self.amed_deis_update(model_output_list, sample, 2)
+
+    def multistep_deis_third_order_update(
+        self,
+        model_output_list: List[torch.FloatTensor],
+        *args,
+        sample: torch.FloatTensor = None,
+        **kwargs,
+    ) -> torch.FloatTensor:
+        """
+        One step for the third-order multistep DEIS with the update direction scaled by AMED.
+        """
+        if getattr(self, "model_sigmas", None) is None:
+            return super().multistep_deis_third_order_update(model_output_list, *args, sample=sample, **kwargs)
+        if sample is None:
+            sample = args[2]
+        return self.amed_deis_update(model_output_list, sample, 3)
@@ -16,6 +16,7 @@
 
 from typing import List, Optional, Tuple, Union
 
+import json
 import torch
 import numpy as np
 
@@ -67,6 +68,29 @@ class DPMSolverMultistepScheduler(DefaultDPMSolver):
         self._begin_index = None
         self.sigmas = self.sigmas.to("cpu")  # to avoid too much CPU/GPU communication
 
+    def load_amed_table(self, table: Union[str, dict]) -> List[int]:
+        """
+        Loads a static AMED table exported by `amed_table.py export` and sets `scale_dirs` and `scale_times`.
+
+        Args:
+            table (`str` or `dict`):
+                The path to the exported JSON file, or its content.
+
+        Returns:
+            `List[int]`: The timesteps to pass to `set_timesteps`.
+        """
+        if isinstance(table, str):
+            with open(table, "r") as f:
+                table = json.load(f)
+        self.scale_dirs = table["scale_dirs"]
+        self.scale_times = table["scale_times"]
+        if "timesteps" in table:
+            return table["timesteps"]
+
+        # Retrieve the timesteps nearest to the exported sigmas
+        all_sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+        return [int(np.argmin(np.abs(all_sigmas - sigma))) for sigma in table["sigmas"]]
+
     def dpm_solver_first_order_update(
         self,
         model_output: torch.FloatTensor,
@@ -0,0 +1,195 @@
+# Copyright 2024 Katherine Crowson and The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The codebase is modified based on https://github.com/huggingface/diffusers/blob/main/src/diffusers/schedulers/scheduling_euler_discrete.py
+
+from typing import List, Optional, Tuple, Union
+
+import json
+import torch
+import numpy as np
+
+from diffusers import EulerDiscreteScheduler as DefaultEuler
+from diffusers.schedulers.scheduling_euler_discrete import EulerDiscreteSchedulerOutput
+
+class EulerDiscreteScheduler(DefaultEuler):
+
+    def set_timesteps(
+        self,
+        num_inference_steps: int = None,
+        device: Union[str, torch.device] = None,
+        timesteps: List[float] = None,
+    ):
+        """
+        Sets the discrete timesteps used for the diffusion chain (to be run before inference).
+
+        Args:
+            num_inference_steps (`int`):
+                The number of diffusion steps used when generating samples with a pre-trained model.
+            device (`str` or `torch.device`, *optional*):
+                The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            timesteps (`List[int]`, *optional*):
+                The AMED timesteps [t_0, t_mid_0, t_1, t_mid_1, ..., t_N] ending with the last timestep.
+        """
+        self.model_sigmas = None
+        if timesteps is None:
+            super().set_timesteps(num_inference_steps, device)
+            return
+
+        assert hasattr(self, "scale_dirs"), "scale_dirs must be set before calling set_timesteps"
+        assert hasattr(self, "scale_times"), "scale_times must be set before calling set_timesteps"
+        all_sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+        self.sigmas = torch.from_numpy(all_sigmas[timesteps]).to(torch.float32)
+        timesteps_model = np.array(timesteps[:-1]) # Ignore the last 0
+
+        # Scale odd-indexed components of self.sigmas by self.scale_times and retrieve timesteps from scaled sigmas
+        for i in range(len(self.scale_times)):
+            if i % 2 == 1:
+                sigma_target = self.sigmas[i] * self.scale_times[i]
+                sigmas_source = torch.tensor(all_sigmas[timesteps[i+1]+1:timesteps[i-1]])
+                timesteps_model[i] = timesteps[i+1] + 1 + torch.argmin(torch.abs(sigmas_source - sigma_target)).item()
+
+        # The model is evaluated at the scaled sigmas while the steps are taken between the unscaled ones
+        self.model_sigmas = torch.from_numpy(all_sigmas[timesteps_model]).to(torch.float32)
+        self.timesteps = torch.from_numpy(timesteps_model.astype(np.float32)).to(device=device)
+        self.num_inference_steps = len(timesteps)
+
+        # add an index counter for schedulers that allow duplicated timesteps
+        self._step_index = None
+        self._begin_index = None
+        self.sigmas = self.sigmas.to("cpu")  # to avoid too much CPU/GPU communication
+
+    def load_amed_table(self, table: Union[str, dict]) -> List[int]:
+        """
+        Loads a static AMED table exported by `amed_table.py export` and sets `scale_dirs` and `scale_times`.
+
+        Args:
+            table (`str` or `dict`):
+                The path to the exported JSON file, or its content.
+
+        Returns:
+            `List[int]`: The timesteps to pass to `set_timesteps`.
+        """
+        if isinstance(table, str):
+            with open(table, "r") as f:
+                table = json.load(f)
+        self.scale_dirs = table["scale_dirs"]
+        self.scale_times = table["scale_times"]
+        if "timesteps" in table:
+            return table["timesteps"]
+
+        # Retrieve the timesteps nearest to the exported sigmas
+        all_sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+        return [int(np.argmin(np.abs(all_sigmas - sigma))) for sigma in table["sigmas"]]
+
+    def get_model_sigma(self) -> torch.FloatTensor:
+        if getattr(self, "model_sigmas", None) is None:
+            return self.sigmas[self.step_index]
+        return self.model_sigmas[self.step_index]
+
+    def scale_model_input(
+        self,
+        sample: torch.FloatTensor,
+        timestep: Union[float, torch.FloatTensor],
+    ) -> torch.FloatTensor:
+        """
+        Scales the denoising model input by `(sigma**2 + 1) ** 0.5` where sigma is the (scaled) sigma at which the model
+        is evaluated.
+
+        Args:
+            sample (`torch.FloatTensor`):
+                The input sample.
+            timestep (`int`, *optional*):
+                The current timestep in the diffusion chain.
+
+        Returns:
+            `torch.FloatTensor`:
+                A scaled input sample.
+        """
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        sigma = self.get_model_sigma()
+        sample = sample / ((sigma**2 + 1) ** 0.5)
+
+        self.is_scale_input_called = True
+        return sample
+
+    def step(
+        self,
+        model_output: torch.FloatTensor,
+        timestep: Union[float, torch.FloatTensor],
+        sample: torch.FloatTensor,
+        generator: Optional[torch.Generator] = None,
+        return_dict: bool = True,
+    ) -> Union[EulerDiscreteSchedulerOutput, Tuple]:
+        """
+        Predict the sample from the previous timestep by reversing the ODE with the Euler method. The step after an
+        AMED intermediate time step is scaled by `self.scale_dirs`.
+
+        Args:
+            model_output (`torch.FloatTensor`):
+                The direct output from learned diffusion model.
+            timestep (`float`):
+                The current discrete timestep in the diffusion chain.
+            sample (`torch.FloatTensor`):
+                A current instance of a sample created by the diffusion process.
+            generator (`torch.Generator`, *optional*):
+                Unused, the AMED schedules are deterministic.
+            return_dict (`bool`):
+                Whether or not to return a [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or
+                tuple.
+
+        Returns:
+            [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or `tuple`:
+                If return_dict is `True`, [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] is
+                returned, otherwise a tuple is returned where the first element is the sample tensor.
+        """
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        # Upcast to avoid precision issues when computing prev_sample
+        sample = sample.to(torch.float32)
+        sigma = self.sigmas[self.step_index]
+        sigma_model = self.get_model_sigma()
+
+        # 1. compute predicted original sample (x_0) from sigma-scaled predicted noise
+        if self.config.prediction_type == "original_sample" or self.config.prediction_type == "sample":
+            pred_original_sample = model_output
+        elif self.config.prediction_type == "epsilon":
+            pred_original_sample = sample - sigma_model * model_output
+        elif self.config.prediction_type == "v_prediction":
+            # denoised = model_output * c_out + input * c_skip
+            pred_original_sample = model_output * (-sigma_model / (sigma_model**2 + 1) ** 0.5) + (sample / (sigma_model**2 + 1))
+        else:
+            raise ValueError(
+                f"prediction_type given as {self.config.prediction_type} must be one of `epsilon`, or `v_prediction`"
+            )
+
+        # 2. Convert to an ODE derivative and scale the direction
+        derivative = (sample - pred_original_sample) / sigma
+        dt = self.sigmas[self.step_index + 1] - sigma
+        scale_dir = self.scale_dirs[self.step_index] if getattr(self, "model_sigmas", None) is not None else 1
+        prev_sample = sample + scale_dir * derivative * dt
+
+        # Cast sample back to model compatible dtype
+        prev_sample = prev_sample.to(model_output.dtype)
+
+        # upon completion increase step index by one
+        self._step_index += 1
+
+        if not return_dict:
+            return (prev_sample, pred_original_sample)
+
+        return EulerDiscreteSchedulerOutput(prev_sample=prev_sample, pred_original_sample=pred_original_sample)
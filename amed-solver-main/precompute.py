@@ -0,0 +1,157 @@
+"""Precompute teacher trajectories for AMED training."""
+
+import os
+import re
+import csv
+import json
+import click
+import tqdm
+import numpy as np
+import torch
+from torch import autocast
+from torch_utils import distributed as dist
+from torch_utils.download_util import check_file_by_key
+from training.training_loop import create_model
+from training.loss import AMED_loss
+from training.teacher_cache import TEACHER_KEYS, get_latents_and_label, get_conditions, get_shard_paths
+
+#----------------------------------------------------------------------------
+# Parse a comma separated list of numbers or ranges and return a list of ints.
+# Example: '1,2,5-10' returns [1, 2, 5, 6, 7, 8, 9, 10]
+
+def parse_int_list(s):
+    if isinstance(s, list): return s
+    ranges = []
+    range_re = re.compile(r'^(\d+)-(\d+)$')
+    for p in s.split(','):
+        m = range_re.match(p)
+        if m:
+            ranges.extend(range(int(m.group(1)), int(m.group(2))+1))
+        else:
+            ranges.append(int(p))
+    return ranges
+
+#----------------------------------------------------------------------------
+
+@click.command()
+
+# General options.
+@click.option('--dataset_name',     help='Dataset name', metavar='STR',                                type=click.Choice(['cifar10', 'ffhq', 'afhqv2', 'imagenet64', 'lsun_bedroom', 'lsun_cat', 'imagenet256', 'ms_coco', 'lsun_bedroom_ldm']), required=True)
+@click.option('--outdir',           help='Where to save the teacher trajectories', metavar='DIR',      type=str, required=True)
+@click.option('--seeds',            help='Random seeds (e.g. 1,2,5-10)', metavar='LIST',               type=parse_int_list, default='0-9999', show_default=True)
+@click.option('--batch',            help='Batch size per GPU', metavar='INT',                          type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--shard_size',       help='Number of trajectories per shard', metavar='INT',            type=click.IntRange(min=1), default=1000, show_default=True)
+@click.option('--dtype',            help='Storage precision', metavar='STR',                           type=click.Choice(['float32', 'float16']), default='float32', show_default=True)
+
+# Options for the teacher solver, see train.py
+@click.option('--num_steps',        help='Number of time steps for training', metavar='INT',           type=click.IntRange(min=1), default=4, show_default=True)
+@click.option('--sampler_tea',      help='Teacher solver', metavar='STR',                              type=click.Choice(['heun', 'dpm', 'dpmpp', 'euler', 'ipndm']), default='heun', show_default=True)
+@click.option('--M',                help='Steps to insert between two adjacent steps', metavar='INT',  type=click.IntRange(min=1), default=1, show_default=True)
+@click.option('--guidance_type',    help='Guidance type',                                              type=click.Choice(['cg', 'cfg', 'uncond', None]), default=None, show_default=True)
+@click.option('--guidance_rate',    help='Guidance rate', metavar='FLOAT',                             type=float, default=0.)
+@click.option('--schedule_type',    help='Time discretization schedule', metavar='STR',                type=click.Choice(['polynomial', 'logsnr', 'time_uniform', 'discrete']), default='polynomial', show_default=True)
+@click.option('--schedule_rho',     help='Time step exponent', metavar='FLOAT',                        type=click.FloatRange(min=0), default=7, show_default=True)
+@click.option('--max_order',        help='max order for solvers', metavar='INT',                       type=click.IntRange(min=1), default=3)
+@click.option('--predict_x0',       help='Whether to use data prediction mode', metavar='BOOL',        type=bool, default=True)
+@click.option('--lower_order_final',help='Lower the order at final stages', metavar='BOOL',            type=bool, default=True)
+
+def main(outdir, seeds, batch, shard_size, dtype, device=torch.device('cuda'), **kwargs):
+    """Generate teacher trajectories for a seed range and store the time steps
+    used by AMED training in sharded memory-mapped files.
+
+    Examples:
+
+    \b
+    # Precompute 10k trajectories for CIFAR-10 using 4 GPUs
+    torchrun --standalone --nproc_per_node=4 precompute.py --dataset_name=cifar10 \\
+        --outdir=teacher/cifar10-heun-4 --seeds=0-9999 --sampler_tea=heun --num_steps=4 --M=1 \\
+        --schedule_type=time_uniform --schedule_rho=1
+
+    \b
+    # Train from the cache
+    torchrun --standalone --nproc_per_node=4 train.py --dataset_name=cifar10 --teacher_cache=teacher/cifar10-heun-4 ...
+    """
+    opts = dict(kwargs)
+    opts['M'] = opts.pop('m')
+    dataset_name = opts['dataset_name']
+    guidance_type = opts['guidance_type']
+    guidance_rate = opts['guidance_rate']
+    dist.init()
+
+    # Rank 0 goes first.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
+    net = create_model(dataset_name, guidance_type, guidance_rate, device)
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
+
+    sample_captions = None
+    num_labels = net.label_dim if net.label_dim and dataset_name not in ['ms_coco'] else 0
+    if dataset_name in ['ms_coco']:
+        # Loading MS-COCO captions for FID-30k evaluaion
+        # We use the selected 30k captions from https://github.com/boomb0om/text2image-benchmark
+        prompt_path, _ = check_file_by_key('prompts')
+        sample_captions = []
+        with open(prompt_path, 'r') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                text = row['text']
+                sample_captions.append(text)
+        num_labels = len(sample_captions)
+
+    loss_fn = AMED_loss(num_steps=opts['num_steps'], sampler_tea=opts['sampler_tea'], M=opts['M'], schedule_type=opts['schedule_type'], \
+                        schedule_rho=opts['schedule_rho'], max_order=opts['max_order'], sigma_min=net.sigma_min, sigma_max=net.sigma_max, \
+                        predict_x0=opts['predict_x0'], lower_order_final=opts['lower_order_final'])
+    latent_shape = [net.img_channels, net.img_resolution, net.img_resolution]
+    traj_shape = [opts['num_steps'] - 1] + latent_shape
+
+    # Every rank generates its own shards, existing shards are skipped to resume an interrupted run.
+    os.makedirs(outdir, exist_ok=True)
+    all_shards = [seeds[i : i + shard_size] for i in range(0, len(seeds), shard_size)]
+    rank_shards = list(range(dist.get_rank(), len(all_shards), dist.get_world_size()))
+    dist.print0(f'Generating {len(seeds)} teacher trajectories in {len(all_shards)} shards to "{outdir}"...')
+    for shard_idx in tqdm.tqdm(rank_shards, unit='shard', disable=(dist.get_rank() != 0)):
+        traj_path, seeds_path, labels_path = get_shard_paths(outdir, shard_idx)
+        if os.path.isfile(traj_path):
+            continue
+        shard_seeds = all_shards[shard_idx]
+        temp_path = traj_path + '.tmp.npy'
+        traj_np = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=tuple([len(shard_seeds)] + traj_shape))
+        labels_np = np.full(len(shard_seeds), -1, dtype=np.int64)
+        for start in range(0, len(shard_seeds), batch):
+            batch_seeds = shard_seeds[start : start + batch]
+            latents, label_idx = zip(*[get_latents_and_label(seed, latent_shape, num_labels) for seed in batch_seeds])
+            latents = loss_fn.sigma_max * torch.stack(latents).to(device)
+            label_idx = torch.as_tensor(label_idx, device=device)
+            with torch.no_grad():
+                labels, c, uc = get_conditions(net, label_idx, guidance_type, guidance_rate, dataset_name, sample_captions)
+                if guidance_type in ['uncond', 'cfg']:      # LDM and SD models
+                    with autocast("cuda"):
+                        with net.model.ema_scope():
+                            teacher_traj = loss_fn.get_teacher_traj(net=net, tensor_in=latents, labels=labels, condition=c, unconditional_condition=uc)
+                else:
+                    teacher_traj = loss_fn.get_teacher_traj(net=net, tensor_in=latents, labels=labels)
+            traj_np[start : start + len(batch_seeds)] = teacher_traj.transpose(0, 1).cpu().numpy().astype(dtype)
+            labels_np[start : start + len(batch_seeds)] = label_idx.cpu().numpy()
+        np.save(seeds_path, np.asarray(shard_seeds, dtype=np.int64))
+        np.save(labels_path, labels_np)
+        traj_np.flush()
+        del traj_np
+        os.replace(temp_path, traj_path) # atomic, marks the shard as completed
+
+    # Write the description of the cache.
+    torch.distributed.barrier()
+    if dist.get_rank() == 0:
+        meta = {key: opts[key] for key in TEACHER_KEYS}
+        meta.update(latent_shape=latent_shape, dtype=dtype, shards=[dict(idx=idx, num=len(shard)) for idx, shard in enumerate(all_shards)])
+        with open(os.path.join(outdir, 'meta.json'), 'wt') as f:
+            json.dump(meta, f, indent=2)
+    torch.distributed.barrier()
+    dist.print0('Done.')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
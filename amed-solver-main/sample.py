@@ -116,57 +116,48 @@ def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, devi
     return net, model_source
 
 #----------------------------------------------------------------------------
+# Find the AMED predictor of an experiment number, the latest snapshot is used.
+
+def get_predictor_path(predictor_path, exp_dir='./exps'):
+    if predictor_path.endswith('pkl') or predictor_path.endswith('json'):
+        return predictor_path
+    predictor_path_str = '0' * (5 - len(predictor_path)) + predictor_path
+    for file_name in os.listdir(exp_dir):
+        if file_name.split('-')[0] == predictor_path_str:
+            file_list = [f for f in os.listdir(os.path.join(exp_dir, file_name)) if f.endswith("pkl")]
+            max_index = -1
+            max_file = None
+            for ckpt_name in file_list:
+                file_index = int(ckpt_name.split("-")[-1].split(".")[0])
+                if file_index > max_index:
+                    max_index = file_index
+                    max_file = ckpt_name
+            return os.path.join(exp_dir, file_name, max_file)
+    return predictor_path
 
-@click.command()
-# General options
-@click.option('--predictor_path',          help='Path to trained AMED instructor', metavar='DIR',                   type=str, required=True)
-@click.option('--model_path',              help='Network filepath', metavar='PATH|URL',                             type=str)
-@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=64, show_default=True)
-@click.option('--seeds',                   help='Random seeds (e.g. 1,2,5-10)', metavar='LIST',                     type=parse_int_list, default='0-63', show_default=True)
-@click.option('--prompt',                  help='Prompt for Stable Diffusion sampling', metavar='STR',              type=str)
-@click.option('--use_fp16',                help='Whether to use mixed precision', metavar='BOOL',                   type=bool, default=False)
-
-# Options for sampling
-@click.option('--return_inters',           help='Whether to save intermediate outputs', metavar='BOOL',             type=bool, default=False)
-
-# Options for saving
-@click.option('--outdir',                  help='Where to save the output images', metavar='DIR',                   type=str)
-@click.option('--grid',                    help='Whether to make grid',                                             type=bool, default=False)
-@click.option('--subdirs',                 help='Create subdirectory for every 1000 seeds',                         type=bool, default=True, is_flag=True)
-
-def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=torch.device('cuda'), **solver_kwargs):
-
-    dist.init()
-    num_batches = ((len(seeds) - 1) // (max_batch_size * dist.get_world_size()) + 1) * dist.get_world_size()
-    all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
-    rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
-
-    # Load models.
-    if dist.get_rank() != 0:
-        torch.distributed.barrier()     # rank 0 goes first
-
-    # Load AMED predictor
-    if not predictor_path.endswith('pkl'):      # load by experiment number
-        # find the directory with trained AMED predictor
-        predictor_path_str = '0' * (5 - len(predictor_path)) + predictor_path
-        for file_name in os.listdir("./exps"):
-            if file_name.split('-')[0] == predictor_path_str:
-                file_list = [f for f in os.listdir(os.path.join('./exps', file_name)) if f.endswith("pkl")]
-                max_index = -1
-                max_file = None
-                for ckpt_name in file_list:
-                    file_index = int(ckpt_name.split("-")[-1].split(".")[0])
-                    if file_index > max_index:
-                        max_index = file_index
-                        max_file = ckpt_name
-                predictor_path = os.path.join('./exps', file_name, max_file)
-                break
+#----------------------------------------------------------------------------
+# Load a trained AMED predictor (*.pkl) or a static AMED table (*.json)
+# exported by amed_table.py.
+
+def load_predictor(predictor_path, device=None):
+    predictor_path = get_predictor_path(predictor_path)
+    if predictor_path.endswith('json'):
+        from training.networks import AMED_table
+        dist.print0(f'Loading AMED table from "{predictor_path}"...')
+        return AMED_table.load(predictor_path).to(device)
     dist.print0(f'Loading AMED predictor from "{predictor_path}"...')
     with dnnlib.util.open_url(predictor_path, verbose=(dist.get_rank() == 0)) as f:
-        AMED_predictor = pickle.load(f)['model'].to(device)
-    
+        return pickle.load(f)['model'].to(device)
+
+#----------------------------------------------------------------------------
+# Load the pre-trained diffusion model and the solver given by the AMED
+# predictor. Returns the model, the solver, the solver settings and the
+# MS-COCO captions (None for other datasets). An already loaded model can be
+# given as `model=(net, model_source)` to skip loading it again.
+
+def setup_solver(AMED_predictor, device=None, model=None, **solver_kwargs):
     # Update settings
-    prompt = solver_kwargs['prompt']
+    prompt = solver_kwargs.get('prompt', None)
     solver_kwargs = {key: value for key, value in solver_kwargs.items() if value is not None}
     solver_kwargs['AMED_predictor'] = AMED_predictor
     solver_kwargs['solver'] = solver = AMED_predictor.sampler_stu
@@ -178,20 +169,19 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
     solver_kwargs['max_order'] = AMED_predictor.max_order
     solver_kwargs['predict_x0'] = AMED_predictor.predict_x0
     solver_kwargs['lower_order_final'] = AMED_predictor.lower_order_final
+    solver_kwargs['deis_mode'] = getattr(AMED_predictor, 'deis_mode', None) or 'tab'
     solver_kwargs['schedule_type'] = AMED_predictor.schedule_type
     solver_kwargs['schedule_rho'] = AMED_predictor.schedule_rho
     solver_kwargs['prompt'] = prompt
 
     solver_kwargs['dataset_name'] = dataset_name = AMED_predictor.dataset_name
     # Load pre-trained diffusion models.
-    net, solver_kwargs['model_source'] = create_model(dataset_name, solver_kwargs['guidance_type'], solver_kwargs['guidance_rate'], device)
+    if model is None:
+        model = create_model(dataset_name, solver_kwargs['guidance_type'], solver_kwargs['guidance_rate'], device)
+    net, solver_kwargs['model_source'] = model
     # TODO: support mixed precision 
     # net.use_fp16 = solver_kwargs['use_fp16']
 
-    # Other ranks follow.
-    if dist.get_rank() == 0:
-        torch.distributed.barrier()
-    
     # Update settings
     solver_kwargs['sigma_min'] = net.sigma_min
     solver_kwargs['sigma_max'] = net.sigma_max
@@ -200,6 +190,7 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
     solver_kwargs['nfe'] = nfe
 
     # Load the prompts
+    sample_captions = None
     if dataset_name in ['ms_coco'] and solver_kwargs['prompt'] is None:
         # Loading MS-COCO captions for FID-30k evaluaion
         # We use the selected 30k captions from https://github.com/boomb0om/text2image-benchmark
@@ -211,7 +202,7 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
                 text = row['text']
                 sample_captions.append(text)
 
-    # Construct solver, 5 solvers are provided
+    # Construct solver, 7 solvers are provided
     if solver == 'amed':
         sampler_fn = solvers_amed.amed_sampler
     elif solver == 'euler':
@@ -222,6 +213,102 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
         sampler_fn = solvers_amed.ipndm_sampler
     elif solver == 'dpmpp':
         sampler_fn = solvers_amed.dpm_pp_sampler
+    elif solver == 'deis':
+        sampler_fn = solvers_amed.deis_sampler
+    elif solver == 'unipc':
+        sampler_fn = solvers_amed.unipc_sampler
+
+    return net, sampler_fn, solver_kwargs, sample_captions
+
+#----------------------------------------------------------------------------
+# Generate the images of a batch of seeds.
+
+def generate_batch(net, sampler_fn, batch_seeds, solver_kwargs, sample_captions=None, device=None):
+    batch_size = len(batch_seeds)
+    dataset_name = solver_kwargs['dataset_name']
+
+    # Pick latents and labels.
+    rnd = StackedRandomGenerator(device, batch_seeds)
+    latents = rnd.randn([batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
+    class_labels = c = uc = None
+    if net.label_dim:
+        if solver_kwargs['model_source'] == 'adm':                                              # ADM models
+            class_labels = rnd.randint(net.label_dim, size=(batch_size,), device=device)
+        elif solver_kwargs['model_source'] == 'ldm' and dataset_name == 'ms_coco':
+            if solver_kwargs['prompt'] is None:
+                prompts = sample_captions[batch_seeds[0]:batch_seeds[-1]+1]
+            else:
+                prompts = [solver_kwargs['prompt'] for i in range(batch_size)]
+            if solver_kwargs['guidance_rate'] != 1.0:
+                uc = net.model.get_learned_conditioning(batch_size * [""])
+            if isinstance(prompts, tuple):
+                prompts = list(prompts)
+            c = net.model.get_learned_conditioning(prompts)
+        else:
+            class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[batch_size], device=device)]
+
+    # Generate images.
+    with torch.no_grad():
+        if solver_kwargs['model_source'] == 'ldm':
+            with autocast("cuda"):
+                with net.model.ema_scope():
+                    images = sampler_fn(net, latents, condition=c, unconditional_condition=uc, **solver_kwargs)
+                    images = net.model.decode_first_stage(images)
+        else:
+            images = sampler_fn(net, latents, class_labels=class_labels, **solver_kwargs)
+    return images
+
+#----------------------------------------------------------------------------
+# Save the images of a batch, one file per seed.
+
+def save_images(images, batch_seeds, outdir, subdirs=True):
+    images_np = (images * 127.5 + 128).clip(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+    for seed, image_np in zip(batch_seeds, images_np):
+        image_dir = os.path.join(outdir, f'{seed-seed%1000:06d}') if subdirs else outdir
+        os.makedirs(image_dir, exist_ok=True)
+        image_path = os.path.join(image_dir, f'{seed:06d}.png')
+        PIL.Image.fromarray(image_np, 'RGB').save(image_path)
+
+#----------------------------------------------------------------------------
+
+@click.command()
+# General options
+@click.option('--predictor_path',          help='Path to trained AMED instructor or AMED table', metavar='DIR',     type=str, required=True)
+@click.option('--model_path',              help='Network filepath', metavar='PATH|URL',                             type=str)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--seeds',                   help='Random seeds (e.g. 1,2,5-10)', metavar='LIST',                     type=parse_int_list, default='0-63', show_default=True)
+@click.option('--prompt',                  help='Prompt for Stable Diffusion sampling', metavar='STR',              type=str)
+@click.option('--use_fp16',                help='Whether to use mixed precision', metavar='BOOL',                   type=bool, default=False)
+
+# Options for sampling
+@click.option('--return_inters',           help='Whether to save intermediate outputs', metavar='BOOL',             type=bool, default=False)
+
+# Options for saving
+@click.option('--outdir',                  help='Where to save the output images', metavar='DIR',                   type=str)
+@click.option('--grid',                    help='Whether to make grid',                                             type=bool, default=False)
+@click.option('--subdirs',                 help='Create subdirectory for every 1000 seeds',                         type=bool, default=True, is_flag=True)
+
+def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=torch.device('cuda'), **solver_kwargs):
+
+    dist.init()
+    num_batches = ((len(seeds) - 1) // (max_batch_size * dist.get_world_size()) + 1) * dist.get_world_size()
+    all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
+    rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
+
+    # Load models.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()     # rank 0 goes first
+
+    # Load AMED predictor and pre-trained diffusion models.
+    AMED_predictor = load_predictor(predictor_path, device)
+    net, sampler_fn, solver_kwargs, sample_captions = setup_solver(AMED_predictor, device, **solver_kwargs)
+    solver = solver_kwargs['solver']
+    dataset_name = solver_kwargs['dataset_name']
+    nfe = solver_kwargs['nfe']
+
+    # Other ranks follow.
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
     
     # Print solver settings.
     dist.print0("Solver settings:")
@@ -232,7 +319,9 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
             continue
         elif key == 'max_order' and solver in ['euler', 'dpm']:
             continue
-        elif key in ['predict_x0', 'lower_order_final'] and solver not in ['dpmpp']:
+        elif key in ['predict_x0', 'lower_order_final'] and solver not in ['dpmpp', 'unipc']:
+            continue
+        elif key == 'deis_mode' and solver not in ['deis']:
             continue
         elif key in ['prompt'] and dataset_name not in ['ms_coco']:
             continue
@@ -251,35 +340,7 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
         if batch_size == 0:
             continue
 
-        # Pick latents and labels.
-        rnd = StackedRandomGenerator(device, batch_seeds)
-        latents = rnd.randn([batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
-        class_labels = c = uc = None
-        if net.label_dim:
-            if solver_kwargs['model_source'] == 'adm':                                              # ADM models
-                class_labels = rnd.randint(net.label_dim, size=(batch_size,), device=device)
-            elif solver_kwargs['model_source'] == 'ldm' and dataset_name == 'ms_coco':
-                if solver_kwargs['prompt'] is None:
-                    prompts = sample_captions[batch_seeds[0]:batch_seeds[-1]+1]
-                else:
-                    prompts = [solver_kwargs['prompt'] for i in range(batch_size)]
-                if solver_kwargs['guidance_rate'] != 1.0:
-                    uc = net.model.get_learned_conditioning(batch_size * [""])
-                if isinstance(prompts, tuple):
-                    prompts = list(prompts)
-                c = net.model.get_learned_conditioning(prompts)
-            else:
-                class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[batch_size], device=device)]
-
-        # Generate images.
-        with torch.no_grad():
-            if solver_kwargs['model_source'] == 'ldm':
-                with autocast("cuda"):
-                    with net.model.ema_scope():
-                        images = sampler_fn(net, latents, condition=c, unconditional_condition=uc, **solver_kwargs)
-                        images = net.model.decode_first_stage(images)
-            else:
-                images = sampler_fn(net, latents, class_labels=class_labels, **solver_kwargs)
+        images = generate_batch(net, sampler_fn, batch_seeds, solver_kwargs, sample_captions, device)
 
         # Save images.
         if grid:
@@ -289,12 +350,7 @@ def main(predictor_path, max_batch_size, seeds, grid, outdir, subdirs, device=to
             image_grid = make_grid(images, nrows, padding=0)
             save_image(image_grid, os.path.join(outdir, "grid.png"))
         else:
-            images_np = (images * 127.5 + 128).clip(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
-            for seed, image_np in zip(batch_seeds, images_np):
-                image_dir = os.path.join(outdir, f'{seed-seed%1000:06d}') if subdirs else outdir
-                os.makedirs(image_dir, exist_ok=True)
-                image_path = os.path.join(image_dir, f'{seed:06d}.png')
-                PIL.Image.fromarray(image_np, 'RGB').save(image_path)
+            save_images(images, batch_seeds, outdir, subdirs)
         
     # Done.
     torch.distributed.barrier()
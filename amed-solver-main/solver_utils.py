@@ -1,3 +1,4 @@
+import functools
 import torch
 import numpy as np
 
@@ -160,3 +161,160 @@ def multistep_dpm_solver_third_update(x, model_prev_list, t_prev_list, t, predic
     return x_t
 
 
+
+#----------------------------------------------------------------------------
+
+##############################
+### Utils for UniPC solver ###
+##############################
+#----------------------------------------------------------------------------
+# Batched UniPC update (https://arxiv.org/abs/2302.04867). The time steps are
+# either shared by the whole batch or given per sample, which is the case for
+# the intermediate time steps predicted by AMED. `model_fn` maps x_t to the
+# model output at `t` and is only called when `use_corrector` is True. The
+# update direction is scaled by `scale`.
+
+def unipc_update(x, model_prev_list, t_prev_list, t, order, predict_x0=True, variant='bh2', model_fn=None, use_corrector=True, scale=1):
+    assert order <= len(model_prev_list)
+    batch_size = x.shape[0]
+    get_t = lambda v: v.reshape(-1).expand(batch_size)
+    to_4d = lambda v: v.reshape(-1, 1, 1, 1)
+
+    # first compute rks
+    t_prev_0, t = get_t(t_prev_list[-1]), get_t(t)
+    lambda_prev_0, lambda_t = -1 * t_prev_0.log(), -1 * t.log()
+    model_prev_0 = model_prev_list[-1]
+    h = lambda_t - lambda_prev_0
+
+    rks = []
+    D1s = []
+    for i in range(1, order):
+        t_prev_i = get_t(t_prev_list[-(i + 1)])
+        rk = (-1 * t_prev_i.log() - lambda_prev_0) / h
+        rks.append(rk)
+        D1s.append((model_prev_list[-(i + 1)] - model_prev_0) / to_4d(rk))
+    rks.append(torch.ones_like(h))
+    rks = torch.stack(rks, dim=1)                                   # [B, order]
+
+    hh = -h if predict_x0 else h
+    h_phi_1 = torch.expm1(hh)
+    h_phi_k = h_phi_1 / hh - 1
+    factorial_i = 1
+    if variant == 'bh1':
+        B_h = hh
+    elif variant == 'bh2':
+        B_h = torch.expm1(hh)
+    else:
+        raise NotImplementedError()
+
+    R = []
+    b = []
+    for i in range(1, order + 1):
+        R.append(torch.pow(rks, i - 1))
+        b.append(h_phi_k * factorial_i / B_h)
+        factorial_i *= (i + 1)
+        h_phi_k = h_phi_k / hh - 1 / factorial_i
+    R = torch.stack(R, dim=1)                                       # [B, order, order]
+    b = torch.stack(b, dim=1)                                       # [B, order]
+
+    # now predictor
+    pred_res = 0
+    if len(D1s) > 0:
+        D1s = torch.stack(D1s, dim=1)                               # [B, K, C, H, W]
+        # for order 2, we use a simplified version
+        rhos_p = torch.full_like(b[:, :1], 0.5) if order == 2 else torch.linalg.solve(R[:, :-1, :-1], b[:, :-1])
+        pred_res = torch.einsum('bk,bkchw->bchw', rhos_p, D1s)
+    else:
+        D1s = None
+
+    # data prediction or noise prediction
+    t, t_prev_0, h_phi_1, B_h = to_4d(t), to_4d(t_prev_0), to_4d(h_phi_1), to_4d(B_h)
+    if predict_x0:
+        x_t_ = t / t_prev_0 * x - scale * h_phi_1 * model_prev_0
+    else:
+        x_t_ = x - scale * t * h_phi_1 * model_prev_0
+        B_h = t * B_h
+    x_t = x_t_ - scale * B_h * pred_res
+
+    model_t = None
+    if use_corrector:
+        # for order 1, we use a simplified version
+        rhos_c = torch.full_like(b[:, :1], 0.5) if order == 1 else torch.linalg.solve(R, b)
+        model_t = model_fn(x_t)
+        corr_res = torch.einsum('bk,bkchw->bchw', rhos_c[:, :-1], D1s) if D1s is not None else 0
+        D1_t = model_t - model_prev_0
+        x_t = x_t_ - scale * B_h * (corr_res + to_4d(rhos_c[:, -1]) * D1_t)
+
+    return x_t, model_t
+
+#----------------------------------------------------------------------------
+
+#############################
+### Utils for DEIS solver ###
+#############################
+#----------------------------------------------------------------------------
+# Transfer from the input time (sigma) used in EDM to that (t) used in DEIS,
+# and the derivative of sigma with respect to t.
+
+def get_vp_coeffs(epsilon_s=1e-3, sigma_min=0.002, sigma_max=80):
+    beta_d = 2 * (np.log(sigma_min ** 2 + 1) / epsilon_s - np.log(sigma_max ** 2 + 1)) / (epsilon_s - 1)
+    beta_min = np.log(sigma_max ** 2 + 1) - 0.5 * beta_d
+    return beta_min, beta_d
+
+def edm2t(sigma, beta_min, beta_d):
+    return ((beta_min ** 2 + 2 * beta_d * (sigma ** 2 + 1).log()).sqrt() - beta_min) / beta_d
+
+def dsigma_dt(t, beta_min, beta_d):
+    alpha = torch.exp(-0.5 * beta_d * t ** 2 - beta_min * t)
+    return 0.5 * (beta_d * t + beta_min) / torch.sqrt(alpha * (1 - alpha))
+
+#----------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def get_gauss_legendre(num_nodes):
+    return np.polynomial.legendre.leggauss(num_nodes)
+
+#----------------------------------------------------------------------------
+# Batched DEIS update (https://arxiv.org/abs/2204.13902) with the gradients
+# `model_prev_list` at `t_prev_list`. The Lagrange polynomial through the last
+# `order` gradients is integrated from the last time step to `t` by
+# Gauss-Legendre quadrature, either in the DEIS time t ('tab') or in sigma
+# ('rhoab', exact for polynomials). The time steps may be given per sample, so
+# that the coefficients are differentiable with respect to the time steps
+# predicted by AMED. The update direction is scaled by `scale`.
+
+def deis_update(x, model_prev_list, t_prev_list, t, order, deis_mode='tab', scale=1, num_nodes=100):
+    assert order <= len(model_prev_list)
+    batch_size = x.shape[0]
+    get_t = lambda v: v.reshape(-1).expand(batch_size)
+    t_prev = [get_t(t_prev_list[-(j + 1)]) for j in range(order)]  # the current time step first
+    t = get_t(t)
+    if order == 1:              # Euler step
+        return x + scale * (t - t_prev[0]).reshape(-1, 1, 1, 1) * model_prev_list[-1]
+
+    if deis_mode == 'tab':
+        beta_min, beta_d = get_vp_coeffs()
+        t_prev = [edm2t(s, beta_min, beta_d) for s in t_prev]
+        t = edm2t(t, beta_min, beta_d)
+    elif deis_mode == 'rhoab':
+        num_nodes = (order + 1) // 2
+    else:
+        raise ValueError("Got wrong DEIS mode {}".format(deis_mode))
+    nodes, weights = get_gauss_legendre(num_nodes)
+    nodes = torch.as_tensor(nodes, dtype=x.dtype, device=x.device).reshape(1, -1)
+    weights = torch.as_tensor(weights, dtype=x.dtype, device=x.device).reshape(1, -1)
+    start, end = t_prev[0].reshape(-1, 1), t.reshape(-1, 1)
+    taus = 0.5 * (end - start) * nodes + 0.5 * (end + start)      # [B, num_nodes]
+    weights = 0.5 * (end - start) * weights
+    if deis_mode == 'tab':
+        weights = weights * dsigma_dt(taus, beta_min, beta_d)
+
+    x_next = x
+    for j in range(order):
+        poly = 1
+        for k in range(order):
+            if k != j:
+                poly = poly * (taus - t_prev[k].reshape(-1, 1)) / (t_prev[j] - t_prev[k]).reshape(-1, 1)
+        coeff = (weights * poly).sum(dim=1)
+        x_next = x_next + scale * coeff.reshape(-1, 1, 1, 1) * model_prev_list[-(j + 1)]
+    return x_next
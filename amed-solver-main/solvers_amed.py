@@ -1,31 +1,77 @@
+import functools
 import torch
 from solver_utils import *
 
 #----------------------------------------------------------------------------
-# Initialize the hook function to get the U-Net bottleneck outputs
+# Capture the U-Net bottleneck outputs for the AMED predictor. The forward hook
+# is registered once per network and kept on the bottleneck module (see
+# get_feature_capture). It writes the channel-averaged features into a buffer
+# per CUDA stream, allocated again only when the batch size changes, so that
+# the teacher running on its own stream during training (see
+# training/teacher_pipeline.py) does not overwrite the features of the student.
 
-def init_hook(net, class_labels=None):
-    unet_enc_out = []
-    def hook_fn(module, input, output):
-        unet_enc_out.append(output.detach())
+class FeatureCapture:
+    def __init__(self, module):
+        self.buffers = dict()
+        self.handle = module.register_forward_hook(self.hook_fn)
+
+    @staticmethod
+    def get_stream(device):
+        return torch.cuda.current_stream(device) if device.type == 'cuda' else None
+
+    def hook_fn(self, module, input, output):
+        stream = self.get_stream(output.device)
+        features = self.buffers.get(stream)
+        if features is None or features.shape[0] != output.shape[0]:
+            features = self.buffers[stream] = torch.zeros([output.shape[0], *output.shape[2:]], device=output.device)
+        with torch.no_grad():
+            features.copy_(torch.mean(output, dim=1))
+
+    def get(self, device):
+        # The buffer is overwritten in-place by the next model evaluation, so hand
+        # out a copy when autograd may save it for the backward pass.
+        features = self.buffers[self.get_stream(device)]
+        return features.clone() if torch.is_grad_enabled() else features
+
+def get_bottleneck(net, class_labels=None):
     if hasattr(net, 'guidance_type'):                                       # models from LDM and Stable Diffusion
-        hook = net.model.model.diffusion_model.middle_block.register_forward_hook(hook_fn)
+        return net.model.model.diffusion_model.middle_block
     elif net.img_resolution == 256:                                         # models from CM and ADM with resolution of 256
-        hook = net.model.middle_block.register_forward_hook(hook_fn)
+        return net.model.middle_block
     else:                                                                   # models from EDM
         module_name = '8x8_block2' if class_labels is not None else '8x8_block3'
-        hook = net.model.enc[module_name].register_forward_hook(hook_fn)
-    return unet_enc_out, hook
+        return net.model.enc[module_name]
+
+def get_feature_capture(net, class_labels=None):
+    module = get_bottleneck(net, class_labels)
+    if not hasattr(module, 'amed_feature_capture'):
+        module.amed_feature_capture = FeatureCapture(module)
+    return module.amed_feature_capture
+
+def init_hook(net, class_labels=None, AMED_predictor=None):
+    # Static AMED tables (see training/networks.py) do not read the bottleneck.
+    if AMED_predictor is None or not getattr(AMED_predictor, 'use_bottleneck', True):
+        return None
+    return get_feature_capture(net, class_labels)
+
+def capture_bottleneck(sampler_fn):
+    # Pass the bottleneck capture of the network to an AMED sampler as `feature_capture`.
+    @functools.wraps(sampler_fn)
+    def wrapper(net, latents, class_labels=None, *args, AMED_predictor=None, **kwargs):
+        feature_capture = init_hook(net, class_labels, AMED_predictor)
+        return sampler_fn(net, latents, class_labels, *args, AMED_predictor=AMED_predictor, feature_capture=feature_capture, **kwargs)
+    return wrapper
 
 #----------------------------------------------------------------------------
 
-def get_amed_prediction(AMED_predictor, t_cur, t_next, net, unet_enc_out, use_afs, batch_size):
+def get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size, class_labels=None):
+    use_features = feature_capture is not None and not use_afs
     if hasattr(net, 'guidance_type') and net.guidance_type == 'classifier-free':
-        unet_enc = torch.mean(unet_enc_out[-1], dim=1) if not use_afs else torch.zeros((2*batch_size, 8, 8), device=t_cur.device)
-        output = AMED_predictor(unet_enc[batch_size:], t_cur, t_next)
+        unet_enc = feature_capture.get(t_cur.device) if use_features else torch.zeros((2*batch_size, 8, 8), device=t_cur.device)
+        output = AMED_predictor(unet_enc[-batch_size:], t_cur, t_next, class_labels=class_labels)
     else:
-        unet_enc = torch.mean(unet_enc_out[-1], dim=1) if not use_afs else torch.zeros((batch_size, 8, 8), device=t_cur.device)
-        output = AMED_predictor(unet_enc, t_cur, t_next)
+        unet_enc = feature_capture.get(t_cur.device) if use_features else torch.zeros((batch_size, 8, 8), device=t_cur.device)
+        output = AMED_predictor(unet_enc, t_cur, t_next, class_labels=class_labels)
     output_list = [*output]
     
     if len(output_list) == 2:
@@ -66,6 +112,7 @@ def get_denoised(net, x, t, class_labels=None, condition=None, unconditional_con
 
 #----------------------------------------------------------------------------
 
+@capture_bottleneck
 def amed_sampler(
     net, 
     latents, 
@@ -83,6 +130,8 @@ def amed_sampler(
     AMED_predictor=None, 
     step_idx=None, 
     train=False, 
+    t_steps=None, 
+    feature_capture=None, 
     **kwargs
 ):
     """
@@ -109,21 +158,23 @@ def amed_sampler(
         AMED_predictor: A predictor network.
         step_idx: A `int`. An index to specify the sampling step for training.
         train: A `bool`. In the training loop?
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`. Per-sample 
+            time steps of shape [num_steps, batch_size, 1, 1, 1] are supported during training.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
     assert AMED_predictor is not None
 
     # Time step discretization.
-    t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
     
     # Main sampling loop.
     x_next = latents * t_steps[0]
     inters = [x_next.unsqueeze(0)]
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):                # 0, ..., N-1
         x_cur = x_next
-        unet_enc_out, hook = init_hook(net, class_labels)
-        
         # Euler step.
         use_afs = afs and (((not train) and i == 0) or (train and step_idx == 0))
         if use_afs:
@@ -132,10 +183,9 @@ def amed_sampler(
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
 
-        hook.remove()
         t_cur = t_cur.reshape(-1, 1, 1, 1)
         t_next = t_next.reshape(-1, 1, 1, 1)
-        r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, unet_enc_out, use_afs, batch_size=latents.shape[0])
+        r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
         t_mid = (t_next ** r) * (t_cur ** (1 - r))
         x_next = x_cur + (t_mid - t_cur) * d_cur
 
@@ -160,6 +210,7 @@ def amed_sampler(
 
 #----------------------------------------------------------------------------
 
+@capture_bottleneck
 def euler_sampler(
     net, 
     latents, 
@@ -177,6 +228,8 @@ def euler_sampler(
     AMED_predictor=None, 
     step_idx=None, 
     train=False, 
+    t_steps=None, 
+    feature_capture=None, 
     **kwargs
 ):  
     """
@@ -203,20 +256,22 @@ def euler_sampler(
         AMED_predictor: A predictor network.
         step_idx: A `int`. An index to specify the sampling step for training.
         train: A `bool`. In the training loop?
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`. Per-sample 
+            time steps of shape [num_steps, batch_size, 1, 1, 1] are supported during training.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
 
     # Time step discretization.
-    t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
 
     # Main sampling loop.
     x_next = latents * t_steps[0]
     inters = [x_next.unsqueeze(0)]
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):                # 0, ..., N-1
         x_cur = x_next
-        if AMED_predictor is not None:
-            unet_enc_out, hook = init_hook(net, class_labels)
 
         # Euler step.
         use_afs = afs and (((not train) and i == 0) or (train and step_idx == 0))
@@ -227,10 +282,9 @@ def euler_sampler(
             d_cur = (x_cur - denoised) / t_cur
             
         if AMED_predictor is not None:
-            hook.remove()
             t_cur = t_cur.reshape(-1, 1, 1, 1)
             t_next = t_next.reshape(-1, 1, 1, 1)
-            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, unet_enc_out, use_afs, batch_size=latents.shape[0])
+            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
             t_mid = (t_next**r) * (t_cur**(1-r))
             x_next = x_cur + (t_mid - t_cur) * d_cur
         else:
@@ -259,6 +313,7 @@ def euler_sampler(
 
 #----------------------------------------------------------------------------
 
+@capture_bottleneck
 def ipndm_sampler(
     net, 
     latents, 
@@ -277,6 +332,8 @@ def ipndm_sampler(
     train=False, 
     max_order=4, 
     buffer_model=[], 
+    t_steps=None, 
+    feature_capture=None, 
     **kwargs
 ):
     """
@@ -305,13 +362,16 @@ def ipndm_sampler(
         train: A `bool`. In the training loop?
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
         buffer_model: A `list`. History model outputs.
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
 
     assert max_order >= 1 and max_order <= 4
     # Time step discretization.
-    t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
 
     # Main sampling loop.
     x_next = latents * t_steps[0]
@@ -319,8 +379,6 @@ def ipndm_sampler(
     buffer_model = buffer_model if train else []
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):
         x_cur = x_next
-        if AMED_predictor is not None:
-            unet_enc_out, hook = init_hook(net, class_labels)
         
         use_afs = (afs and len(buffer_model) == 0)
         if use_afs:
@@ -331,10 +389,9 @@ def ipndm_sampler(
         
         order = min(max_order, len(buffer_model)+1)
         if AMED_predictor is not None:
-            hook.remove()
             t_cur = t_cur.reshape(-1, 1, 1, 1)
             t_next = t_next.reshape(-1, 1, 1, 1)
-            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, unet_enc_out, use_afs, batch_size=latents.shape[0])
+            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
             t_mid = (t_next**r) * (t_cur**(1-r))
             if order == 1:      # First Euler step.
                 x_next = x_cur + (t_mid - t_cur) * d_cur
@@ -397,6 +454,7 @@ def ipndm_sampler(
 
 #----------------------------------------------------------------------------
 
+@capture_bottleneck
 def dpm_2_sampler(
     net, 
     latents, 
@@ -415,6 +473,8 @@ def dpm_2_sampler(
     step_idx=None, 
     train=False, 
     r=0.5, 
+    t_steps=None, 
+    feature_capture=None, 
     **kwargs
 ):
     """
@@ -441,21 +501,23 @@ def dpm_2_sampler(
         AMED_predictor: A predictor network.
         step_idx: A `int`. An index to specify the sampling step for training.
         train: A `bool`. In the training loop?
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`. Per-sample 
+            time steps of shape [num_steps, batch_size, 1, 1, 1] are supported during training.
         r: A `float`. The hyperparameter controlling the location of the intermediate time step. r=0.5 recovers the original DPM-Solver-2.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
 
     # Time step discretization.
-    t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
     
     # Main sampling loop.
     x_next = latents * t_steps[0]
     inters = [x_next.unsqueeze(0)]
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):                # 0, ..., N-1
         x_cur = x_next
-        if AMED_predictor is not None:
-            unet_enc_out, hook = init_hook(net, class_labels)
         
         # Euler step.
         use_afs = afs and (((not train) and i == 0) or (train and step_idx == 0))
@@ -467,10 +529,9 @@ def dpm_2_sampler(
 
         scale_time, scale_dir = 1, 1
         if AMED_predictor is not None:
-            hook.remove()
             t_cur = t_cur.reshape(-1, 1, 1, 1)
             t_next = t_next.reshape(-1, 1, 1, 1)
-            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, unet_enc_out, use_afs, batch_size=latents.shape[0])
+            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
         t_mid = (t_next ** r) * (t_cur ** (1 - r))
         x_next = x_cur + (t_mid - t_cur) * d_cur
 
@@ -495,6 +556,7 @@ def dpm_2_sampler(
 
 #----------------------------------------------------------------------------
 
+@capture_bottleneck
 def dpm_pp_sampler(
     net, 
     latents, 
@@ -517,6 +579,8 @@ def dpm_pp_sampler(
     max_order=3, 
     predict_x0=True, 
     lower_order_final=True,
+    t_steps=None, 
+    feature_capture=None, 
     **kwargs
 ):
     """
@@ -548,13 +612,16 @@ def dpm_pp_sampler(
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 3
         predict_x0: A `bool`. Whether to use the data prediction formulation. 
         lower_order_final: A `bool`. Whether to lower the order at the final stages of sampling. 
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
     Returns:
         A pytorch tensor. The sample at time `sigma_min` or the whole sampling trajectory if return_inters=True.
     """
 
     assert max_order >= 1 and max_order <= 3
     # Time step discretization.
-    t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
 
     # Main sampling loop.
     x_next = latents * t_steps[0]
@@ -567,7 +634,6 @@ def dpm_pp_sampler(
         x_cur = x_next
         if AMED_predictor is not None:
             step_cur = (2 * step_idx + 1 if train else 2 * i + 1)
-            unet_enc_out, hook = init_hook(net, class_labels)
         else:
             step_cur = i + 1
         
@@ -581,10 +647,9 @@ def dpm_pp_sampler(
             
         buffer_model.append(dynamic_thresholding_fn(denoised)) if predict_x0 else buffer_model.append(d_cur)
         if AMED_predictor is not None:
-            hook.remove()
             t_cur = t_cur.reshape(-1, 1, 1, 1)
             t_next = t_next.reshape(-1, 1, 1, 1)
-            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, unet_enc_out, use_afs, batch_size=latents.shape[0])
+            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
             t_mid = (t_next**r) * (t_cur**(1-r))
         buffer_t.append(t_cur)
         
@@ -632,6 +697,266 @@ def dpm_pp_sampler(
 
 #----------------------------------------------------------------------------
 
+@capture_bottleneck
+def deis_sampler(
+    net, 
+    latents, 
+    class_labels=None, 
+    condition=None, 
+    unconditional_condition=None,
+    num_steps=None, 
+    sigma_min=0.002, 
+    sigma_max=80, 
+    schedule_type='polynomial',
+    schedule_rho=7, 
+    afs=False,
+    denoise_to_zero=False, 
+    return_inters=False, 
+    AMED_predictor=None, 
+    step_idx=None, 
+    train=False, 
+    buffer_model=[], 
+    buffer_t=[], 
+    max_order=4, 
+    deis_mode='tab', 
+    t_steps=None, 
+    feature_capture=None, 
+    **kwargs
+):
+    """
+    AMED-Plugin for DEIS (https://arxiv.org/abs/2204.13902).
+
+    Args:
+        net: A wrapped diffusion model.
+        latents: A pytorch tensor. Input sample at time `sigma_max`.
+        class_labels: A pytorch tensor. The condition for conditional sampling or guided sampling.
+        condition: A pytorch tensor. The condition to the model used in LDM and Stable Diffusion
+        unconditional_condition: A pytorch tensor. The unconditional condition to the model used in LDM and Stable Diffusion
+        num_steps: A `int`. The total number of the time steps with `num_steps-1` spacings. 
+        sigma_min: A `float`. The ending sigma during samping.
+        sigma_max: A `float`. The starting sigma during sampling.
+        schedule_type: A `str`. The type of time schedule. We support three types:
+            - 'polynomial': polynomial time schedule. (Recommended in EDM.)
+            - 'logsnr': uniform logSNR time schedule. (Recommended in DPM-Solver for small-resolution datasets.)
+            - 'time_uniform': uniform time schedule. (Recommended in DPM-Solver for high-resolution datasets.)
+            - 'discrete': time schedule used in LDM. (Recommended when using pre-trained diffusion models from the LDM and Stable Diffusion codebases.)
+        schedule_rho: A `float`. Time step exponent. Need to be specified when schedule_type in ['polynomial', 'time_uniform'].
+        afs: A `bool`. Whether to use analytical first step (AFS) at the beginning of sampling.
+        denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
+        return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
+        AMED_predictor: A predictor network.
+        step_idx: A `int`. An index to specify the sampling step for training.
+        train: A `bool`. In the training loop?
+        buffer_model: A `list`. History gradients.
+        buffer_t: A `list`. History time steps.
+        max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
+        deis_mode: A `str`. Select between 'tab' and 'rhoab'. Type of DEIS.
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
+    Returns:
+        A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
+    """
+
+    assert max_order >= 1 and max_order <= 4
+    # Time step discretization.
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+
+    # Main sampling loop.
+    x_next = latents * t_steps[0]
+    inters = [x_next.unsqueeze(0)]
+    buffer_model = buffer_model if train else []
+    buffer_t = buffer_t if train else []
+    for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):                # 0, ..., N-1
+        x_cur = x_next
+        
+        use_afs = (afs and len(buffer_model) == 0)
+        if use_afs:
+            d_cur = x_cur / ((1 + t_cur**2).sqrt())
+        else:
+            denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
+            d_cur = (x_cur - denoised) / t_cur
+        buffer_model.append(d_cur)
+        buffer_t.append(t_cur)
+        
+        if AMED_predictor is not None:
+            t_cur = t_cur.reshape(-1, 1, 1, 1)
+            t_next = t_next.reshape(-1, 1, 1, 1)
+            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
+            t_mid = (t_next**r) * (t_cur**(1-r))
+            order = min(max_order, len(buffer_model))
+            x_next = deis_update(x_cur, buffer_model, buffer_t, t_mid, order, deis_mode=deis_mode)
+            
+            # One more step for step instruction:
+            denoised = get_denoised(net, x_next, scale_time * t_mid, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
+            buffer_model.append((x_next - denoised) / t_mid)
+            buffer_t.append(t_mid)
+            order = min(max_order, len(buffer_model))
+            x_next = deis_update(x_next, buffer_model, buffer_t, t_next, order, deis_mode=deis_mode, scale=scale_dir)
+        else:
+            order = min(max_order, len(buffer_model))
+            x_next = deis_update(x_cur, buffer_model, buffer_t, t_next, order, deis_mode=deis_mode)
+        
+        buffer_model = [a.detach() for a in buffer_model[-max_order:]]
+        buffer_t = [a.detach() for a in buffer_t[-max_order:]]
+        
+        if return_inters:
+            inters.append(x_next.unsqueeze(0))
+    
+    if denoise_to_zero:
+        x_next = get_denoised(net, x_next, t_next, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
+        if return_inters:
+            inters.append(x_next.unsqueeze(0))
+
+    if return_inters:
+        return torch.cat(inters, dim=0).to(latents.device)
+    if train:
+        return x_next, buffer_model, buffer_t, r, scale_dir, scale_time
+    return x_next
+
+#----------------------------------------------------------------------------
+
+@capture_bottleneck
+def unipc_sampler(
+    net, 
+    latents, 
+    class_labels=None, 
+    condition=None, 
+    unconditional_condition=None,
+    num_steps=None, 
+    sigma_min=0.002, 
+    sigma_max=80, 
+    schedule_type='polynomial', 
+    schedule_rho=7, 
+    afs=False, 
+    denoise_to_zero=False, 
+    return_inters=False, 
+    AMED_predictor=None, 
+    step_idx=None, 
+    train=False, 
+    buffer_model=[], 
+    buffer_t=[], 
+    max_order=3, 
+    predict_x0=True, 
+    lower_order_final=True,
+    variant='bh2',
+    t_steps=None, 
+    feature_capture=None, 
+    **kwargs
+):
+    """
+    AMED-Plugin for UniPC (https://arxiv.org/abs/2302.04867). The model output at the end of every 
+    step is evaluated for the corrector and reused by the next step.
+
+    Args:
+        net: A wrapped diffusion model.
+        latents: A pytorch tensor. Input sample at time `sigma_max`.
+        class_labels: A pytorch tensor. The condition for conditional sampling or guided sampling.
+        condition: A pytorch tensor. The condition to the model used in LDM and Stable Diffusion
+        unconditional_condition: A pytorch tensor. The unconditional condition to the model used in LDM and Stable Diffusion
+        num_steps: A `int`. The total number of the time steps with `num_steps-1` spacings. 
+        sigma_min: A `float`. The ending sigma during samping.
+        sigma_max: A `float`. The starting sigma during sampling.
+        schedule_type: A `str`. The type of time schedule. We support three types:
+            - 'polynomial': polynomial time schedule. (Recommended in EDM.)
+            - 'logsnr': uniform logSNR time schedule. (Recommended in DPM-Solver for small-resolution datasets.)
+            - 'time_uniform': uniform time schedule. (Recommended in DPM-Solver for high-resolution datasets.)
+            - 'discrete': time schedule used in LDM. (Recommended when using pre-trained diffusion models from the LDM and Stable Diffusion codebases.)
+        schedule_rho: A `float`. Time step exponent. Need to be specified when schedule_type in ['polynomial', 'time_uniform'].
+        afs: A `bool`. Whether to use analytical first step (AFS) at the beginning of sampling.
+        denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
+        return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
+        AMED_predictor: A predictor network.
+        step_idx: A `int`. An index to specify the sampling step for training.
+        train: A `bool`. In the training loop?
+        buffer_model: A `list`. History model outputs.
+        buffer_t: A `list`. History time steps.
+        max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 3
+        predict_x0: A `bool`. Whether to use the data prediction formulation. 
+        lower_order_final: A `bool`. Whether to lower the order at the final stages of sampling. 
+        variant: A `str`. Select between 'bh1' and 'bh2'. Type of the UniPC sampler.
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`.
+        feature_capture: A `FeatureCapture`. The bottleneck features, passed by `capture_bottleneck`.
+    Returns:
+        A pytorch tensor. The sample at time `sigma_min` or the whole sampling trajectory if return_inters=True.
+    """
+
+    assert max_order >= 1 and max_order <= 3
+    # Time step discretization.
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
+
+    # Main sampling loop.
+    x_next = latents * t_steps[0]
+    inters = [x_next.unsqueeze(0)]
+    buffer_model = buffer_model if train else []
+    buffer_t = buffer_t if train else []
+    if AMED_predictor is not None:
+        num_steps = 2 * AMED_predictor.module.num_steps - 1 if train else 2 * num_steps - 1
+    
+    def get_model_out(x, t, scale_time=1):
+        denoised = get_denoised(net, x, scale_time * t, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
+        return dynamic_thresholding_fn(denoised) if predict_x0 else (x - denoised) / t
+    
+    def unipc_step(x, t, step_cur, scale=1, scale_time=1):
+        order = min(max_order, len(buffer_model))
+        if lower_order_final:
+            order = min(order, num_steps - 1 - step_cur)
+        use_corrector = step_cur < num_steps - 2        # no model evaluation after the last step
+        x, model_out = unipc_update(x, buffer_model, buffer_t, t, order, predict_x0=predict_x0, variant=variant, \
+                                    model_fn=lambda x_t: get_model_out(x_t, t, scale_time), use_corrector=use_corrector, scale=scale)
+        if use_corrector:
+            buffer_model.append(model_out)
+            buffer_t.append(t)
+        return x
+    
+    for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):                # 0, ..., N-1
+        x_cur = x_next
+        if AMED_predictor is not None:
+            step_cur = (2 * step_idx if train else 2 * i)
+        else:
+            step_cur = i
+        
+        # The model output at t_cur is given by the corrector of the last step, except for the first step.
+        use_afs = (afs and len(buffer_model) == 0)
+        if len(buffer_model) == 0:
+            if use_afs:
+                d_cur = x_cur / ((1 + t_cur**2).sqrt())
+                denoised = x_cur - t_cur * d_cur
+                buffer_model.append(dynamic_thresholding_fn(denoised) if predict_x0 else d_cur)
+            else:
+                buffer_model.append(get_model_out(x_cur, t_cur))
+            buffer_t.append(t_cur)
+        
+        if AMED_predictor is not None:
+            t_cur = t_cur.reshape(-1, 1, 1, 1)
+            t_next = t_next.reshape(-1, 1, 1, 1)
+            r, scale_dir, scale_time = get_amed_prediction(AMED_predictor, t_cur, t_next, net, feature_capture, use_afs, batch_size=latents.shape[0], class_labels=class_labels)
+            t_mid = (t_next**r) * (t_cur**(1-r))
+            x_next = unipc_step(x_cur, t_mid, step_cur, scale_time=scale_time)
+            x_next = unipc_step(x_next, t_next, step_cur + 1, scale=scale_dir)
+        else:
+            x_next = unipc_step(x_cur, t_next, step_cur)
+        
+        buffer_model[:] = [a.detach() for a in buffer_model[-max_order:]]
+        buffer_t[:] = [a.detach() for a in buffer_t[-max_order:]]
+        
+        if return_inters:
+            inters.append(x_next.unsqueeze(0))
+            
+    if denoise_to_zero:
+        x_next = get_denoised(net, x_next, t_next, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
+        if return_inters:
+            inters.append(x_next.unsqueeze(0))
+            
+    if return_inters:
+        return torch.cat(inters, dim=0).to(latents.device)
+    if train:
+        return x_next, buffer_model, buffer_t, r, scale_dir, scale_time
+    return x_next
+
+#----------------------------------------------------------------------------
+
 def heun_sampler(
     net, 
     latents, 
@@ -646,6 +971,7 @@ def heun_sampler(
     afs=False, 
     denoise_to_zero=False, 
     return_inters=False, 
+    t_steps=None, 
     **kwargs
 ):
     """
@@ -669,12 +995,14 @@ def heun_sampler(
         afs: A `bool`. Whether to use analytical first step (AFS) at the beginning of sampling.
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
+        t_steps: A pytorch tensor. The time schedule to use instead of the one given by `schedule_type`.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
 
     # Time step discretization.
-    t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho)
+    if t_steps is None:
+        t_steps = get_schedule(num_steps, sigma_min, sigma_max, device=latents.device, schedule_type=schedule_type, schedule_rho=schedule_rho)
 
     # Main sampling loop.
     x_next = latents * t_steps[0]
@@ -0,0 +1,170 @@
+"""Evaluate the FID of every snapshot of AMED experiments. The pre-trained
+diffusion model and the Inception-v3 model are loaded only once, and the
+generated images are passed to Inception-v3 in memory."""
+
+import os
+import re
+import csv
+import click
+import tqdm
+import numpy as np
+import torch
+import dnnlib
+from torch_utils import distributed as dist
+from sample import parse_int_list, load_predictor, setup_solver, generate_batch
+from fid import load_detector, calculate_fid_from_inception_stats
+
+#----------------------------------------------------------------------------
+# List the snapshots to evaluate. Every entry of the comma separated `paths`
+# is an experiment number, a directory searched recursively for network
+# snapshots, or the path of an AMED predictor (*.pkl) or AMED table (*.json).
+
+def list_snapshots(paths, exp_dir='./exps'):
+    snapshots = []
+    for path in paths.split(','):
+        if path.endswith('pkl') or path.endswith('json'):
+            snapshots.append(path)
+            continue
+        if not os.path.isdir(path):
+            path_str = '0' * (5 - len(path)) + path
+            exp_dirs = [d for d in sorted(os.listdir(exp_dir)) if d.split('-')[0] == path_str]
+            if len(exp_dirs) == 0:
+                raise click.ClickException(f'Found no experiment "{path}" in "{exp_dir}"')
+            path = os.path.join(exp_dir, exp_dirs[0])
+        for root, _dirs, files in sorted(os.walk(path)):
+            snapshots += [os.path.join(root, f) for f in sorted(files) if re.fullmatch(r'network-snapshot-\d+\.pkl', f)]
+    return snapshots
+
+#----------------------------------------------------------------------------
+# Sample the given seeds with an AMED predictor and return the mean and
+# covariance of the Inception-v3 features, without saving the images.
+
+def calculate_inception_stats_in_memory(
+    net, sampler_fn, rank_batches, solver_kwargs, detector_net, sample_captions=None, device=torch.device('cuda'),
+):
+    feature_dim = 2048
+    num_images = torch.zeros([], dtype=torch.float64, device=device)
+    mu = torch.zeros([feature_dim], dtype=torch.float64, device=device)
+    sigma = torch.zeros([feature_dim, feature_dim], dtype=torch.float64, device=device)
+    for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
+        torch.distributed.barrier()
+        if len(batch_seeds) == 0:
+            continue
+        images = generate_batch(net, sampler_fn, batch_seeds, solver_kwargs, sample_captions, device)
+        images = (images * 127.5 + 128).clip(0, 255).to(torch.uint8)
+        if images.shape[1] == 1:
+            images = images.repeat([1, 3, 1, 1])
+        features = detector_net(images, return_features=True).to(torch.float64)
+        num_images += features.shape[0]
+        mu += features.sum(0)
+        sigma += features.T @ features
+
+    # Calculate grand totals.
+    torch.distributed.all_reduce(num_images)
+    torch.distributed.all_reduce(mu)
+    torch.distributed.all_reduce(sigma)
+    mu /= num_images
+    sigma -= mu.ger(mu) * num_images
+    sigma /= num_images - 1
+    return mu.cpu().numpy(), sigma.cpu().numpy()
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--predictor_path',          help='Experiment numbers, directories or snapshots (e.g. 1,2,path/to/snapshot.pkl)', metavar='LIST', type=str, required=True)
+@click.option('--ref', 'ref_path',         help='Dataset reference statistics ', metavar='NPZ|URL',                 type=str, required=True)
+@click.option('--seeds',                   help='Random seeds (e.g. 1,2,5-10)', metavar='LIST',                     type=parse_int_list, default='0-49999', show_default=True)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--exp_dir',                 help='Where to find the experiments', metavar='DIR',                     type=str, default='./exps', show_default=True)
+@click.option('--out',                     help='Where to save the results table', metavar='CSV',                   type=str, default='./exps/sweep-fid.csv', show_default=True)
+
+def main(predictor_path, ref_path, seeds, max_batch_size, exp_dir, out, device=torch.device('cuda')):
+    """Calculate the FID of every AMED snapshot of the given experiments.
+
+    Examples:
+
+    \b
+    # FID-50k of all snapshots of the experiments 1 and 2
+    torchrun --standalone --nproc_per_node=1 sweep.py --predictor_path=1,2 \\
+        --ref=https://nvlabs-fi-cdn.nvidia.com/edm/fid-refs/cifar10-32x32.npz
+
+    \b
+    # FID-10k of an AMED predictor and its exported table
+    torchrun --standalone --nproc_per_node=1 sweep.py --seeds=0-9999 \\
+        --predictor_path=exps/00001-cifar10-4-5-amed-heun-1-poly7.0-afs/network-snapshot-000010.pkl,exps/cifar10-table.json \\
+        --ref=https://nvlabs-fi-cdn.nvidia.com/edm/fid-refs/cifar10-32x32.npz
+    """
+    torch.multiprocessing.set_start_method('spawn')
+    dist.init()
+    num_batches = ((len(seeds) - 1) // (max_batch_size * dist.get_world_size()) + 1) * dist.get_world_size()
+    all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
+    rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
+
+    snapshots = list_snapshots(predictor_path, exp_dir)
+    if len(snapshots) == 0:
+        raise click.ClickException(f'Found no snapshots for "{predictor_path}"')
+    dist.print0(f'Found {len(snapshots)} snapshots to evaluate.')
+
+    # Rank 0 goes first.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
+    detector_net = load_detector(device)
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
+
+    dist.print0(f'Loading dataset reference statistics from "{ref_path}"...')
+    ref = None
+    if dist.get_rank() == 0:
+        with dnnlib.util.open_url(ref_path) as f:
+            ref = dict(np.load(f))
+
+    # The results are written after every snapshot, so that an interrupted sweep keeps them.
+    fieldnames = ['snapshot', 'dataset_name', 'solver', 'num_steps', 'nfe', 'afs', 'fid']
+    if dist.get_rank() == 0:
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, 'wt', newline='') as f:
+            csv.DictWriter(f, fieldnames=fieldnames).writeheader()
+
+    # Pre-trained diffusion models, keyed by the settings they are loaded from.
+    models = dict()
+    results = []
+    for snapshot in snapshots:
+        if dist.get_rank() != 0:
+            torch.distributed.barrier()
+        AMED_predictor = load_predictor(snapshot, device)
+        model_key = (AMED_predictor.dataset_name, AMED_predictor.guidance_type, AMED_predictor.guidance_rate)
+        net, sampler_fn, solver_kwargs, sample_captions = setup_solver(AMED_predictor, device, model=models.get(model_key))
+        models[model_key] = (net, solver_kwargs['model_source'])
+        if dist.get_rank() == 0:
+            torch.distributed.barrier()
+
+        dist.print0(f'Calculating FID of "{snapshot}" with {len(seeds)} images...')
+        mu, sigma = calculate_inception_stats_in_memory(net, sampler_fn, rank_batches, solver_kwargs, detector_net, sample_captions, device)
+        if dist.get_rank() == 0:
+            fid = calculate_fid_from_inception_stats(mu, sigma, ref['mu'], ref['sigma'])
+            row = dict(snapshot=snapshot, dataset_name=solver_kwargs['dataset_name'], solver=solver_kwargs['solver'], \
+                       num_steps=solver_kwargs['num_steps'], nfe=solver_kwargs['nfe'], afs=solver_kwargs['afs'], fid=fid)
+            results.append(row)
+            print(f'FID: {fid:g}')
+            with open(out, 'at', newline='') as f:
+                csv.DictWriter(f, fieldnames=fieldnames).writerow(row)
+        torch.distributed.barrier()
+
+    # Print the results table.
+    if dist.get_rank() == 0:
+        print(f'Saved the results to "{out}"')
+        width = max(len(row['snapshot']) for row in results)
+        for row in results:
+            print(f'{row["snapshot"]:<{width}s} | NFE: {row["nfe"]:<3d} | FID: {row["fid"]:g}')
+        best = min(results, key=lambda row: row['fid'])
+        print(f'Best snapshot: {best["snapshot"]} (FID: {best["fid"]:g})')
+    torch.distributed.barrier()
+    dist.print0('Done.')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
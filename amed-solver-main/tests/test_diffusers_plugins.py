@@ -0,0 +1,102 @@
+"""Check the diffusers AMED plugins against the samplers in solvers_amed.py on
+a small random UNet with the same static AMED table."""
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+diffusers = pytest.importorskip('diffusers')
+
+from solvers_amed import euler_sampler, unipc_sampler, deis_sampler
+from training.networks import AMED_table
+from diffusers_amed_plugin_euler import EulerDiscreteScheduler
+from diffusers_amed_plugin_unipc import UniPCMultistepScheduler
+from diffusers_amed_plugin_deis import DEISMultistepScheduler
+
+# AMED steps between the discrete timesteps 999 -> 700 -> 400 -> 100. The
+# intermediate time steps and the time-scaled sigmas fall on discrete timesteps,
+# so that both sides evaluate the model at the same points.
+T_STEPS = [999, 700, 400, 100]
+T_MIDS = [850, 500, 200]
+T_MODELS = [820, 530, 230]
+SCALE_DIRS = [1.1, 0.9, 1.05]
+
+#----------------------------------------------------------------------------
+# EDM wrapper of a discrete-time noise prediction model, as the LDM wrapper in
+# models/networks_edm.py but with the nearest discrete timestep.
+
+class DiscreteEDM(torch.nn.Module):
+    def __init__(self, unet, all_sigmas):
+        super().__init__()
+        self.unet = unet
+        self.register_buffer('all_sigmas', all_sigmas)
+
+    def forward(self, x, sigma, class_labels=None):
+        sigma = sigma.reshape(-1).expand(x.shape[0])
+        timestep = (sigma.reshape(-1, 1) - self.all_sigmas.reshape(1, -1)).abs().argmin(dim=1)
+        c_in = (1 / (sigma ** 2 + 1).sqrt()).reshape(-1, 1, 1, 1)
+        return x - sigma.reshape(-1, 1, 1, 1) * self.unet(c_in * x, timestep).sample
+
+def get_unet():
+    torch.manual_seed(0)
+    unet = diffusers.UNet2DModel(
+        sample_size=8, in_channels=3, out_channels=3, layers_per_block=1, block_out_channels=(8, 16),
+        down_block_types=('DownBlock2D', 'DownBlock2D'), up_block_types=('UpBlock2D', 'UpBlock2D'), norm_num_groups=4,
+    )
+    return unet.to(torch.float64).eval()
+
+def get_tables(all_sigmas):
+    # The static table for solvers_amed and the expanded one for the plugins.
+    sigmas = all_sigmas[T_STEPS]
+    r = [np.log(all_sigmas[m] / s_cur) / np.log(s_next / s_cur) for m, s_cur, s_next in zip(T_MIDS, sigmas[:-1], sigmas[1:])]
+    scale_time = [all_sigmas[k] / all_sigmas[m] for k, m in zip(T_MODELS, T_MIDS)]
+    table = AMED_table(dict(settings={}, t_steps=sigmas.tolist(), r=r, scale_dir=SCALE_DIRS, scale_time=scale_time))
+    timesteps, scale_dirs, scale_times = [T_STEPS[0]], [1.], [1.]
+    for i in range(len(T_MIDS)):
+        timesteps += [T_MIDS[i], T_STEPS[i + 1]]
+        scale_dirs += [SCALE_DIRS[i], 1.]
+        scale_times += [scale_time[i], 1.]
+    return table, dict(timesteps=timesteps, scale_dirs=scale_dirs, scale_times=scale_times)
+
+def run_plugin(scheduler, unet, x, plugin_table):
+    scheduler.set_timesteps(timesteps=scheduler.load_amed_table(plugin_table))
+    for t in scheduler.timesteps:
+        model_input = scheduler.scale_model_input(x, t)
+        x = scheduler.step(unet(model_input, t).sample, t, x).prev_sample
+    return x
+
+#----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('name', ['euler', 'unipc', 'deis-1', 'deis-2', 'deis-3', 'deis-rhoab-3'])
+@torch.no_grad()
+def test_plugin_matches_solvers_amed(name):
+    unet = get_unet()
+    if name == 'euler':
+        scheduler = EulerDiscreteScheduler()
+        sampler_fn, sampler_kwargs = euler_sampler, {}
+    elif name == 'unipc':
+        # solvers_amed always thresholds the data prediction, without an upper bound on the scale.
+        scheduler = UniPCMultistepScheduler(solver_order=3, thresholding=True, sample_max_value=float('inf'))
+        sampler_fn, sampler_kwargs = unipc_sampler, dict(max_order=3)
+    else:
+        order, deis_mode = int(name[-1]), 'rhoab' if 'rhoab' in name else 'tab'
+        scheduler = DEISMultistepScheduler(solver_order=order, lower_order_final=False)
+        sampler_fn, sampler_kwargs = deis_sampler, dict(max_order=order, deis_mode=deis_mode)
+    all_sigmas = ((1 - scheduler.alphas_cumprod) / scheduler.alphas_cumprod).sqrt().to(torch.float64)
+    table, plugin_table = get_tables(all_sigmas.numpy())
+    if name.startswith('deis'):
+        plugin_table['settings'] = dict(deis_mode=sampler_kwargs['deis_mode'])
+    net = DiscreteEDM(unet, all_sigmas)
+
+    latents = torch.randn([2, 3, 8, 8], dtype=torch.float64, generator=torch.Generator().manual_seed(1))
+    t_steps = all_sigmas[T_STEPS]
+    ref = sampler_fn(net, latents, num_steps=len(T_STEPS), t_steps=t_steps, AMED_predictor=table, **sampler_kwargs)
+
+    # Euler runs in the EDM space and the multistep solvers in the VP space.
+    alpha = lambda sigma: 1 / (sigma ** 2 + 1).sqrt() if name != 'euler' else torch.ones_like(sigma)
+    sample_plugin = lambda plugin_table: run_plugin(scheduler, unet, latents * t_steps[0] * alpha(t_steps[0]), plugin_table) / alpha(t_steps[-1])
+    torch.testing.assert_close(sample_plugin(plugin_table).to(torch.float64), ref, rtol=1e-4, atol=1e-4)
+
+    # Without the AMED scales, the plugin is far from solvers_amed.
+    plain_table = dict(plugin_table, scale_dirs=[1.] * len(plugin_table['scale_dirs']), scale_times=[1.] * len(plugin_table['scale_times']))
+    assert not torch.allclose(sample_plugin(plain_table).to(torch.float64), ref, rtol=1e-2, atol=1e-2)
@@ -0,0 +1,75 @@
+"""Check that the bottleneck capture of the AMED samplers is attached once per
+network and gives the same samples with the network compiled by torch.compile."""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from solvers_amed import amed_sampler
+
+#----------------------------------------------------------------------------
+# A small EDM-like network with the 8x8 bottleneck of the unconditional models
+# and an AMED predictor that reads it.
+
+class TinyUNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.enc = torch.nn.ModuleDict({
+            'conv_in': torch.nn.Conv2d(3, 8, 3, padding=1),
+            '8x8_block3': torch.nn.Sequential(torch.nn.Conv2d(8, 8, 3, stride=2, padding=1), torch.nn.SiLU()),
+        })
+        self.dec = torch.nn.ConvTranspose2d(8, 3, 2, stride=2)
+
+    def forward(self, x):
+        return self.dec(self.enc['8x8_block3'](self.enc['conv_in'](x)))
+
+class TinyEDM(torch.nn.Module):
+    img_resolution = 16
+    img_channels = 3
+    label_dim = 0
+    sigma_min = 0.002
+    sigma_max = 80
+
+    def __init__(self):
+        super().__init__()
+        self.model = TinyUNet()
+
+    def forward(self, x, sigma, class_labels=None):
+        sigma = sigma.reshape(-1, 1, 1, 1)
+        return x - sigma * self.model(x / (sigma ** 2 + 1).sqrt())
+
+class TinyPredictor(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(64, 3)
+
+    def forward(self, unet_bottleneck, t_cur, t_next, class_labels=None):
+        output = torch.sigmoid(self.fc(unet_bottleneck.reshape(unet_bottleneck.shape[0], -1)))
+        return output[:, 0], 0.5 + output[:, 1], 0.5 + output[:, 2]
+
+#----------------------------------------------------------------------------
+
+@torch.no_grad()
+def test_capture_is_attached_once():
+    torch.manual_seed(0)
+    net, predictor = TinyEDM(), TinyPredictor()
+    latents = torch.randn([2, 3, 16, 16])
+    samples = [amed_sampler(net, latents, num_steps=4, AMED_predictor=predictor) for _ in range(3)]
+    assert len(net.model.enc['8x8_block3']._forward_hooks) == 1
+    torch.testing.assert_close(samples[0], samples[2])
+
+    # A new batch size reallocates the buffer, the features of each sample do not depend on the batch.
+    sample = amed_sampler(net, latents[:1], num_steps=4, AMED_predictor=predictor)
+    torch.testing.assert_close(sample, samples[0][:1], rtol=1e-4, atol=1e-4)
+
+@torch.no_grad()
+def test_capture_with_torch_compile():
+    torch.manual_seed(0)
+    net, predictor = TinyEDM(), TinyPredictor()
+    latents = torch.randn([2, 3, 16, 16])
+    ref = amed_sampler(net, latents, num_steps=4, AMED_predictor=predictor)
+
+    compiled = torch.compile(net)
+    sample = amed_sampler(compiled, latents, num_steps=4, AMED_predictor=predictor)
+    torch.testing.assert_close(sample, ref, rtol=1e-4, atol=1e-4)
+    assert len(net.model.enc['8x8_block3']._forward_hooks) == 1
@@ -10,6 +10,27 @@ from training import training_loop
 import warnings
 warnings.filterwarnings('ignore', 'Grad strides do not match bucket view strides') # False warning printed by PyTorch 1.12.
 
+#----------------------------------------------------------------------------
+# Parse additional training configurations of the form num_steps:sampler_stu[:afs[:M]].
+# Example: '3:amed:True,5:ipndm:False:2' returns
+# [{'num_steps': 3, 'sampler_stu': 'amed', 'afs': True}, {'num_steps': 5, 'sampler_stu': 'ipndm', 'afs': False, 'M': 2}]
+
+def parse_sweep(s):
+    if s is None or isinstance(s, list):
+        return s or []
+    configs = []
+    for p in s.split(','):
+        fields = p.split(':')
+        if not 2 <= len(fields) <= 4:
+            raise click.BadParameter(f'Expected num_steps:sampler_stu[:afs[:M]], got "{p}"')
+        config = dict(num_steps=int(fields[0]), sampler_stu=fields[1])
+        if len(fields) > 2:
+            config['afs'] = fields[2].lower() in ['true', '1', 'yes']
+        if len(fields) > 3:
+            config['M'] = int(fields[3])
+        configs.append(config)
+    return configs
+
 #----------------------------------------------------------------------------
 
 @click.command()
@@ -22,7 +43,7 @@ warnings.filterwarnings('ignore', 'Grad strides do not match bucket view strides
 
 # Options for solvers
 @click.option('--num_steps',        help='Number of time steps for training', metavar='INT',           type=click.IntRange(min=1), default=4, show_default=True)
-@click.option('--sampler_stu',      help='Student solver', metavar='STR',                              type=click.Choice(['amed', 'dpm', 'dpmpp', 'euler', 'ipndm']), default='amed', show_default=True)
+@click.option('--sampler_stu',      help='Student solver', metavar='STR',                              type=click.Choice(['amed', 'dpm', 'dpmpp', 'euler', 'ipndm', 'deis', 'unipc']), default='amed', show_default=True)
 @click.option('--sampler_tea',      help='Teacher solver', metavar='STR',                              type=click.Choice(['heun', 'dpm', 'dpmpp', 'euler', 'ipndm']), default='heun', show_default=True)
 @click.option('--M',                help='Steps to insert between two adjacent steps', metavar='INT',  type=click.IntRange(min=1), default=1, show_default=True)
 @click.option('--guidance_type',    help='Guidance type',                                              type=click.Choice(['cg', 'cfg', 'uncond', None]), default=None, show_default=True)
@@ -30,13 +51,16 @@ warnings.filterwarnings('ignore', 'Grad strides do not match bucket view strides
 @click.option('--schedule_type',    help='Time discretization schedule', metavar='STR',                type=click.Choice(['polynomial', 'logsnr', 'time_uniform', 'discrete']), default='polynomial', show_default=True)
 @click.option('--schedule_rho',     help='Time step exponent', metavar='FLOAT',                        type=click.FloatRange(min=0), default=7, show_default=True)
 @click.option('--afs',              help='Whether to use afs', metavar='BOOL',                         type=bool, default=True, show_default=True)
+@click.option('--sweep',            help='Additional configs sharing the teacher, e.g. 3:amed:True,5:ipndm:False:2', metavar='LIST', type=parse_sweep, default=None)
 @click.option('--scale_dir',        help='Scale the gradient by [1-scale_dir, 1+scale_dir]', metavar='FLOAT',     type=click.FloatRange(min=0), default=0.01, show_default=True)
 @click.option('--scale_time',       help='Scale the gradient by [1-scale_time, 1+scale_time]', metavar='FLOAT',   type=click.FloatRange(min=0), default=0, show_default=True)
-# Additional options for multi-step solvers, 1<=max_order<=4 for iPNDM, 1<=max_order<=3 for DPM-Solver++
+# Additional options for multi-step solvers, 1<=max_order<=4 for iPNDM and DEIS, 1<=max_order<=3 for DPM-Solver++ and UniPC
 @click.option('--max_order',        help='max order for solvers', metavar='INT',                       type=click.IntRange(min=1), default=3)
-# Additional options for DPM-Solver++
+# Additional options for DPM-Solver++ and UniPC
 @click.option('--predict_x0',       help='Whether to use data prediction mode', metavar='BOOL',        type=bool, default=True)
 @click.option('--lower_order_final',help='Lower the order at final stages', metavar='BOOL',            type=bool, default=True)
+# Additional options for DEIS
+@click.option('--deis_mode',        help='Type of DEIS', metavar='STR',                                type=click.Choice(['tab', 'rhoab']), default='tab', show_default=True)
 
 # Hyperparameters.
 @click.option('--batch',            help='Total batch size', metavar='INT',                            type=click.IntRange(min=1), default=512, show_default=True)
@@ -45,6 +69,8 @@ warnings.filterwarnings('ignore', 'Grad strides do not match bucket view strides
 
 # Performance-related.
 @click.option('--bench',            help='Enable cuDNN benchmarking', metavar='BOOL',                  type=bool, default=True, show_default=True)
+@click.option('--parallel_steps',   help='Train all steps of single-step students at once', metavar='BOOL', type=bool, default=False, show_default=True)
+@click.option('--async_teacher',    help='Generate teacher trajectories on a separate CUDA stream', metavar='BOOL', type=bool, default=False, show_default=True)
 
 # I/O-related.
 @click.option('--desc',             help='String to include in result dir name', metavar='STR',        type=str)
@@ -52,6 +78,7 @@ warnings.filterwarnings('ignore', 'Grad strides do not match bucket view strides
 @click.option('--tick',             help='How often to print progress', metavar='KIMG',                type=click.IntRange(min=1), default=10, show_default=True)
 @click.option('--snap',             help='How often to save snapshots', metavar='TICKS',               type=click.IntRange(min=1), default=10, show_default=True)
 @click.option('--dump',             help='How often to dump state', metavar='TICKS',                   type=click.IntRange(min=1), default=50, show_default=True)
+@click.option('--teacher_cache',    help='Directory of teacher trajectories from precompute.py', metavar='DIR', type=str)
 @click.option('--seed',             help='Random seed  [default: random]', metavar='INT',              type=int)
 @click.option('-n', '--dry-run',    help='Print training options and exit',                            is_flag=True)
 
@@ -72,8 +99,10 @@ def main(**kwargs):
                          M=opts.m, guidance_type=opts.guidance_type, guidance_rate=opts.guidance_rate, \
                          schedule_rho=opts.schedule_rho, schedule_type=opts.schedule_type, afs=opts.afs, \
                          dataset_name=opts.dataset_name, scale_dir=opts.scale_dir, scale_time=opts.scale_time, \
-                         max_order=opts.max_order, predict_x0=opts.predict_x0, lower_order_final=opts.lower_order_final)
+                         max_order=opts.max_order, predict_x0=opts.predict_x0, lower_order_final=opts.lower_order_final, \
+                         deis_mode=opts.deis_mode)
     c.loss_kwargs.class_name = 'training.loss.AMED_loss'
+    c.sweep_kwargs = opts.sweep or []
 
     # Training options.
     c.total_kimg = opts.total_kimg      # Train for total_kimg k trajectories
@@ -82,6 +111,10 @@ def main(**kwargs):
     c.state_dump_ticks = c.total_kimg   # 1 dump
     c.update(dataset_name=opts.dataset_name, batch_size=opts.batch, batch_gpu=opts.batch_gpu, gpus=dist.get_world_size(), cudnn_benchmark=opts.bench)
     c.update(guidance_type=opts.guidance_type, guidance_rate=opts.guidance_rate, prompt_path=opts.prompt_path)
+    c.async_teacher = opts.async_teacher
+    c.parallel_steps = opts.parallel_steps
+    if opts.teacher_cache is not None:
+        c.teacher_cache = opts.teacher_cache
     
     # Random seed.
     if opts.seed is not None:
@@ -109,6 +142,8 @@ def main(**kwargs):
         desc = f'{opts.dataset_name:s}-{opts.num_steps}-{nfe}-{opts.sampler_stu}-{opts.sampler_tea}-{opts.m}-{schedule_str}-afs'
     else:
         desc = f'{opts.dataset_name:s}-{opts.num_steps}-{nfe}-{opts.sampler_stu}-{opts.sampler_tea}-{opts.m}-{schedule_str}'
+    if c.sweep_kwargs:
+        desc += f'-sweep{len(c.sweep_kwargs) + 1}'
     if opts.desc is not None:
         desc += f'{opts.desc}'
 
@@ -1,6 +1,7 @@
 import torch
 from torch_utils import persistence
 from torch_utils import distributed as dist
+from torch_utils import training_stats
 import solvers_amed
 from solver_utils import get_schedule
 
@@ -17,6 +18,10 @@ def get_solver_fn(solver_name):
         solver_fn = solvers_amed.dpm_2_sampler
     elif solver_name == 'dpmpp':
         solver_fn = solvers_amed.dpm_pp_sampler
+    elif solver_name == 'deis':
+        solver_fn = solvers_amed.deis_sampler
+    elif solver_name == 'unipc':
+        solver_fn = solvers_amed.unipc_sampler
     elif solver_name == 'heun':
         solver_fn = solvers_amed.heun_sampler
     else:
@@ -30,10 +35,10 @@ class AMED_loss:
     def __init__(
         self, num_steps=None, sampler_stu=None, sampler_tea=None, M=None, 
         schedule_type=None, schedule_rho=None, afs=False, max_order=None, 
-        sigma_min=None, sigma_max=None, predict_x0=True, lower_order_final=True,
+        sigma_min=None, sigma_max=None, predict_x0=True, lower_order_final=True, deis_mode='tab', stats_name='AMED',
     ):
         self.num_steps = num_steps
-        self.solver_stu = get_solver_fn(sampler_stu)
+        self.solver_stu = get_solver_fn(sampler_stu) if sampler_stu is not None else None  # None when only generating teacher trajectories
         self.solver_tea = get_solver_fn(sampler_tea)
         self.M = M
         self.schedule_type = schedule_type
@@ -44,6 +49,8 @@ class AMED_loss:
         self.sigma_max = sigma_max
         self.predict_x0 = predict_x0
         self.lower_order_final = lower_order_final
+        self.deis_mode = deis_mode
+        self.stats_name = stats_name    # prefix of the reported training statistics
         
         self.num_steps_teacher = None
         self.tea_slice = None           # a list to extract the intermediate outputs of teacher sampling trajectory
@@ -80,6 +87,7 @@ class AMED_loss:
             predict_x0=self.predict_x0, 
             lower_order_final=self.lower_order_final, 
             max_order=self.max_order, 
+            deis_mode=self.deis_mode, 
             buffer_model=self.buffer_model, 
             buffer_t=self.buffer_t, 
         )
@@ -87,23 +95,70 @@ class AMED_loss:
         self.buffer_t = buffer_t
         
         loss = (student_out - teacher_out) ** 2
-        dist.print0("Step: {} | Loss: {:8.4f} | r (mean std): {:5.4f} {:5.4f} | scale_dir (mean std): {:5.4f} {:5.4f} | scale_time (mean std): {:5.4f} {:5.4f}".format(
-                step_idx.item(), 
-                torch.mean(torch.norm(loss, p=2, dim=(1, 2, 3))).item(), 
-                r.mean().item(), r.std().item(),
-                scale_dir.mean().item(), scale_dir.std().item(),
-                scale_time.mean().item(), scale_time.std().item()
-            )
-        )
+        self.report_stats(int(step_idx), loss, r, scale_dir, scale_time)
         
         return loss, student_out.detach()
+
+    def parallel_steps(self, AMED_predictor, net, tensor_in, teacher_traj, labels=None, condition=None, unconditional_condition=None):
+        # Train the steps of a single-step student at once. Every step starts from the
+        # teacher output at t_cur, so the steps are independent and are stacked along the
+        # batch dimension with per-sample time steps. With AFS, the first step skips the
+        # first model evaluation and is left to __call__, see get_parallel_start().
+        assert self.solver_stu in [solvers_amed.amed_sampler, solvers_amed.euler_sampler, solvers_amed.dpm_2_sampler]
+        batch_size = tensor_in.shape[0]
+        start = self.get_parallel_start()
+        num_stacked = self.num_steps - 1 - start
+
+        repeat_fn = lambda x: None if x is None else x.repeat(num_stacked, *([1] * (x.dim() - 1)))
+        x_cur = torch.cat([tensor_in.unsqueeze(0), teacher_traj[:-1]])[start:].flatten(0, 1)
+        teacher_out = teacher_traj[start:].flatten(0, 1)
+        t_steps = torch.stack([self.t_steps[start:-1], self.t_steps[start+1:]]).to(tensor_in.device)
+        t_steps = t_steps.repeat_interleave(batch_size, dim=1).reshape(2, -1, 1, 1, 1)
+        student_out, _, _, r, scale_dir, scale_time = self.solver_stu(
+            net, 
+            x_cur / t_steps[0], 
+            class_labels=repeat_fn(labels), 
+            condition=repeat_fn(condition), 
+            unconditional_condition=repeat_fn(unconditional_condition),
+            num_steps=2,
+            t_steps=t_steps, 
+            afs=False, 
+            denoise_to_zero=False, 
+            return_inters=False, 
+            AMED_predictor=AMED_predictor, 
+            train=True,
+            predict_x0=self.predict_x0, 
+            lower_order_final=self.lower_order_final, 
+            max_order=self.max_order, 
+        )
+        
+        loss = (student_out - teacher_out) ** 2
+        for i in range(num_stacked):
+            idx = slice(i * batch_size, (i + 1) * batch_size)
+            self.report_stats(start + i, loss[idx], r[idx], scale_dir[idx], scale_time[idx])
+        
+        return loss
+
+    def get_parallel_start(self):
+        return 1 if self.afs else 0
+
+    def report_stats(self, step_idx, loss, r, scale_dir, scale_time):
+        # Accumulate the statistics on the device, they are printed once per tick by the training loop.
+        name = f'{self.stats_name}/step{step_idx}'
+        training_stats.report(name + '/loss', torch.norm(loss, p=2, dim=(1, 2, 3)))
+        training_stats.report(name + '/r', r)
+        training_stats.report(name + '/scale_dir', scale_dir)
+        training_stats.report(name + '/scale_time', scale_time)
     
-    def get_teacher_traj(self, net, tensor_in, labels=None, condition=None, unconditional_condition=None):
+    def init_schedule(self, net, device):
         if self.t_steps is None:
-            self.t_steps = get_schedule(self.num_steps, self.sigma_min, self.sigma_max, schedule_type=self.schedule_type, schedule_rho=self.schedule_rho, device=tensor_in.device, net=net)
+            self.t_steps = get_schedule(self.num_steps, self.sigma_min, self.sigma_max, schedule_type=self.schedule_type, schedule_rho=self.schedule_rho, device=device, net=net)
         if self.tea_slice is None:
             self.num_steps_teacher = (self.M + 1) * (self.num_steps - 1) + 1
             self.tea_slice = [i * (self.M + 1) for i in range(1, self.num_steps)]
+
+    def get_teacher_traj(self, net, tensor_in, labels=None, condition=None, unconditional_condition=None):
+        self.init_schedule(net, tensor_in.device)
         
         # Teacher steps.
         teacher_traj = self.solver_tea(
@@ -128,4 +183,70 @@ class AMED_loss:
         )
         
         return teacher_traj[self.tea_slice]
-        
\ No newline at end of file
+        
+
+#----------------------------------------------------------------------------
+# Run the teacher once for several AMED configurations sharing the teacher
+# solver. The teacher time steps are the union of the teacher time steps of
+# all configurations, and every configuration takes the states at its own
+# time steps from the shared trajectory.
+
+class SharedTeacher:
+    def __init__(self, loss_fns, net, device):
+        teacher = loss_fns[0]
+        for loss_fn in loss_fns[1:]:
+            for key in ['solver_tea', 'schedule_type', 'schedule_rho', 'max_order', 'predict_x0', 'lower_order_final', 'sigma_min', 'sigma_max']:
+                if getattr(loss_fn, key) != getattr(teacher, key):
+                    raise ValueError(f'All configurations must share the teacher settings, got different {key}')
+        self.solver_tea = teacher.solver_tea
+        self.sigma_min = teacher.sigma_min
+        self.sigma_max = teacher.sigma_max
+        self.schedule_type = teacher.schedule_type
+        self.schedule_rho = teacher.schedule_rho
+        self.max_order = teacher.max_order
+        self.predict_x0 = teacher.predict_x0
+        self.lower_order_final = teacher.lower_order_final
+
+        # Merge the teacher time steps, dropping duplicates up to rounding errors.
+        t_steps_list = []
+        for loss_fn in loss_fns:
+            loss_fn.init_schedule(net, device)
+            t_steps_list.append(get_schedule(loss_fn.num_steps_teacher, self.sigma_min, self.sigma_max, schedule_type=self.schedule_type, schedule_rho=self.schedule_rho, device=device, net=net))
+        t_steps = torch.cat(t_steps_list).sort(descending=True).values
+        keep = torch.ones_like(t_steps, dtype=torch.bool)
+        keep[1:] = (t_steps[:-1] - t_steps[1:]) > 1e-5 * t_steps[:-1]
+        self.t_steps = t_steps[keep]
+
+        # Snap the student time steps to the merged teacher time steps.
+        self.tea_slices = []
+        for loss_fn in loss_fns:
+            idx = (loss_fn.t_steps.reshape(-1, 1) - self.t_steps.reshape(1, -1)).abs().argmin(dim=1)
+            loss_fn.t_steps = self.t_steps[idx]
+            self.tea_slices.append(idx[1:].tolist())
+
+    def get_teacher_traj(self, net, tensor_in, labels=None, condition=None, unconditional_condition=None):
+        # Returns the whole trajectory, use split() to get the teacher outputs of every configuration.
+        return self.solver_tea(
+            net, 
+            tensor_in / self.t_steps[0], 
+            class_labels=labels, 
+            condition=condition, 
+            unconditional_condition=unconditional_condition, 
+            num_steps=len(self.t_steps), 
+            sigma_min=self.sigma_min, 
+            sigma_max=self.sigma_max, 
+            schedule_type=self.schedule_type, 
+            schedule_rho=self.schedule_rho, 
+            t_steps=self.t_steps, 
+            afs=False, 
+            denoise_to_zero=False, 
+            return_inters=True, 
+            AMED_predictor=None, 
+            train=False,
+            predict_x0=self.predict_x0, 
+            lower_order_final=self.lower_order_final, 
+            max_order=self.max_order, 
+        )
+
+    def split(self, teacher_traj):
+        return [teacher_traj[tea_slice] for tea_slice in self.tea_slices]
@@ -1,3 +1,4 @@
+import json
 import numpy as np
 import torch
 from torch_utils import persistence
@@ -79,9 +80,10 @@ class AMED_predictor(torch.nn.Module):
         max_order               = None,
         predict_x0              = True,
         lower_order_final       = True,
+        deis_mode               = 'tab',
     ):
         super().__init__()
-        assert sampler_stu in ['amed', 'dpm', 'dpmpp', 'euler', 'ipndm']
+        assert sampler_stu in ['amed', 'dpm', 'dpmpp', 'euler', 'ipndm', 'deis', 'unipc']
         assert sampler_tea in ['heun', 'dpm', 'dpmpp', 'euler', 'ipndm']
         assert scale_dir >= 0
         assert scale_time >= 0
@@ -101,6 +103,7 @@ class AMED_predictor(torch.nn.Module):
         self.max_order = max_order
         self.predict_x0 = predict_x0
         self.lower_order_final = lower_order_final
+        self.deis_mode = deis_mode
         
         init = dict(init_mode='xavier_uniform')
         
@@ -120,12 +123,13 @@ class AMED_predictor(torch.nn.Module):
 
     def forward(self, unet_bottleneck, t_cur, t_next, class_labels=None):
         # Encode the current and next time steps, then concatenate them
-        emb = self.map_noise(t_cur.reshape(1,))
+        # The time steps are either shared by the whole batch or given per sample
+        emb = self.map_noise(t_cur.reshape(-1,))
         emb = emb.reshape(emb.shape[0], 2, -1).flip(1).reshape(*emb.shape) # swap sin/cos
-        emb = silu(self.map_layer0(emb)).repeat(unet_bottleneck.shape[0], 1)
-        emb1 = self.map_noise(t_next.reshape(1,))
+        emb = silu(self.map_layer0(emb)).expand(unet_bottleneck.shape[0], -1)
+        emb1 = self.map_noise(t_next.reshape(-1,))
         emb1 = emb1.reshape(emb1.shape[0], 2, -1).flip(1).reshape(*emb1.shape) # swap sin/cos
-        emb1 = silu(self.map_layer0(emb1)).repeat(unet_bottleneck.shape[0], 1)
+        emb1 = silu(self.map_layer0(emb1)).expand(unet_bottleneck.shape[0], -1)
         emb = torch.cat((emb, emb1), dim=1)
         
         # Encode the U-Net bottlenect and concatenate it with the time-embedding
@@ -153,3 +157,48 @@ class AMED_predictor(torch.nn.Module):
                 return r, scale_dir, scale_time
 
         return r
+
+#----------------------------------------------------------------------------
+# Static AMED schedule exported by amed_table.py. Replaces the AMED predictor
+# at sampling time: the per-step predictions are looked up from a table
+# instead of being computed from the U-Net bottleneck, so the solvers skip the
+# feature hook and the predictor network altogether.
+
+SETTING_KEYS = ['dataset_name', 'img_resolution', 'num_steps', 'sampler_tea', 'sampler_stu', 'M', 'guidance_type', 'guidance_rate', \
+                'schedule_type', 'schedule_rho', 'afs', 'scale_dir', 'scale_time', 'max_order', 'predict_x0', 'lower_order_final', 'deis_mode']
+
+@persistence.persistent_class
+class AMED_table(torch.nn.Module):
+    use_bottleneck = False
+
+    def __init__(self, table):
+        super().__init__()
+        for key in SETTING_KEYS:
+            setattr(self, key, table['settings'].get(key))
+        self.register_buffer('t_steps', torch.tensor(table['t_steps'], dtype=torch.float32))
+        values = [table['r'], table['scale_dir'], table['scale_time']]
+        self.register_buffer('values', torch.tensor(values, dtype=torch.float32).T)    # [num_steps-1, 3]
+        class_values = None
+        if table.get('class_r') is not None:
+            class_values = [table['class_r'], table['class_scale_dir'], table['class_scale_time']]
+            class_values = torch.tensor(class_values, dtype=torch.float32).permute(1, 2, 0)   # [label_dim, num_steps-1, 3]
+        self.register_buffer('class_values', class_values)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def forward(self, unet_bottleneck, t_cur, t_next, class_labels=None):
+        # Find the step by the current time, either shared by the whole batch or given per sample
+        batch_size = unet_bottleneck.shape[0]
+        step = (t_cur.reshape(-1, 1) - self.t_steps[:-1].reshape(1, -1)).abs().argmin(dim=1).expand(batch_size)
+        if class_labels is not None and self.class_values is not None:
+            label_idx = class_labels.argmax(dim=1) if class_labels.dim() == 2 else class_labels.long()
+            out = self.class_values[label_idx, step]
+        else:
+            out = self.values[step]
+        r, scale_dir, scale_time = out.unbind(dim=1)
+        return r.reshape(-1, 1), scale_dir.reshape(-1, 1), scale_time.reshape(-1, 1)
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,89 @@
+"""Teacher trajectories precomputed by precompute.py and stored in sharded
+memory-mapped files, so that AMED training can stream them instead of
+running the teacher solver for every batch."""
+
+import os
+import json
+import numpy as np
+import torch
+
+#----------------------------------------------------------------------------
+# Settings that determine the teacher trajectories. A cache can only be used
+# for training when all of them match the AMED predictor settings.
+
+TEACHER_KEYS = ['dataset_name', 'sampler_tea', 'num_steps', 'M', 'schedule_type', 'schedule_rho', \
+                'guidance_type', 'guidance_rate', 'max_order', 'predict_x0', 'lower_order_final']
+
+#----------------------------------------------------------------------------
+# Latents and condition indices are derived from the seed, so only the seeds
+# are stored. The index is a class label or a caption index, -1 means none.
+
+def get_latents_and_label(seed, shape, num_labels=0):
+    gen = torch.Generator().manual_seed(int(seed) % (1 << 32))
+    latents = torch.randn(shape, generator=gen)
+    label_idx = int(torch.randint(num_labels, size=[], generator=gen)) if num_labels else -1
+    return latents, label_idx
+
+#----------------------------------------------------------------------------
+# Convert the condition indices into the inputs of the pre-trained model.
+
+def get_conditions(net, label_idx, guidance_type=None, guidance_rate=None, dataset_name=None, sample_captions=None):
+    batch_size = label_idx.shape[0]
+    device = label_idx.device
+    labels = c = uc = None
+    if net.label_dim:
+        if guidance_type == 'cg':                                           # ADM models
+            labels = label_idx
+        elif guidance_type == 'cfg' and dataset_name in ['ms_coco']:        # Stable Diffusion (SD) models
+            prompts = [sample_captions[i] for i in label_idx.tolist()]
+            if guidance_rate != 1.0:
+                uc = net.model.get_learned_conditioning(batch_size * [""])
+            c = net.model.get_learned_conditioning(prompts)
+        else:                                                               # EDM models
+            labels = torch.eye(net.label_dim, device=device)[label_idx]
+    return labels, c, uc
+
+#----------------------------------------------------------------------------
+# File names of a shard.
+
+def get_shard_paths(cache_dir, shard_idx):
+    prefix = os.path.join(cache_dir, f'shard-{shard_idx:05d}')
+    return prefix + '-traj.npy', prefix + '-seeds.npy', prefix + '-labels.npy'
+
+#----------------------------------------------------------------------------
+# Dataset of cached teacher trajectories. Every item is (latents, teacher_traj,
+# label_idx) with teacher_traj of shape [num_steps-1, C, H, W].
+
+class TeacherTrajDataset(torch.utils.data.Dataset):
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self._shard_sizes = np.array([shard['num'] for shard in self.meta['shards']], dtype=np.int64)
+        self._shard_starts = np.concatenate([[0], np.cumsum(self._shard_sizes)])
+        self._shards = dict() # {shard_idx: (traj, seeds, labels), ...}, opened lazily in every worker
+
+    def __len__(self):
+        return int(self._shard_starts[-1])
+
+    def check_config(self, **kwargs):
+        for key in TEACHER_KEYS:
+            if key in kwargs and kwargs[key] != self.meta[key]:
+                raise ValueError(f'Teacher cache "{self._cache_dir}" was generated with {key}={self.meta[key]}, got {kwargs[key]}')
+
+    def _open_shard(self, shard_idx):
+        if shard_idx not in self._shards:
+            shard = self.meta['shards'][shard_idx]
+            paths = get_shard_paths(self._cache_dir, shard['idx'])
+            self._shards[shard_idx] = tuple(np.load(path, mmap_mode='r') for path in paths)
+        return self._shards[shard_idx]
+
+    def __getitem__(self, idx):
+        shard_idx = int(np.searchsorted(self._shard_starts, idx, side='right') - 1)
+        traj, seeds, labels = self._open_shard(shard_idx)
+        local_idx = idx - self._shard_starts[shard_idx]
+        latents, _ = get_latents_and_label(seeds[local_idx], self.meta['latent_shape'])
+        teacher_traj = torch.from_numpy(np.array(traj[local_idx])).to(torch.float32)
+        return latents, teacher_traj, int(labels[local_idx])
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,94 @@
+"""Generate teacher trajectories for AMED training, optionally on a separate
+CUDA stream so that the teacher of the next batch runs while the AMED
+predictor is trained on the current one."""
+
+import queue
+import random
+import threading
+import torch
+from torch import autocast
+
+#----------------------------------------------------------------------------
+# Sample latents and conditions for one batch and run the teacher solver.
+# Pass `generator` and `rng` for a random stream independent of the global one.
+
+def generate_teacher_batch(net, loss_fn, batch_gpu, guidance_type=None, guidance_rate=None, dataset_name=None, sample_captions=None, device=None, generator=None, rng=random):
+    latents = loss_fn.sigma_max * torch.randn([batch_gpu, net.img_channels, net.img_resolution, net.img_resolution], device=device, generator=generator)
+    labels = c = uc = None
+    with torch.no_grad():
+        if net.label_dim:
+            if guidance_type == 'cg':                                           # ADM models
+                labels = torch.randint(net.label_dim, size=(batch_gpu,), device=device, generator=generator)
+            elif guidance_type == 'cfg' and dataset_name in ['ms_coco']:        # Stable Diffusion (SD) models
+                prompts = rng.sample(sample_captions, batch_gpu)
+                if guidance_rate != 1.0:
+                    uc = net.model.get_learned_conditioning(batch_gpu * [""])
+                c = net.model.get_learned_conditioning(prompts)
+            else:                                                               # EDM models
+                labels = torch.eye(net.label_dim, device=device)[torch.randint(net.label_dim, size=[batch_gpu], device=device, generator=generator)]
+
+        if guidance_type in ['uncond', 'cfg']:      # LDM and SD models
+            with autocast("cuda"):
+                with net.model.ema_scope():
+                    teacher_traj = loss_fn.get_teacher_traj(net=net, tensor_in=latents, labels=labels, condition=c, unconditional_condition=uc)
+        else:
+            teacher_traj = loss_fn.get_teacher_traj(net=net, tensor_in=latents, labels=labels)
+    return latents, labels, c, uc, teacher_traj
+
+#----------------------------------------------------------------------------
+# Producer thread that generates teacher batches on its own CUDA stream. At
+# most `max_queue` finished batches wait in the queue, which bounds the memory
+# and blocks the producer when the training loop falls behind. The random
+# stream only depends on `seed`, so the sequence of batches is deterministic.
+
+class TeacherProducer:
+    def __init__(self, seed=0, max_queue=1, device=None, **batch_kwargs):
+        self._batch_kwargs = dict(batch_kwargs, device=device)
+        self._device_index = torch.cuda.current_device() if device is None or device.index is None else device.index
+        self._stream = torch.cuda.Stream(device=self._device_index)
+        self._generator = torch.Generator(device=torch.device('cuda', self._device_index)).manual_seed(seed)
+        self._rng = random.Random(seed)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            torch.cuda.set_device(self._device_index) # the current device is per thread
+            with torch.cuda.stream(self._stream):
+                while not self._stop.is_set():
+                    batch = generate_teacher_batch(generator=self._generator, rng=self._rng, **self._batch_kwargs)
+                    event = torch.cuda.Event()
+                    event.record(self._stream)
+                    self._put((batch, event))
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self):
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        batch, event = item
+        stream = torch.cuda.current_stream()
+        stream.wait_event(event)
+        for x in batch:
+            if isinstance(x, torch.Tensor):
+                x.record_stream(stream) # the memory was allocated on the producer stream
+        return batch
+
+    def close(self):
+        self._stop.set()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._thread.join()
+
+#----------------------------------------------------------------------------
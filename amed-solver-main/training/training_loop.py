@@ -9,13 +9,14 @@ import pickle
 import numpy as np
 import torch
 import dnnlib
-import random
-from torch import autocast
 from torch_utils import distributed as dist
 from torch_utils import training_stats
 from torch_utils import misc
 from models.ldm.util import instantiate_from_config
 from torch_utils.download_util import check_file_by_key
+from training.teacher_cache import TeacherTrajDataset, get_conditions
+from training.teacher_pipeline import generate_teacher_batch, TeacherProducer
+from training.loss import SharedTeacher
 
 #----------------------------------------------------------------------------
 # Load pre-trained models from the LDM codebase (https://github.com/CompVis/latent-diffusion) 
@@ -96,6 +97,10 @@ def training_loop(
     prompt_path         = None,
     guidance_type       = None,
     guidance_rate       = 0.,
+    teacher_cache       = None,     # Directory of precomputed teacher trajectories, None = generate on the fly.
+    async_teacher       = False,    # Generate the next teacher trajectories on a separate CUDA stream?
+    parallel_steps      = False,    # Train all steps of single-step students at once?
+    sweep_kwargs        = [],       # Options overriding AMED_kwargs for additional predictors trained with the same teacher.
     device              = torch.device('cuda'),
     **kwargs,
 ):
@@ -115,6 +120,7 @@ def training_loop(
     num_accumulation_rounds = batch_gpu_total // batch_gpu
     assert batch_size == batch_gpu * num_accumulation_rounds * dist.get_world_size()
    
+    sample_captions = None
     if dataset_name in ['ms_coco']:
         # Loading MS-COCO captions for FID-30k evaluaion
         # We use the selected 30k captions from https://github.com/boomb0om/text2image-benchmark
@@ -136,21 +142,80 @@ def training_loop(
     if dist.get_rank() == 0:
         torch.distributed.barrier()     # other ranks follow
     
-    # Construct AMED predictor.
-    dist.print0('Constructing AMED predictor...')
-    AMED_kwargs.update(img_resolution=net.img_resolution)
-    AMED_predictor = dnnlib.util.construct_class_by_name(**AMED_kwargs) # subclass of torch.nn.Module
-    AMED_predictor.train().requires_grad_(True).to(device)
+    # Training configurations. The first one is given by AMED_kwargs, the others override
+    # some of its options and share the same teacher trajectories.
+    config_list = [dnnlib.EasyDict(AMED_kwargs)] + [dnnlib.EasyDict(AMED_kwargs, **overrides) for overrides in sweep_kwargs]
+    num_configs = len(config_list)
+    for config in config_list:
+        if parallel_steps and config.sampler_stu not in ['euler', 'dpm', 'amed']:
+            raise ValueError("parallel_steps only supports single-step students, got {}".format(config.sampler_stu))
+    if num_configs > 1 and teacher_cache is not None:
+        raise ValueError("teacher_cache does not support training several configurations")
 
-    # Setup optimizer.
-    dist.print0('Setting up optimizer...')
-    loss_kwargs.update(num_steps=AMED_kwargs.num_steps, sampler_stu=AMED_kwargs.sampler_stu, sampler_tea=AMED_kwargs.sampler_tea, \
-                       M=AMED_kwargs.M, schedule_type=AMED_kwargs.schedule_type, schedule_rho=AMED_kwargs.schedule_rho, \
-                       afs=AMED_kwargs.afs, max_order=AMED_kwargs.max_order, sigma_min=net.sigma_min, sigma_max=net.sigma_max, \
-                       predict_x0=AMED_kwargs.predict_x0, lower_order_final=AMED_kwargs.lower_order_final)
-    loss_fn = dnnlib.util.construct_class_by_name(**loss_kwargs)
-    optimizer = dnnlib.util.construct_class_by_name(params=AMED_predictor.parameters(), **optimizer_kwargs) # subclass of torch.optim.Optimizer
-    ddp = torch.nn.parallel.DistributedDataParallel(AMED_predictor, device_ids=[device], broadcast_buffers=False)
+    # Construct AMED predictors.
+    dist.print0(f'Constructing {num_configs} AMED predictor(s)...')
+    predictor_list, loss_fn_list, optimizer_list, ddp_list, config_dirs = [], [], [], [], []
+    for config_idx, config in enumerate(config_list):
+        config.update(img_resolution=net.img_resolution)
+        AMED_predictor = dnnlib.util.construct_class_by_name(**config) # subclass of torch.nn.Module
+        AMED_predictor.train().requires_grad_(True).to(device)
+
+        # Setup optimizer.
+        config_loss_kwargs = dnnlib.EasyDict(loss_kwargs)
+        config_loss_kwargs.update(num_steps=config.num_steps, sampler_stu=config.sampler_stu, sampler_tea=config.sampler_tea, \
+                                  M=config.M, schedule_type=config.schedule_type, schedule_rho=config.schedule_rho, \
+                                  afs=config.afs, max_order=config.max_order, sigma_min=net.sigma_min, sigma_max=net.sigma_max, \
+                                  predict_x0=config.predict_x0, lower_order_final=config.lower_order_final, \
+                                  deis_mode=config.get('deis_mode', 'tab'), \
+                                  stats_name=f'AMED{config_idx}' if num_configs > 1 else 'AMED')
+        loss_fn = dnnlib.util.construct_class_by_name(**config_loss_kwargs)
+        optimizer = dnnlib.util.construct_class_by_name(params=AMED_predictor.parameters(), **optimizer_kwargs) # subclass of torch.optim.Optimizer
+        ddp = torch.nn.parallel.DistributedDataParallel(AMED_predictor, device_ids=[device], broadcast_buffers=False)
+
+        # Every configuration writes its snapshots to a subdirectory when training several ones.
+        config_dir = run_dir
+        if num_configs > 1 and run_dir is not None:
+            config_dir = os.path.join(run_dir, f'{config_idx:02d}-{config.num_steps}-{config.sampler_stu}-{config.M}' + ('-afs' if config.afs else ''))
+            os.makedirs(config_dir, exist_ok=True)
+        predictor_list.append(AMED_predictor)
+        loss_fn_list.append(loss_fn)
+        optimizer_list.append(optimizer)
+        ddp_list.append(ddp)
+        config_dirs.append(config_dir)
+
+    # The teacher trajectories are generated by the loss of the single configuration, or
+    # once for all configurations on the merged teacher time steps.
+    if num_configs > 1:
+        dist.print0('Merging the teacher time steps...')
+        teacher = SharedTeacher(loss_fn_list, net, device)
+        dist.print0(f'Teacher time steps: {len(teacher.t_steps)}')
+    else:
+        teacher = loss_fn_list[0]
+    loss_fn = loss_fn_list[0]
+
+    # Load precomputed teacher trajectories.
+    teacher_iterator = None
+    if teacher_cache is not None:
+        dist.print0(f'Loading teacher trajectories from "{teacher_cache}"...')
+        teacher_set = TeacherTrajDataset(teacher_cache)
+        teacher_set.check_config(**AMED_kwargs)
+        teacher_sampler = misc.InfiniteSampler(dataset=teacher_set, rank=dist.get_rank(), num_replicas=dist.get_world_size(), seed=seed)
+        teacher_iterator = iter(torch.utils.data.DataLoader(dataset=teacher_set, sampler=teacher_sampler, batch_size=batch_gpu, pin_memory=True, num_workers=2, prefetch_factor=2))
+        loss_fn.init_schedule(net, device)
+
+    # Generate teacher trajectories on a separate CUDA stream.
+    teacher_kwargs = dict(net=net, loss_fn=teacher, batch_gpu=batch_gpu, guidance_type=guidance_type, guidance_rate=guidance_rate, \
+                          dataset_name=dataset_name, sample_captions=sample_captions, device=device)
+    teacher_producer = None
+    if async_teacher and teacher_iterator is None:
+        if guidance_type in ['uncond', 'cfg']:
+            # ema_scope() swaps the model weights in place and cannot be shared between threads
+            dist.print0('Asynchronous teacher generation is not supported for LDM models, generating teacher trajectories in sequence...')
+        else:
+            dist.print0('Generating teacher trajectories on a separate CUDA stream...')
+            for config_loss_fn in loss_fn_list:
+                config_loss_fn.init_schedule(net, device)
+            teacher_producer = TeacherProducer(seed=(seed * dist.get_world_size() + dist.get_rank()) % (1 << 31), **teacher_kwargs)
     
     # Train.
     dist.print0(f'Training for {total_kimg} kimg...')
@@ -164,57 +229,62 @@ def training_loop(
     stats_jsonl = None
     while True:
 
-        # Generate latents and conditions in every first step
-        latents = loss_fn.sigma_max * torch.randn([batch_gpu, net.img_channels, net.img_resolution, net.img_resolution], device=device)
-        labels = c = uc = None
-        if net.label_dim:
-            if guidance_type == 'cg':                                           # ADM models
-                labels = torch.randint(net.label_dim, size=(batch_gpu,), device=device)
-            elif guidance_type == 'cfg' and dataset_name in ['ms_coco']:        # Stable Diffusion (SD) models
-                prompts = random.sample(sample_captions, batch_gpu)
-                uc = None
-                if guidance_rate != 1.0:
-                    uc = net.model.get_learned_conditioning(batch_gpu * [""])
-                if isinstance(prompts, tuple):
-                    prompts = list(prompts)
-                c = net.model.get_learned_conditioning(prompts)
-            else:                                                               # EDM models
-                labels = torch.eye(net.label_dim, device=device)[torch.randint(net.label_dim, size=[batch_gpu], device=device)]
+        if teacher_iterator is not None:
+            # Load latents, conditions and teacher trajectories from the cache
+            latents, teacher_traj, label_idx = next(teacher_iterator)
+            latents = loss_fn.sigma_max * latents.to(device, non_blocking=True)
+            teacher_traj = teacher_traj.to(device, non_blocking=True).transpose(0, 1)
+            with torch.no_grad():
+                labels, c, uc = get_conditions(net, label_idx.to(device), guidance_type, guidance_rate, dataset_name, sample_captions)
+        elif teacher_producer is not None:
+            # Take the teacher trajectories generated while training on the previous batch
+            latents, labels, c, uc, teacher_traj = teacher_producer.get()
+        else:
+            # Generate latents, conditions and teacher trajectories in every first step
+            latents, labels, c, uc, teacher_traj = generate_teacher_batch(**teacher_kwargs)
 
-        # Generate teacher trajectories in every first step
-        with torch.no_grad():
-            if guidance_type in ['uncond', 'cfg']:      # LDM and SD models
-                with autocast("cuda"):
-                    with net.model.ema_scope():
-                        teacher_traj = loss_fn.get_teacher_traj(net=net, tensor_in=latents, labels=labels, condition=c, unconditional_condition=uc)
-            else:
-                teacher_traj = loss_fn.get_teacher_traj(net=net, tensor_in=latents, labels=labels)
+        teacher_traj_list = teacher.split(teacher_traj) if num_configs > 1 else [teacher_traj]
+        for AMED_predictor, loss_fn, optimizer, ddp, teacher_traj in zip(predictor_list, loss_fn_list, optimizer_list, ddp_list, teacher_traj_list):
+            tensor_in = latents
 
-        # Perform training step by step
-        for step_idx in range(loss_fn.num_steps - 1):
-            optimizer.zero_grad(set_to_none=True)
-            # Calculate loss
-            for round_idx in range(num_accumulation_rounds):
-                with misc.ddp_sync(ddp, (round_idx == num_accumulation_rounds - 1)):
-                    if guidance_type in ['uncond', 'cfg']:      # LDM and SD models
-                        with net.model.ema_scope():
-                            loss, stu_out = loss_fn(AMED_predictor=ddp, net=net, tensor_in=latents, labels=labels, step_idx=step_idx, teacher_out=teacher_traj[step_idx], condition=c, unconditional_condition=uc)
-                    else:
-                        loss, stu_out = loss_fn(AMED_predictor=ddp, net=net, tensor_in=latents, labels=labels, step_idx=step_idx, teacher_out=teacher_traj[step_idx])
-                    training_stats.report('Loss/loss', loss)
-                    loss.sum().mul(1 / batch_gpu_total).backward()
+            # Perform training step by step, or all steps at once (step_idx=None) in the parallel mode
+            if parallel_steps:
+                parallel_start = loss_fn.get_parallel_start()
+                step_list = list(range(parallel_start)) + ([None] if parallel_start < loss_fn.num_steps - 1 else [])
+            else:
+                step_list = range(loss_fn.num_steps - 1)
+            for step_idx in step_list:
+                optimizer.zero_grad(set_to_none=True)
+                # Calculate loss
+                for round_idx in range(num_accumulation_rounds):
+                    with misc.ddp_sync(ddp, (round_idx == num_accumulation_rounds - 1)):
+                        if step_idx is None:
+                            if guidance_type in ['uncond', 'cfg']:  # LDM and SD models
+                                with net.model.ema_scope():
+                                    loss = loss_fn.parallel_steps(AMED_predictor=ddp, net=net, tensor_in=tensor_in, teacher_traj=teacher_traj, labels=labels, condition=c, unconditional_condition=uc)
+                            else:
+                                loss = loss_fn.parallel_steps(AMED_predictor=ddp, net=net, tensor_in=tensor_in, teacher_traj=teacher_traj, labels=labels)
+                        elif guidance_type in ['uncond', 'cfg']:    # LDM and SD models
+                            with net.model.ema_scope():
+                                loss, stu_out = loss_fn(AMED_predictor=ddp, net=net, tensor_in=tensor_in, labels=labels, step_idx=step_idx, teacher_out=teacher_traj[step_idx], condition=c, unconditional_condition=uc)
+                        else:
+                            loss, stu_out = loss_fn(AMED_predictor=ddp, net=net, tensor_in=tensor_in, labels=labels, step_idx=step_idx, teacher_out=teacher_traj[step_idx])
+                        training_stats.report('Loss/loss', loss)
+                        loss.sum().mul(1 / batch_gpu_total).backward()
 
-            # Update weights.
-            for param in AMED_predictor.parameters():
-                if param.grad is not None:
-                    torch.nan_to_num(param.grad, nan=0, posinf=1e5, neginf=-1e5, out=param.grad)
-            optimizer.step()
+                # Update weights.
+                for param in AMED_predictor.parameters():
+                    if param.grad is not None:
+                        torch.nan_to_num(param.grad, nan=0, posinf=1e5, neginf=-1e5, out=param.grad)
+                optimizer.step()
             
-            if AMED_predictor.sampler_stu in ['euler', 'dpm', 'amed']:
-                # Start from teacher samples yielding slightly better performance for single-step solvers
-                latents = teacher_traj[step_idx]
-            else:
-                latents = stu_out
+                if step_idx is None:
+                    pass
+                elif AMED_predictor.sampler_stu in ['euler', 'dpm', 'amed']:
+                    # Start from teacher samples yielding slightly better performance for single-step solvers
+                    tensor_in = teacher_traj[step_idx]
+                else:
+                    tensor_in = stu_out
 
         # Perform maintenance tasks once per tick.
         cur_nimg += batch_size
@@ -244,17 +314,18 @@ def training_loop(
             
         # Save network snapshot.
         if (snapshot_ticks is not None) and (done or cur_tick % snapshot_ticks == 0) and cur_tick > 0:
-            data = dict(model=AMED_predictor, loss_fn=loss_fn)
-            for key, value in data.items():
-                if isinstance(value, torch.nn.Module):
-                    value = copy.deepcopy(value).eval().requires_grad_(False)
-                    misc.check_ddp_consistency(value)
-                    data[key] = value.cpu()
-                del value # conserve memory
-            if dist.get_rank() == 0:
-                with open(os.path.join(run_dir, f'network-snapshot-{cur_nimg//1000:06d}.pkl'), 'wb') as f:
-                    pickle.dump(data, f)
-            del data # conserve memory
+            for AMED_predictor, loss_fn, config_dir in zip(predictor_list, loss_fn_list, config_dirs):
+                data = dict(model=AMED_predictor, loss_fn=loss_fn)
+                for key, value in data.items():
+                    if isinstance(value, torch.nn.Module):
+                        value = copy.deepcopy(value).eval().requires_grad_(False)
+                        misc.check_ddp_consistency(value)
+                        data[key] = value.cpu()
+                    del value # conserve memory
+                if dist.get_rank() == 0:
+                    with open(os.path.join(config_dir, f'network-snapshot-{cur_nimg//1000:06d}.pkl'), 'wb') as f:
+                        pickle.dump(data, f)
+                del data # conserve memory
 
         # Save full dump of the training state.
         # if (state_dump_ticks is not None) and (done or cur_tick % state_dump_ticks == 0) and cur_tick != 0 and dist.get_rank() == 0:
@@ -262,6 +333,20 @@ def training_loop(
 
         # Update logs.
         training_stats.default_collector.update()
+        for config_idx, loss_fn in enumerate(loss_fn_list):
+            if num_configs > 1:
+                dist.print0(f'Configuration {config_idx}: {os.path.basename(config_dirs[config_idx] or "")}')
+            for step_idx in range(loss_fn.num_steps - 1):
+                name = f'{loss_fn.stats_name}/step{step_idx}'
+                stats = training_stats.default_collector
+                dist.print0("Step: {} | Loss: {:8.4f} | r (mean std): {:5.4f} {:5.4f} | scale_dir (mean std): {:5.4f} {:5.4f} | scale_time (mean std): {:5.4f} {:5.4f}".format(
+                        step_idx,
+                        stats.mean(name + '/loss'),
+                        stats.mean(name + '/r'), stats.std(name + '/r'),
+                        stats.mean(name + '/scale_dir'), stats.std(name + '/scale_dir'),
+                        stats.mean(name + '/scale_time'), stats.std(name + '/scale_time'),
+                    )
+                )
         if dist.get_rank() == 0:
             if stats_jsonl is None:
                 stats_jsonl = open(os.path.join(run_dir, 'stats.jsonl'), 'at')
@@ -278,6 +363,8 @@ def training_loop(
             break
 
     # Done.
+    if teacher_producer is not None:
+        teacher_producer.close()
     dist.print0()
     dist.print0('Exiting...')
 
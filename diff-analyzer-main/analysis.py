@@ -0,0 +1,115 @@
+"""Analyses of sampling trajectories used in main_mp.ipynb. Every function
+computes the metrics of one batch, (num_steps, batch_size) per metric, and
+TrajectoryAnalyzer accumulates them over batches in constant memory."""
+
+import torch
+import solvers
+import utils
+from stats import StepStats
+
+#----------------------------------------------------------------------------
+# Magnitude of the L2 norm of the intermediate samples, denoised samples and
+# intermediate noises.
+
+def cal_magnitude(inter_xt, inter_denoised, inter_eps):
+    mag_xt = torch.norm(inter_xt, p=2, dim=(2,3,4))                     # (num_steps, batch_size)
+    mag_denoised = torch.norm(inter_denoised, p=2, dim=(2,3,4))         # (num_steps-1, batch_size)
+    mag_eps = torch.norm(inter_eps, p=2, dim=(2,3,4))                   # (num_steps-1, batch_size)
+    return dict(mag_xt=mag_xt, mag_denoised=mag_denoised, mag_eps=mag_eps)
+
+#----------------------------------------------------------------------------
+# Perpendicular L2 distance of the intermediate samples (say, x_t) to the
+# line (x_T - x_0).
+
+def cal_deviation(inter_xt, inter_denoised):
+    _, batch_size, ch, r, _ = inter_xt.shape
+    dev_xt = utils.cal_deviation(inter_xt, ch, r, batch_size).transpose(0,1)                   # (num_steps-2, batch_size)
+    dev_denoised = utils.cal_deviation(inter_denoised, ch, r, batch_size).transpose(0,1)       # (num_steps-3, batch_size)
+    return dict(dev_xt=dev_xt, dev_denoised=dev_denoised)
+
+#----------------------------------------------------------------------------
+# L2 distance of the intermediate samples to the final sample, i.e.,
+# ||x_t - x_0||.
+
+def cal_distance(inter_xt, inter_denoised):
+    dist_xt = torch.norm(inter_xt - inter_xt[-1].unsqueeze(0), p=2, dim=(2,3,4))                        # (num_steps, batch_size)
+    dist_denoised = torch.norm(inter_denoised - inter_denoised[-1].unsqueeze(0), p=2, dim=(2,3,4))      # (num_steps-1, batch_size)
+    return dict(dist_xt=dist_xt, dist_denoised=dist_denoised)
+
+#----------------------------------------------------------------------------
+# Cosine similarity between the intermediate gradients (say, \epsilon_t) and
+# the line (x_0 - x_t).
+
+def cal_cos(inter_xt, inter_eps):
+    batch_size = inter_xt.shape[1]
+    a = inter_eps.reshape(inter_eps.shape[0], batch_size, -1)
+    b = (inter_xt[:-1] - inter_xt[-1].unsqueeze(0)).reshape(inter_eps.shape[0], batch_size, -1)
+    return dict(cos_xt=torch.nn.functional.cosine_similarity(a, b, dim=2))                              # (num_steps-1, batch_size)
+
+#----------------------------------------------------------------------------
+# Difference between the samples and the theoretically optimal samples.
+# (Only for CIFAR-10) Also returns the optimal trajectories of the batch.
+
+def cal_opt_difference(net, latents, inter_xt, inter_denoised, cifar10_dataset, solver_kwargs, opt_index=None):
+    t_steps = solver_kwargs['t_steps']
+    inter_xt_opt, inter_denoised_opt, inter_eps_opt = solvers.optimal_sampler(net, latents, cifar10_dataset, opt_index=opt_index, **solver_kwargs)
+    diff_sample_traj = torch.norm(inter_xt_opt - inter_xt, p=2, dim=(2,3,4))                                    # (num_steps, batch_size)
+    diff_denoised_traj = torch.norm(inter_denoised_opt - inter_denoised, p=2, dim=(2,3,4))                      # (num_steps-1, batch_size)
+
+    num_denoised = inter_denoised.shape[0]
+    opt_denoised_traj = torch.stack([solvers.get_denoised_opt(inter_xt[i], t_steps[i], cifar10_dataset, index=opt_index) for i in range(num_denoised)])
+    denoised_opt_traj = torch.stack([solvers.get_denoised(net, inter_xt_opt[i], t_steps[i]) for i in range(num_denoised)])
+    diff_traj = torch.norm(opt_denoised_traj - inter_denoised, p=2, dim=(2,3,4))
+    diff_opt_traj = torch.norm(denoised_opt_traj - inter_denoised_opt, p=2, dim=(2,3,4))
+
+    metrics = dict(diff_sample_traj=diff_sample_traj, diff_denoised_traj=diff_denoised_traj, diff_traj=diff_traj, diff_opt_traj=diff_opt_traj)
+    trajs = dict(inter_xt_opt=inter_xt_opt, inter_denoised_opt=inter_denoised_opt, inter_eps_opt=inter_eps_opt, \
+                 opt_denoised_traj=opt_denoised_traj, denoised_opt_traj=denoised_opt_traj)
+    return metrics, trajs
+
+#----------------------------------------------------------------------------
+# Streaming statistics of the metrics above, one StepStats per metric.
+# Cosine similarities use linear histogram bins in [-1, 1], the other
+# metrics are nonnegative and use logarithmic bins.
+
+class TrajectoryAnalyzer:
+    def __init__(self, num_bins=256, device=None):
+        self.num_bins = num_bins
+        self.device = device
+        self.stats = dict()
+
+    def get_stats(self, name):
+        if name not in self.stats:
+            hist_kwargs = dict(hist_range=(-1, 1), log_bins=False) if name.startswith('cos') else dict()
+            self.stats[name] = StepStats(num_bins=self.num_bins, device=self.device, **hist_kwargs)
+        return self.stats[name]
+
+    def update(self, metrics):
+        for name, values in metrics.items():
+            self.get_stats(name).update(values)
+
+    def merge(self, other):
+        for name, step_stats in other.stats.items():
+            self.get_stats(name).merge(step_stats)
+        return self
+
+    def state_dict(self):
+        return {name: step_stats.state_dict() for name, step_stats in self.stats.items()}
+
+    def load_state_dict(self, state_dict):
+        for name, step_stats in state_dict.items():
+            self.get_stats(name).load_state_dict(step_stats)
+        return self
+
+    def reduce(self, accelerator=None):
+        for name in sorted(self.stats.keys()):      # same order on every rank
+            self.stats[name].reduce(accelerator)
+        return self
+
+    def summary(self):
+        stat = dict()
+        for name, step_stats in self.stats.items():
+            stat.update(step_stats.summary(name))
+        return stat
+
+#----------------------------------------------------------------------------
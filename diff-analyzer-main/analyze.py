@@ -0,0 +1,271 @@
+"""Analyze the sampling trajectories of a large seed range, as main_mp.ipynb
+does, in resumable shards. Every shard stores its accumulator state, so an
+interrupted run restarts from the last completed shard."""
+
+import os
+import csv
+import json
+import click
+import tqdm
+import numpy as np
+import torch
+from torch import autocast
+from torch_utils import distributed as dist
+from torch_utils.download_util import check_file_by_key
+import utils
+import analysis
+from stats import FeatureStats, StreamingPCA
+
+#----------------------------------------------------------------------------
+# Options that do not change the results and may differ when a run resumes.
+
+RESUME_IGNORE_KEYS = ['max_batch_size']
+
+def get_shard_path(outdir, shard_idx):
+    return os.path.join(outdir, f'shard-{shard_idx:05d}.pt')
+
+def save_atomic(write_fn, path):
+    temp_path = path + '.tmp'
+    write_fn(temp_path)
+    os.replace(temp_path, path) # atomic, the file is either complete or missing
+
+def write_manifest(outdir, config, all_shards, done=False):
+    shards = [dict(idx=idx, seeds=[shard[0], shard[-1]], num=len(shard), completed=os.path.isfile(get_shard_path(outdir, idx))) \
+              for idx, shard in enumerate(all_shards)]
+    manifest = dict(config=config, num_completed=sum(shard['completed'] for shard in shards), num_shards=len(shards), done=done, shards=shards)
+    def write_fn(path):
+        with open(path, 'wt') as f:
+            json.dump(manifest, f, indent=2)
+    save_atomic(write_fn, os.path.join(outdir, 'manifest.json'))
+
+#----------------------------------------------------------------------------
+# Pick latents and conditions of a batch, the same as main_mp.ipynb.
+
+def get_latents_and_conditions(net, batch_seeds, solver_kwargs, sample_captions=None, device=torch.device('cuda')):
+    batch_size = len(batch_seeds)
+    rnd = utils.StackedRandomGenerator(device, batch_seeds)
+    latents = rnd.randn([batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
+    class_labels = c = uc = None
+    if net.label_dim:
+        if solver_kwargs['model_source'] == 'adm':
+            class_labels = rnd.randint(net.label_dim, size=(batch_size,), device=device)
+        elif solver_kwargs['model_source'] == 'ldm' and solver_kwargs['dataset_name'] == 'ms_coco':
+            if solver_kwargs['prompt'] is None:
+                prompts = sample_captions[batch_seeds[0]:batch_seeds[-1]+1]
+            else:
+                prompts = [solver_kwargs['prompt'] for i in range(batch_size)]
+            if solver_kwargs['guidance_rate'] != 1.0:
+                uc = net.model.get_learned_conditioning(batch_size * [""])
+            if isinstance(prompts, tuple):
+                prompts = list(prompts)
+            c = net.model.get_learned_conditioning(prompts)
+        else:
+            class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[batch_size], device=device)]
+    return latents, class_labels, c, uc
+
+#----------------------------------------------------------------------------
+
+@click.command()
+
+# General options.
+@click.option('--outdir',                  help='Where to save the shards and the statistics, reused to resume', metavar='DIR',  type=str, required=True)
+@click.option('--seeds',                   help='Random seeds (e.g. 1,2,5-10)', metavar='LIST',                 type=utils.parse_int_list, default='0-49999', show_default=True)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                            type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--shard_size',              help='Number of seeds per shard', metavar='INT',                     type=click.IntRange(min=1), default=2500, show_default=True)
+@click.option('--save_trajs',              help='Save all the trajectories of every shard in float16', metavar='BOOL', type=bool, default=False, show_default=True)
+
+# Sampling options, see main_mp.ipynb.
+@click.option('--dataset_name',            help='Name of the dataset', metavar='STR',                           type=click.Choice(['cifar10', 'ffhq', 'afhqv2', 'imagenet64', 'lsun_bedroom', 'imagenet256', 'lsun_bedroom_ldm', 'ffhq_ldm', 'ms_coco']), required=True)
+@click.option('--solver',                  help='Name of the solver', metavar='STR',                            type=click.Choice(['euler', 'heun', 'dpm', 'dpmpp', 'deis', 'ipndm', 'ipndm_v']), default='euler', show_default=True)
+@click.option('--num_steps',               help='Number of time steps', metavar='INT',                          type=click.IntRange(min=3), default=21, show_default=True)
+@click.option('--afs',                     help='Whether to use AFS', metavar='BOOL',                           type=bool, default=False, show_default=True)
+@click.option('--denoise_to_zero',         help='Whether to denoise from the last time step to 0', metavar='BOOL', type=bool, default=False, show_default=True)
+@click.option('--guidance_type',           help='Guidance type',                                                type=click.Choice(['cg', 'cfg', 'uncond', None]), default=None, show_default=True)
+@click.option('--guidance_rate',           help='Guidance rate', metavar='FLOAT',                               type=float, default=None)
+@click.option('--prompt',                  help='Prompt for Stable Diffusion sampling', metavar='STR',          type=str, default=None)
+@click.option('--max_order',               help='Max order for multi-step solvers', metavar='INT',              type=click.IntRange(min=1), default=2, show_default=True)
+@click.option('--predict_x0',              help='Whether to use data prediction mode', metavar='BOOL',          type=bool, default=False, show_default=True)
+@click.option('--lower_order_final',       help='Lower the order at final stages', metavar='BOOL',              type=bool, default=True, show_default=True)
+@click.option('--deis_mode',               help='Type of DEIS', metavar='STR',                                  type=click.Choice(['tab', 'rhoab']), default='tab', show_default=True)
+@click.option('--schedule_type',           help='Time discretization schedule', metavar='STR',                  type=click.Choice(['polynomial', 'logsnr', 'time_uniform', 'discrete']), default='polynomial', show_default=True)
+@click.option('--schedule_rho',            help='Time step exponent', metavar='FLOAT',                          type=click.FloatRange(min=0), default=7, show_default=True)
+
+# Analyses, see main_mp.ipynb.
+@click.option('--cal_magnitude',           help='Calculate the magnitudes', metavar='BOOL',                     type=bool, default=True, show_default=True)
+@click.option('--cal_deviation',           help='Calculate the deviations', metavar='BOOL',                     type=bool, default=True, show_default=True)
+@click.option('--cal_distance',            help='Calculate the distances to the final samples', metavar='BOOL', type=bool, default=True, show_default=True)
+@click.option('--cal_cos',                 help='Calculate the cosine similarities', metavar='BOOL',            type=bool, default=True, show_default=True)
+@click.option('--cifar10_path',            help='Processed CIFAR-10 dataset, enables the optimal samples', metavar='ZIP', type=str, default=None)
+@click.option('--opt_index', 'opt_index_lists', help='Clusters of the index for the optimal denoiser at small sigma, 0 for the dense one', metavar='INT', type=click.IntRange(min=0), default=0, show_default=True)
+@click.option('--ref', 'ref_stat_path',    help='FID reference statistics, enables the FID', metavar='NPZ|URL', type=str, default=None)
+@click.option('--inception',               help='Inception-v3 model for FID evaluation', metavar='PKL',         type=str, default=None)
+@click.option('--pca_rank',                help='Number of principal components of x_t, 0 to disable', metavar='INT', type=click.IntRange(min=0), default=0, show_default=True)
+@click.option('--pca_per_step',            help='One PCA per time step instead of over all time steps', metavar='BOOL', type=bool, default=True, show_default=True)
+
+def main(outdir, seeds, max_batch_size, shard_size, save_trajs, cal_magnitude, cal_deviation, cal_distance, cal_cos, \
+         cifar10_path, opt_index_lists, ref_stat_path, inception, pca_rank, pca_per_step, device=torch.device('cuda'), **solver_kwargs):
+    """Analyze the sampling trajectories in shards of seeds and merge the
+    statistics into stat.npz, which main_mp.ipynb loads with `stat_path`.
+
+    Examples:
+
+    \b
+    # Statistics of 50k CIFAR-10 trajectories using 4 GPUs, rerun the same command to resume
+    torchrun --standalone --nproc_per_node=4 analyze.py --outdir=outputs/cifar10-euler-steps21 \\
+        --dataset_name=cifar10 --solver=euler --num_steps=21 \\
+        --cifar10_path=/path/to/cifar10-32x32.zip --ref=/path/to/cifar10-32x32.npz
+    """
+    cal_opt_difference = cifar10_path is not None
+    cal_FID = ref_stat_path is not None
+    config = dict(seeds=[seeds[0], seeds[-1], len(seeds)], max_batch_size=max_batch_size, shard_size=shard_size, save_trajs=save_trajs, \
+                  cal_magnitude=cal_magnitude, cal_deviation=cal_deviation, cal_distance=cal_distance, cal_cos=cal_cos, \
+                  cal_opt_difference=cal_opt_difference, opt_index_lists=opt_index_lists, cal_FID=cal_FID, pca_rank=pca_rank, pca_per_step=pca_per_step, **solver_kwargs)
+    solver_kwargs.update(max_batch_size=max_batch_size, t_steps=None, return_inters=True, return_denoised=True, return_eps=True)
+    dist.init()
+
+    # The configuration of an existing run must match, so that the shards can be merged.
+    manifest_path = os.path.join(outdir, 'manifest.json')
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'rt') as f:
+            prev_config = json.load(f)['config']
+        diff = [key for key in set(config) | set(prev_config) if key not in RESUME_IGNORE_KEYS and config.get(key) != prev_config.get(key)]
+        if len(diff) > 0:
+            raise click.ClickException(f'"{outdir}" holds a run with different settings: {", ".join(sorted(diff))}')
+    all_shards = [seeds[i : i + shard_size] for i in range(0, len(seeds), shard_size)]
+    if dist.get_rank() == 0:
+        os.makedirs(outdir, exist_ok=True)
+        write_manifest(outdir, config, all_shards)
+
+    # Rank 0 goes first.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
+    net, solver_kwargs['model_source'] = utils.create_model(solver_kwargs['dataset_name'], solver_kwargs['guidance_type'], solver_kwargs['guidance_rate'], device)
+    if cal_FID:
+        _, _, mu_ref, sigma_ref, detector_net = utils.fid_prepare(ref_stat_path, inception, device)
+    if cal_opt_difference:
+        assert solver_kwargs['dataset_name'] == 'cifar10'
+        cifar10_dataset = utils.cifar10_prepare(cifar10_path, device)
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
+    opt_index = None
+    if cal_opt_difference and opt_index_lists > 0:
+        opt_index = utils.opt_index_prepare(cifar10_dataset, num_lists=opt_index_lists, device=device)
+
+    sample_captions = None
+    if solver_kwargs['dataset_name'] in ['ms_coco'] and solver_kwargs['prompt'] is None:
+        # Loading MS-COCO captions for FID-30k evaluaion
+        # We use the selected 30k captions from https://github.com/boomb0om/text2image-benchmark
+        prompt_path, _ = check_file_by_key('prompts')
+        sample_captions = []
+        with open(prompt_path, 'r') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                text = row['text']
+                sample_captions.append(text)
+
+    sampler_fn, solver_kwargs = utils.configure_solver(solver_kwargs, net, device)
+
+    # Every rank analyzes its own shards, completed shards are skipped to resume an interrupted run.
+    rank_shards = [idx for idx in range(dist.get_rank(), len(all_shards), dist.get_world_size()) if not os.path.isfile(get_shard_path(outdir, idx))]
+    dist.print0(f'Analyzing {len(seeds)} trajectories in {len(all_shards)} shards to "{outdir}"...')
+    for shard_idx in tqdm.tqdm(rank_shards, unit='shard', disable=(dist.get_rank() != 0)):
+        shard_seeds = all_shards[shard_idx]
+        analyzer = analysis.TrajectoryAnalyzer(device=device)
+        feature_stats = FeatureStats(device=device) if cal_FID else None
+        pca = None
+        trajs = dict()
+        for start in range(0, len(shard_seeds), max_batch_size):
+            batch_seeds = shard_seeds[start : start + max_batch_size]
+            latents, class_labels, c, uc = get_latents_and_conditions(net, batch_seeds, solver_kwargs, sample_captions, device)
+
+            # Generate images.
+            with torch.no_grad():
+                if solver_kwargs['model_source'] == 'ldm':
+                    with autocast("cuda"):
+                        with net.model.ema_scope():
+                            inter_xt, inter_denoised, inter_eps = sampler_fn(net, latents, condition=c, unconditional_condition=uc, **solver_kwargs)
+                            images = net.model.decode_first_stage(inter_xt[-1])
+                else:
+                    inter_xt, inter_denoised, inter_eps = sampler_fn(net, latents, class_labels=class_labels, **solver_kwargs)
+                    images = inter_xt[-1]
+
+            # Accumulate the statistics of the trajectories, see analysis.py.
+            if cal_magnitude:
+                analyzer.update(analysis.cal_magnitude(inter_xt, inter_denoised, inter_eps))
+            if cal_deviation:
+                analyzer.update(analysis.cal_deviation(inter_xt, inter_denoised))
+            if cal_distance:
+                analyzer.update(analysis.cal_distance(inter_xt, inter_denoised))
+            if cal_cos:
+                analyzer.update(analysis.cal_cos(inter_xt, inter_eps))
+            batch_trajs = dict(inter_xt=inter_xt, inter_denoised=inter_denoised, inter_eps=inter_eps)
+            if cal_opt_difference:
+                opt_metrics, opt_trajs = analysis.cal_opt_difference(net, latents, inter_xt, inter_denoised, cifar10_dataset, solver_kwargs, opt_index=opt_index)
+                analyzer.update(opt_metrics)
+                batch_trajs.update(opt_trajs)
+            if pca_rank > 0:
+                if pca is None:
+                    pca = StreamingPCA(inter_xt[0, 0].numel(), pca_rank, num_steps=inter_xt.shape[0] if pca_per_step else None, device=device)
+                pca.update(inter_xt)
+            if cal_FID:
+                images = (images * 127.5 + 128).clip(0, 255).to(torch.uint8)
+                feature_stats.update(detector_net(images, return_features=True))
+
+            # Keep the first batch of the shard for display, or every batch with --save_trajs.
+            if start == 0 or save_trajs:
+                for key, value in batch_trajs.items():
+                    trajs.setdefault(key, []).append(value.to(torch.float16).cpu())
+
+        shard = dict(seeds=shard_seeds, analyzer=analyzer.state_dict(), feature_stats=None if feature_stats is None else feature_stats.state_dict(), \
+                     pca=None if pca is None else pca.state_dict(), \
+                     trajs={key: torch.cat(value, dim=1) for key, value in trajs.items()})
+        save_atomic(lambda path: torch.save(shard, path), get_shard_path(outdir, shard_idx))
+        if dist.get_rank() == 0:
+            write_manifest(outdir, config, all_shards)
+
+    if opt_index is not None:
+        dist.print0(f'The optimal denoiser fell back to the dense computation for {opt_index.num_fallbacks} of {opt_index.num_queries} indexed queries on rank 0')
+
+    # Merge the shards.
+    torch.distributed.barrier()
+    if dist.get_rank() == 0:
+        dist.print0(f'Merging {len(all_shards)} shards...')
+        analyzer = analysis.TrajectoryAnalyzer(device=device)
+        feature_stats = FeatureStats(device=device) if cal_FID else None
+        pca = None
+        stat = dict()
+        for shard_idx in range(len(all_shards)):
+            shard = torch.load(get_shard_path(outdir, shard_idx), map_location='cpu')
+            analyzer.merge(analysis.TrajectoryAnalyzer(device=device).load_state_dict(shard['analyzer']))
+            if cal_FID:
+                feature_stats.merge(FeatureStats(device=device).load_state_dict(shard['feature_stats']))
+            if pca_rank > 0:
+                shard_pca = StreamingPCA(shard['pca']['dim'], pca_rank, num_steps=shard['pca']['num_steps'], device=device).load_state_dict(shard['pca'])
+                pca = shard_pca if pca is None else pca.merge(shard_pca)
+            if shard_idx == 0:
+                stat.update({key: value[:, :max_batch_size].float().numpy() for key, value in shard['trajs'].items()})
+        stat.update(analyzer.summary())
+        if pca_rank > 0:
+            stat.update(pca.summary('pca_xt'))
+        if cal_FID:
+            stat['fid'] = feature_stats.get_fid(mu_ref, sigma_ref)
+            dist.print0(f"FID: {float(stat['fid'])}")
+        for key, value in solver_kwargs.items():
+            if key == 't_steps':
+                stat[key] = value.cpu().numpy()
+            elif key == 'coeff_list':
+                continue
+            elif value is not None:
+                stat[key] = value
+        np.savez(os.path.join(outdir, 'stat.npz'), **stat)
+        write_manifest(outdir, config, all_shards, done=True)
+        dist.print0(f'Saved the statistics to "{os.path.join(outdir, "stat.npz")}"')
+    torch.distributed.barrier()
+    dist.print0('Done.')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
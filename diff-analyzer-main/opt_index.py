@@ -0,0 +1,150 @@
+"""Inverted-file (IVF) index over a dataset for the optimal denoiser at low
+noise levels, where the softmax weights concentrate on a few neighbours."""
+
+import os
+import math
+import torch
+
+#----------------------------------------------------------------------------
+# The dataset is partitioned by k-means into `num_lists` clusters. A query
+# visits the `num_probes` clusters with the smallest lower bound on the
+# distance to their members, max(||x - c|| - radius, 0), and computes the
+# exact softmax over the visited images (optionally the `top_k` nearest).
+# Every image left out is at least `lb` away from the query, so the total
+# softmax weight left out is at most
+#     eps = n_out * exp(-(lb^2 - d_min^2) / (2 * t^2))
+# relative to the weight of the nearest image at distance d_min, and the
+# error of the denoised output is at most eps times the diameter of the
+# dataset. Queries with eps > tol are answered by the dense computation.
+
+class OptimalDenoiserIndex:
+    def __init__(self, centroids, radii, perm, offsets):
+        self.centroids = centroids      # (num_lists, ch*r*r)
+        self.radii = radii              # (num_lists,), distance from the centroid to the farthest member
+        self.perm = perm                # (num_images,), image indices grouped by cluster
+        self.offsets = offsets          # (num_lists+1,), the members of cluster j are perm[offsets[j]:offsets[j+1]]
+        self.members = self.get_members(perm, offsets)
+        self.num_queries = 0
+        self.num_fallbacks = 0
+
+    @staticmethod
+    def get_members(perm, offsets):
+        # The members of every cluster padded with -1 to the size of the largest one, (num_lists, max_size)
+        sizes = offsets[1:] - offsets[:-1]
+        lists = torch.repeat_interleave(torch.arange(sizes.shape[0], device=perm.device), sizes)
+        members = torch.full([sizes.shape[0], max(int(sizes.max()), 1)], -1, dtype=torch.int64, device=perm.device)
+        members[lists, torch.arange(perm.shape[0], device=perm.device) - offsets[lists]] = perm
+        return members
+
+    @property
+    def num_images(self):
+        return self.perm.shape[0]
+
+    def to(self, device):
+        self.centroids, self.radii = self.centroids.to(device), self.radii.to(device)
+        self.perm, self.offsets, self.members = self.perm.to(device), self.offsets.to(device), self.members.to(device)
+        return self
+
+    @classmethod
+    @torch.no_grad()
+    def build(cls, dataset, num_lists=256, num_iters=10, chunk_size=10000, seed=0):
+        data = dataset.reshape(dataset.shape[0], -1)
+        generator = torch.Generator(data.device).manual_seed(seed)
+        init_idx = torch.randperm(data.shape[0], generator=generator, device=data.device)[:num_lists]
+        centroids = data[init_idx].to(torch.float64)
+
+        # Lloyd's iterations, the squared distances to the centroids are computed chunk by chunk
+        def assign(centroids):
+            assignments = []
+            c_sq = (centroids ** 2).sum(dim=1).unsqueeze(0)
+            for start in range(0, data.shape[0], chunk_size):
+                y = data[start:start+chunk_size].to(torch.float64)
+                assignments.append((c_sq - 2 * y @ centroids.T).argmin(dim=1))
+            return torch.cat(assignments)
+
+        for _ in range(num_iters):
+            assignments = assign(centroids)
+            sums = torch.zeros_like(centroids)
+            for start in range(0, data.shape[0], chunk_size):
+                sums.index_add_(0, assignments[start:start+chunk_size], data[start:start+chunk_size].to(torch.float64))
+            counts = torch.bincount(assignments, minlength=num_lists).unsqueeze(1)
+            centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)   # keep empty clusters in place
+        assignments = assign(centroids)
+
+        # Exact radii of the clusters
+        radii = torch.zeros([num_lists], dtype=torch.float64, device=data.device)
+        for start in range(0, data.shape[0], chunk_size):
+            a = assignments[start:start+chunk_size]
+            dist = (data[start:start+chunk_size].to(torch.float64) - centroids[a]).norm(dim=1)
+            radii.scatter_reduce_(0, a, dist, reduce='amax')
+        perm = assignments.argsort(stable=True)
+        offsets = torch.zeros([num_lists + 1], dtype=torch.int64, device=data.device)
+        offsets[1:] = torch.bincount(assignments, minlength=num_lists).cumsum(dim=0)
+        return cls(centroids, radii, perm, offsets)
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        state = dict(centroids=self.centroids, radii=self.radii, perm=self.perm, offsets=self.offsets)
+        temp_path = path + '.tmp'
+        torch.save({key: value.cpu() for key, value in state.items()}, temp_path)
+        os.replace(temp_path, path) # atomic, the file is either complete or missing
+
+    @classmethod
+    def load(cls, path, device=None):
+        state = torch.load(path, map_location='cpu')
+        return cls(**state).to(device)
+
+    # The probed clusters are gathered from the padded member table for a
+    # chunk of queries at once, with about `chunk_size` candidate images per
+    # chunk. The distances and the softmax are computed in `dtype`.
+
+    @torch.no_grad()
+    def denoise(self, x, t, dataset, num_probes=8, top_k=None, tol=1e-4, fallback=None, chunk_size=10000, dtype=torch.float64):
+        batch_size = x.shape[0]
+        data = dataset.reshape(dataset.shape[0], -1)
+        x_flat = x.reshape(batch_size, -1).to(dtype)
+        t = torch.as_tensor(t, device=x.device).to(dtype).reshape(-1).expand(batch_size)
+        num_probes = min(num_probes, self.centroids.shape[0])
+
+        # Lower bounds on the distances to the members of every cluster
+        lower_bounds = (torch.cdist(x_flat.to(self.centroids.dtype), self.centroids) - self.radii.unsqueeze(0)).clamp(min=0)
+        lower_bounds, order = lower_bounds.sort(dim=1)                                  # (bs, num_lists)
+        lb_sq = lower_bounds[:, num_probes].to(dtype) ** 2 if num_probes < lower_bounds.shape[1] else torch.full_like(t, float('inf'))
+
+        denoised = torch.zeros_like(x_flat)
+        exact = torch.zeros([batch_size], dtype=torch.bool, device=x.device)
+        queries_per_chunk = max(chunk_size // (num_probes * self.members.shape[1]), 1)
+        for start in range(0, batch_size, queries_per_chunk):
+            end = min(start + queries_per_chunk, batch_size)
+            idx = self.members[order[start:end, :num_probes]].reshape(end - start, -1)     # (q, num_probes*max_size)
+            y = data[idx.clamp(min=0)].to(dtype)
+            dist_sq = ((y - x_flat[start:end].unsqueeze(1)) ** 2).sum(dim=2)
+            dist_sq = dist_sq.masked_fill(idx < 0, float('inf'))
+            chunk_lb_sq = lb_sq[start:end]
+            if top_k is not None and top_k < idx.shape[1]:
+                dist_sq, nearest = dist_sq.topk(top_k + 1, dim=1, largest=False, sorted=True)
+                chunk_lb_sq = torch.minimum(chunk_lb_sq, dist_sq[:, -1])
+                dist_sq, nearest = dist_sq[:, :-1], nearest[:, :-1]
+                y = y.gather(1, nearest.unsqueeze(2).expand(-1, -1, y.shape[2]))
+            num_out = self.num_images - dist_sq.isfinite().sum(dim=1)
+
+            # Bound on the relative softmax weight of the images left out
+            t_chunk = t[start:end]
+            d_min = dist_sq.min(dim=1).values
+            log_eps = num_out.to(dtype).log() - (chunk_lb_sq - d_min) / (2 * t_chunk ** 2)
+            accurate = d_min.isfinite() & ((num_out == 0) | (log_eps <= math.log(tol)))
+            weights = torch.softmax(-dist_sq / (2 * t_chunk.unsqueeze(1) ** 2), dim=1)
+            denoised[start:end] = torch.where(accurate.unsqueeze(1), torch.bmm(weights.unsqueeze(1), y).squeeze(1), denoised[start:end])
+            exact[start:end] = accurate
+
+        # Dense computation for the queries where the truncation is not accurate enough
+        self.num_queries += batch_size
+        self.num_fallbacks += int((~exact).sum())
+        if not exact.all():
+            assert fallback is not None
+            t_fb = t[~exact] if t.unique().numel() > 1 else t[0]
+            denoised[~exact] = fallback(x[~exact], t_fb).reshape(-1, x_flat.shape[1]).to(dtype)
+        return denoised.reshape(x.shape).to(x.dtype)
+
+#----------------------------------------------------------------------------
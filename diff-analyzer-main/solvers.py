@@ -15,17 +15,44 @@ def get_denoised(net, x, t, class_labels=None, condition=None, unconditional_con
     return denoised
 
 #----------------------------------------------------------------------------
+# Get the output of the optimal denoiser, i.e. the mean of the dataset images
+# weighted by softmax(-||x - y||^2 / (2 * t^2)). The whole batch is processed
+# at once: the squared distances to a chunk of the dataset are computed by
+# ||x||^2 + ||y||^2 - 2xy with one matrix product, and the softmax is
+# accumulated over the chunks with a streaming log-sum-exp. `t` is a scalar
+# or given per sample. The cancellation in the distances is amplified by
+# 1 / (2 * t^2), so float64 is used by default for accurate weights at small t.
+# With an `OptimalDenoiserIndex` (see opt_index.py), the softmax is truncated
+# to the nearest images for t <= index_max_sigma when this is provably
+# accurate up to the tolerance given in `index_kwargs`.
 
 @torch.no_grad()
-def get_denoised_opt(x, t, cifar10_dataset):
-    for i in range(x.shape[0]):
-        l2_norms = torch.norm(cifar10_dataset - x[i].unsqueeze(0), p=2, dim=(1, 2, 3))  # (50000,)
-        weights = torch.nn.functional.softmax((-1 * l2_norms ** 2) / (2 * t ** 2)).reshape(-1, 1, 1, 1)
-        if i == 0:
-            denoised = torch.sum(torch.mul(cifar10_dataset, weights), dim=0).unsqueeze(0)
-        else:
-            denoised = torch.cat((denoised, torch.sum(torch.mul(cifar10_dataset, weights), dim=0).unsqueeze(0)), dim=0)
-    return denoised
+def get_denoised_opt(x, t, cifar10_dataset, chunk_size=10000, dtype=torch.float64, index=None, index_max_sigma=1., **index_kwargs):
+    if index is not None and torch.as_tensor(t).max() <= index_max_sigma:
+        fallback = lambda x_fb, t_fb: get_denoised_opt(x_fb, t_fb, cifar10_dataset, chunk_size=chunk_size, dtype=dtype)
+        return index.denoise(x, t, cifar10_dataset, fallback=fallback, chunk_size=chunk_size, dtype=dtype, **index_kwargs)
+    batch_size = x.shape[0]
+    x_flat = x.reshape(batch_size, -1).to(dtype)
+    x_sq = (x_flat ** 2).sum(dim=1, keepdim=True)                                       # (bs, 1)
+    t = torch.as_tensor(t, device=x.device).to(dtype).reshape(-1, 1)                     # (1, 1) or (bs, 1)
+
+    max_logit = torch.full([batch_size, 1], -float('inf'), dtype=dtype, device=x.device)
+    weight_sum = torch.zeros([batch_size, 1], dtype=dtype, device=x.device)
+    weighted_sum = torch.zeros_like(x_flat)                                             # (bs, ch*r*r)
+    for start in range(0, cifar10_dataset.shape[0], chunk_size):
+        y = cifar10_dataset[start:start+chunk_size].reshape(-1, x_flat.shape[1]).to(x.device, dtype)
+        dist_sq = (x_sq + (y ** 2).sum(dim=1).unsqueeze(0) - 2 * x_flat @ y.T).clamp(min=0)    # (bs, chunk_size)
+        logits = -dist_sq / (2 * t ** 2)
+
+        # Rescale the accumulators to the new maximum logit
+        new_max = torch.maximum(max_logit, logits.max(dim=1, keepdim=True).values)
+        rescale = torch.exp(max_logit - new_max)
+        weights = torch.exp(logits - new_max)
+        weight_sum = weight_sum * rescale + weights.sum(dim=1, keepdim=True)
+        weighted_sum = weighted_sum * rescale + weights @ y
+        max_logit = new_max
+    denoised = weighted_sum / weight_sum
+    return denoised.reshape(x.shape).to(x.dtype)
 
 #----------------------------------------------------------------------------
 
@@ -787,6 +814,9 @@ def optimal_sampler(
     return_denoised=False, 
     return_eps=False, 
     t_steps=None,
+    chunk_size=10000,
+    opt_dtype=torch.float64,
+    opt_index=None,
     **kwargs
 ):  
     """
@@ -811,6 +841,9 @@ def optimal_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        chunk_size: A `int`. The number of dataset images processed at once by the optimal denoiser.
+        opt_dtype: A `torch.dtype`. The precision of the optimal denoiser.
+        opt_index: An `OptimalDenoiserIndex` used by the optimal denoiser at small time steps.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
@@ -831,13 +864,7 @@ def optimal_sampler(
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
         else:
-            for j in range(x_cur.shape[0]):
-                l2_norms = torch.norm(cifar10_dataset - x_cur[j].unsqueeze(0), p=2, dim=(1, 2, 3))  # (50000,)
-                weights = torch.nn.functional.softmax((-1 * l2_norms ** 2) / (2 * t_cur ** 2)).reshape(-1, 1, 1, 1)
-                if j == 0:
-                    denoised = torch.sum(torch.mul(cifar10_dataset, weights), dim=0).unsqueeze(0)
-                else:
-                    denoised = torch.cat((denoised, torch.sum(torch.mul(cifar10_dataset, weights), dim=0).unsqueeze(0)), dim=0)
+            denoised = get_denoised_opt(x_cur, t_cur, cifar10_dataset, chunk_size=chunk_size, dtype=opt_dtype, index=opt_index)
             d_cur = (x_cur - denoised) / t_cur
         x_next = x_cur + (t_next - t_cur) * d_cur
         if return_inters:
@@ -848,13 +875,7 @@ def optimal_sampler(
             inters_eps.append(d_cur.unsqueeze(0))
     
     if denoise_to_zero:
-        for j in range(x_cur.shape[0]):
-            l2_norms = torch.norm(cifar10_dataset - x_cur[j].unsqueeze(0), p=2, dim=(1, 2, 3))  # (50000,)
-            weights = torch.nn.functional.softmax((-1 * l2_norms ** 2) / (2 * t_cur ** 2)).reshape(-1, 1, 1, 1)
-            if j == 0:
-                denoised = torch.sum(torch.mul(cifar10_dataset, weights), dim=0).unsqueeze(0)
-            else:
-                denoised = torch.cat((denoised, torch.sum(torch.mul(cifar10_dataset, weights), dim=0).unsqueeze(0)), dim=0)
+        denoised = get_denoised_opt(x_cur, t_cur, cifar10_dataset, chunk_size=chunk_size, dtype=opt_dtype, index=opt_index)
         d_cur = (x_next - denoised) / t_next
         if return_inters:
             inters_xt.append(denoised.unsqueeze(0))
@@ -0,0 +1,302 @@
+"""Streaming statistics of per-time-step metrics of sampling trajectories.
+The accumulators use constant memory in the number of samples and are merged
+across ranks with a single collective operation."""
+
+import numpy as np
+import scipy.linalg
+import torch
+
+#----------------------------------------------------------------------------
+# Collective operations over all ranks, either through 🤗 Accelerate or
+# torch.distributed. Both are no-ops for a single process.
+
+def all_gather(tensor, accelerator=None):
+    if accelerator is not None:
+        return accelerator.gather(tensor.unsqueeze(0))
+    if not torch.distributed.is_initialized() or torch.distributed.get_world_size() == 1:
+        return tensor.unsqueeze(0)
+    gathered = tensor.new_empty([torch.distributed.get_world_size(), *tensor.shape])
+    torch.distributed.all_gather_into_tensor(gathered, tensor.contiguous())
+    return gathered
+
+def all_reduce(tensor, accelerator=None):
+    if accelerator is not None:
+        return accelerator.reduce(tensor, reduction='sum')
+    if torch.distributed.is_initialized():
+        torch.distributed.all_reduce(tensor)
+    return tensor
+
+#----------------------------------------------------------------------------
+# Count, mean, M2 (sum of squared deviations from the mean), min, max and a
+# fixed-bin histogram per time step. The batches are merged with the
+# parallel variant of Welford's algorithm. Quantiles are estimated from the
+# histogram, with linear or logarithmic bins between `hist_range`; values
+# outside the range fall in the first and last bins. The number of time
+# steps is set by the first update.
+
+class StepStats:
+    def __init__(self, num_bins=256, hist_range=(1e-4, 1e5), log_bins=True, device=None):
+        self.num_bins = num_bins
+        self.device = device
+        if log_bins:
+            self.edges = torch.logspace(np.log10(hist_range[0]), np.log10(hist_range[1]), num_bins + 1, dtype=torch.float64, device=device)
+        else:
+            self.edges = torch.linspace(hist_range[0], hist_range[1], num_bins + 1, dtype=torch.float64, device=device)
+        self.log_bins = log_bins
+        self.count = self.mean = self.m2 = self.min = self.max = self.hist = None
+
+    def _init_state(self, num_steps):
+        zeros = lambda *shape: torch.zeros(shape, dtype=torch.float64, device=self.device)
+        self.count, self.mean, self.m2 = zeros(num_steps), zeros(num_steps), zeros(num_steps)
+        self.min = torch.full([num_steps], float('inf'), dtype=torch.float64, device=self.device)
+        self.max = torch.full([num_steps], -float('inf'), dtype=torch.float64, device=self.device)
+        self.hist = zeros(num_steps, self.num_bins)
+
+    @property
+    def num_steps(self):
+        return None if self.count is None else self.count.shape[0]
+
+    @torch.no_grad()
+    def update(self, values):
+        # values: (num_steps, batch_size)
+        values = values.to(self.device, torch.float64)
+        if self.count is None:
+            self._init_state(values.shape[0])
+        count = torch.full_like(self.count, values.shape[1])
+        mean = values.mean(dim=1)
+        m2 = ((values - mean.unsqueeze(1)) ** 2).sum(dim=1)
+        idx = torch.bucketize(values, self.edges[1:-1])
+        hist = torch.zeros_like(self.hist).scatter_add_(1, idx, torch.ones_like(values))
+        self._merge(count, mean, m2, values.min(dim=1).values, values.max(dim=1).values, hist)
+
+    def _merge(self, count, mean, m2, vmin, vmax, hist):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total.clamp(min=1)
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total.clamp(min=1)
+        self.count = total
+        self.min, self.max = torch.minimum(self.min, vmin), torch.maximum(self.max, vmax)
+        self.hist = self.hist + hist
+
+    def _pack(self):
+        return torch.cat([torch.stack([self.count, self.mean, self.m2, self.min, self.max], dim=1), self.hist], dim=1)
+
+    def _unpack(self, state):
+        return state[:, 0], state[:, 1], state[:, 2], state[:, 3], state[:, 4], state[:, 5:]
+
+    @torch.no_grad()
+    def merge(self, other):
+        if other.count is None:
+            return self
+        if self.count is None:
+            self._init_state(other.num_steps)
+        self._merge(*self._unpack(other._pack().to(self.count.device)))
+        return self
+
+    def state_dict(self):
+        return dict(edges=self.edges.cpu(), log_bins=self.log_bins, state=None if self.count is None else self._pack().cpu())
+
+    def load_state_dict(self, state_dict):
+        self.edges, self.log_bins = state_dict['edges'].to(self.device), state_dict['log_bins']
+        self.num_bins = self.edges.shape[0] - 1
+        if state_dict['state'] is None:
+            self.count = self.mean = self.m2 = self.min = self.max = self.hist = None
+        else:
+            self.count, self.mean, self.m2, self.min, self.max, self.hist = self._unpack(state_dict['state'].to(self.device))
+        return self
+
+    @torch.no_grad()
+    def reduce(self, accelerator=None):
+        # Every rank must have been updated at least once to know the number of time steps.
+        assert self.count is not None
+        states = all_gather(self._pack(), accelerator)
+        self._init_state(self.num_steps)
+        for state in states:
+            self._merge(*self._unpack(state))
+        return self
+
+    @property
+    def std(self):
+        return (self.m2 / self.count.clamp(min=1)).sqrt()     # same as np.std
+
+    @torch.no_grad()
+    def quantile(self, q):
+        # Interpolate inside the bin where the cumulative count reaches q * count.
+        cdf = self.hist.cumsum(dim=1)
+        target = (q * self.count).unsqueeze(1)
+        idx = torch.searchsorted(cdf, target).clamp(max=self.num_bins - 1)
+        prev = torch.cat([torch.zeros_like(cdf[:, :1]), cdf], dim=1).gather(1, idx)
+        frac = ((target - prev) / self.hist.gather(1, idx).clamp(min=1)).clamp(0, 1).squeeze(1)
+        lo, hi = self.edges[idx.squeeze(1)], self.edges[idx.squeeze(1) + 1]
+        value = lo * (hi / lo) ** frac if self.log_bins else lo + (hi - lo) * frac
+        return torch.minimum(torch.maximum(value, self.min), self.max)
+
+    def summary(self, name, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        stat = {f'{name}_{key}': value.cpu().numpy() for key, value in \
+                dict(count=self.count, mean=self.mean, std=self.std, min=self.min, max=self.max, hist=self.hist).items()}
+        stat[f'{name}_edges'] = self.edges.cpu().numpy()
+        stat[f'{name}_quantiles'] = np.array(quantiles)
+        stat[f'{name}_q'] = torch.stack([self.quantile(q) for q in quantiles]).cpu().numpy()     # (num_quantiles, num_steps)
+        return stat
+
+#----------------------------------------------------------------------------
+# Sums of the Inception-v3 features and of their outer products for FID.
+# The sums are packed in one tensor, so the ranks are merged with one
+# reduction.
+
+class FeatureStats:
+    def __init__(self, feature_dim=2048, device=None):
+        self.feature_dim = feature_dim
+        self.state = torch.zeros([1 + feature_dim + feature_dim ** 2], dtype=torch.float64, device=device)
+
+    @torch.no_grad()
+    def update(self, features):
+        features = features.to(torch.float64)
+        self.state[0] += features.shape[0]
+        self.state[1:1+self.feature_dim] += features.sum(dim=0)
+        self.state[1+self.feature_dim:] += (features.T @ features).flatten()
+
+    @torch.no_grad()
+    def reduce(self, accelerator=None):
+        self.state = all_reduce(self.state, accelerator)
+        return self
+
+    def merge(self, other):
+        self.state += other.state.to(self.state.device)
+        return self
+
+    def state_dict(self):
+        return dict(feature_dim=self.feature_dim, state=self.state.cpu())
+
+    def load_state_dict(self, state_dict):
+        self.feature_dim = state_dict['feature_dim']
+        self.state = state_dict['state'].to(self.state.device)
+        return self
+
+    def get_mean_cov(self):
+        count = self.state[0]
+        mu = self.state[1:1+self.feature_dim] / count
+        sigma = self.state[1+self.feature_dim:].reshape(self.feature_dim, self.feature_dim)
+        sigma = (sigma - mu.ger(mu) * count) / (count - 1)
+        return mu.cpu().numpy(), sigma.cpu().numpy()
+
+    def get_fid(self, mu_ref, sigma_ref):
+        mu, sigma = self.get_mean_cov()
+        m = np.square(mu - mu_ref).sum()
+        s, _ = scipy.linalg.sqrtm(np.dot(sigma, sigma_ref), disp=False)
+        fid = m + np.trace(sigma + sigma_ref - s * 2)
+        return float(np.real(fid))
+
+#----------------------------------------------------------------------------
+# Streaming randomized PCA of trajectory states, per time step or over all
+# time steps. Every batch updates a sketch of the second moment matrix,
+# sum x x^T Omega, with a fixed Gaussian test matrix Omega of
+# `rank + oversample` columns, along with the sums of the states and of their
+# squared norms. All of them are sums, so batches, ranks and shards are
+# merged by addition. The principal components are recovered from the sketch
+# of the centered covariance with the single-pass Nystrom approximation
+# (Tropp et al., 2017), without a second pass over the data.
+
+class StreamingPCA:
+    def __init__(self, dim, rank=32, oversample=10, num_steps=None, seed=0, device=None):
+        self.dim = dim
+        self.rank = rank
+        self.num_sketch = rank + oversample
+        self.num_steps = num_steps      # None for a single PCA over all time steps
+        self.num_groups = 1 if num_steps is None else num_steps
+        generator = torch.Generator().manual_seed(seed)     # the same test matrix on every rank
+        self.omega = torch.randn([dim, self.num_sketch], generator=generator, dtype=torch.float64).to(device)
+        self.state = torch.zeros([self.num_groups, 2 + dim + dim * self.num_sketch], dtype=torch.float64, device=device)
+        self.mean = self.eigvals = self.components = self.total_var = None
+
+    def _unpack(self):
+        count, sq_norm, sums = self.state[:, 0], self.state[:, 1], self.state[:, 2:2+self.dim]
+        sketch = self.state[:, 2+self.dim:].reshape(self.num_groups, self.dim, self.num_sketch)
+        return count, sq_norm, sums, sketch
+
+    def _flatten(self, states):
+        # states: (num_steps, batch_size, ...) -> (num_groups, num_samples, dim)
+        x = states.reshape(states.shape[0], states.shape[1], -1).to(self.state.device, torch.float64)
+        x = x.reshape(1, -1, self.dim) if self.num_steps is None else x
+        assert x.shape[0] == self.num_groups and x.shape[2] == self.dim
+        return x
+
+    @torch.no_grad()
+    def update(self, states):
+        x = self._flatten(states)
+        self.state[:, 0] += x.shape[1]
+        self.state[:, 1] += (x ** 2).sum(dim=(1, 2))
+        self.state[:, 2:2+self.dim] += x.sum(dim=1)
+        self.state[:, 2+self.dim:] += (x.transpose(1, 2) @ (x @ self.omega)).flatten(1)
+        self.mean = self.eigvals = self.components = self.total_var = None
+
+    @torch.no_grad()
+    def reduce(self, accelerator=None):
+        self.state = all_reduce(self.state, accelerator)
+        self.mean = self.eigvals = self.components = self.total_var = None
+        return self
+
+    def merge(self, other):
+        self.state += other.state.to(self.state.device)
+        self.mean = self.eigvals = self.components = self.total_var = None
+        return self
+
+    def state_dict(self):
+        return dict(dim=self.dim, rank=self.rank, num_sketch=self.num_sketch, num_steps=self.num_steps, omega=self.omega.cpu(), state=self.state.cpu())
+
+    def load_state_dict(self, state_dict):
+        self.dim, self.rank, self.num_sketch, self.num_steps = state_dict['dim'], state_dict['rank'], state_dict['num_sketch'], state_dict['num_steps']
+        self.num_groups = 1 if self.num_steps is None else self.num_steps
+        self.omega, self.state = state_dict['omega'].to(self.state.device), state_dict['state'].to(self.state.device)
+        self.mean = self.eigvals = self.components = self.total_var = None
+        return self
+
+    @torch.no_grad()
+    def _solve(self):
+        count, sq_norm, sums, sketch = self._unpack()
+        assert (count > 1).all()
+        self.mean = sums / count.unsqueeze(1)
+        self.total_var = (sq_norm - count * (self.mean ** 2).sum(dim=1)) / (count - 1)
+
+        # Sketch of the covariance, C Omega = (sum x x^T - n mu mu^T) Omega / (n - 1)
+        y = sketch - count.reshape(-1, 1, 1) * self.mean.unsqueeze(2) * (self.mean @ self.omega).unsqueeze(1)
+        y = y / (count - 1).reshape(-1, 1, 1)
+
+        # C ~ Y (Omega^T Y)^+ Y^T, shifted by a tiny nu for the stability of the Cholesky factorization
+        nu = torch.finfo(y.dtype).eps * torch.linalg.matrix_norm(y)
+        y = y + nu.reshape(-1, 1, 1) * self.omega
+        core = self.omega.T @ y
+        chol = torch.linalg.cholesky((core + core.transpose(1, 2)) / 2)
+        b = torch.linalg.solve_triangular(chol, y.transpose(1, 2), upper=False).transpose(1, 2)
+        u, s, _ = torch.linalg.svd(b, full_matrices=False)
+        self.eigvals = (s[:, :self.rank] ** 2 - nu.unsqueeze(1)).clamp(min=0)     # (num_groups, rank)
+        self.components = u[:, :, :self.rank]                                   # (num_groups, dim, rank)
+
+    def explained_variance(self):
+        if self.eigvals is None:
+            self._solve()
+        return self.eigvals
+
+    def explained_variance_ratio(self):
+        return self.explained_variance() / self.total_var.unsqueeze(1)
+
+    @torch.no_grad()
+    def project(self, states, num_components=None):
+        # Coordinates of the states in the principal components, (num_steps, batch_size, num_components)
+        if self.components is None:
+            self._solve()
+        x = self._flatten(states)
+        coords = (x - self.mean.unsqueeze(1)) @ self.components[:, :, :num_components]
+        return coords.reshape(states.shape[0], states.shape[1], -1)
+
+    def summary(self, name='pca'):
+        ratio = self.explained_variance_ratio()
+        return {f'{name}_count': self.state[:, 0].cpu().numpy(),
+                f'{name}_total_variance': self.total_var.cpu().numpy(),
+                f'{name}_explained_variance': self.eigvals.cpu().numpy(),               # (num_groups, rank)
+                f'{name}_explained_variance_ratio': ratio.cpu().numpy(),
+                f'{name}_cumulative_ratio': ratio.cumsum(dim=1).cpu().numpy(),
+                f'{name}_mean': self.mean.to(torch.float32).cpu().numpy(),               # (num_groups, dim)
+                f'{name}_components': self.components.to(torch.float32).cpu().numpy()}  # (num_groups, dim, rank)
+
+#----------------------------------------------------------------------------
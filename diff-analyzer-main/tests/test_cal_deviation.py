@@ -0,0 +1,36 @@
+"""Check cal_deviation against the previous version, which repeated the
+projection coefficients to the full trajectory shape."""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from utils import cal_deviation
+
+def cal_deviation_repeat(traj, ch, r, bs=1):
+    traj = traj.transpose(0, 1)
+    a, b, c = traj[:, 1:-1], traj[:, 0].unsqueeze(1), traj[:, -1].unsqueeze(1)
+    bc = c - b
+    bc_unit = bc / torch.norm(bc, p=2, dim=(1, 2, 3, 4)).reshape(bs, 1, 1, 1, 1)
+    ac = c - a
+    bc_unit_bcasted = bc_unit.expand_as(ac)
+    temp = torch.sum(ac * bc_unit_bcasted, dim=(2, 3, 4))
+    temp_expanded = temp.unsqueeze(2).unsqueeze(3).unsqueeze(4).repeat(1, 1, ch, r, r)
+    ac_projection = temp_expanded * bc_unit
+    perp = ac - ac_projection
+    return torch.norm(perp, p=2, dim=(2, 3, 4))
+
+#----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float64])
+@pytest.mark.parametrize('chunk_size', [None, 1, 2, 3, 10])
+@pytest.mark.parametrize('num_steps', [2, 3, 6])
+def test_cal_deviation_matches_repeat(num_steps, chunk_size, dtype):
+    bs, ch, r = 3, 2, 4
+    traj = torch.randn([num_steps, bs, ch, r, r], generator=torch.Generator().manual_seed(num_steps)).to(dtype)
+    traj_copy = traj.clone()
+    ref = cal_deviation_repeat(traj, ch, r, bs=bs)
+    out = cal_deviation(traj, ch, r, bs=bs, chunk_size=chunk_size)
+    assert out.shape == ref.shape == (bs, num_steps - 2)
+    torch.testing.assert_close(out, ref)
+    assert torch.equal(traj, traj_copy)
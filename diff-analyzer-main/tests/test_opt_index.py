@@ -0,0 +1,64 @@
+"""Check the optimal denoiser with OptimalDenoiserIndex against the dense
+computation, and that the queries answered densely are counted."""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from opt_index import OptimalDenoiserIndex
+from solvers import get_denoised_opt
+
+def get_dataset(num_images=2000, num_modes=20):
+    # Images around a few modes, so that the k-means clusters are tight.
+    generator = torch.Generator().manual_seed(0)
+    modes = torch.rand([num_modes, 3, 4, 4], generator=generator) * 2 - 1
+    labels = torch.randint(num_modes, [num_images], generator=generator)
+    return (modes[labels] + 0.05 * torch.randn([num_images, 3, 4, 4], generator=generator)).clamp(-1, 1)
+
+#----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('top_k', [None, 16])
+@pytest.mark.parametrize('t', [0.02, 0.1, 0.5])
+def test_index_matches_dense(t, top_k):
+    dataset = get_dataset()
+    index = OptimalDenoiserIndex.build(dataset, num_lists=32)
+    generator = torch.Generator().manual_seed(1)
+    x = dataset[torch.randint(dataset.shape[0], [64], generator=generator)] + t * torch.randn([64, 3, 4, 4], generator=generator)
+
+    num_dense = []
+    def fallback(x_fb, t_fb):
+        num_dense.append(x_fb.shape[0])
+        return get_denoised_opt(x_fb, t_fb, dataset)
+
+    ref = get_denoised_opt(x, t, dataset)
+    denoised = index.denoise(x, t, dataset, num_probes=4, top_k=top_k, fallback=fallback)
+    torch.testing.assert_close(denoised, ref, rtol=0, atol=1e-3)
+    assert index.num_queries == x.shape[0]
+    assert index.num_fallbacks == sum(num_dense)
+    if t == 0.02:   # the softmax weights concentrate on the nearest images
+        assert index.num_fallbacks == 0
+
+    # get_denoised_opt only uses the index up to index_max_sigma.
+    torch.testing.assert_close(get_denoised_opt(x, t, dataset, index=index, index_max_sigma=1., num_probes=4, top_k=top_k), ref, rtol=0, atol=1e-3)
+    assert index.num_queries == 2 * x.shape[0]
+    get_denoised_opt(x, t, dataset, index=index, index_max_sigma=t / 2)
+    assert index.num_queries == 2 * x.shape[0]
+
+def test_index_falls_back_far_from_the_data():
+    # Queries far from every image are never provably accurate with one probed cluster.
+    dataset = get_dataset()
+    index = OptimalDenoiserIndex.build(dataset, num_lists=32)
+    x = torch.randn([8, 3, 4, 4], generator=torch.Generator().manual_seed(2)) * 3
+    denoised = index.denoise(x, 1., dataset, num_probes=1, fallback=lambda x_fb, t_fb: get_denoised_opt(x_fb, t_fb, dataset))
+    torch.testing.assert_close(denoised, get_denoised_opt(x, 1., dataset), rtol=0, atol=1e-6)
+    assert index.num_fallbacks == index.num_queries == x.shape[0]
+
+def test_save_and_load(tmp_path):
+    dataset = get_dataset()
+    index = OptimalDenoiserIndex.build(dataset, num_lists=32)
+    path = str(tmp_path / 'index.pt')
+    index.save(path)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['index.pt']
+    loaded = OptimalDenoiserIndex.load(path)
+    for key in ['centroids', 'radii', 'perm', 'offsets', 'members']:
+        assert torch.equal(getattr(loaded, key), getattr(index, key))
@@ -1,16 +1,19 @@
+import os
 import re
 import ast
 import pickle
+import warnings
 import dnnlib
 import PIL.Image
 import numpy as np
 import torch
 from torch_utils import distributed as dist
-from torch_utils import misc
 from torch_utils.download_util import check_file_by_key
 from torchvision.utils import make_grid, save_image
 import solvers
 import solver_utils
+import dataset
+from opt_index import OptimalDenoiserIndex
 from IPython.display import display
 
 #----------------------------------------------------------------------------
@@ -158,13 +161,14 @@ def fid_prepare(ref_stat_path, inceptionV3_path, device, accelerator=None):
 
 def cifar10_prepare(path_to_cifar10, device, accelerator=None):
     dist.print0('Loading CIFAR-10 dataset...') if accelerator is None else accelerator.print('Loading CIFAR-10 dataset...')
-    dataset_kwargs = dnnlib.EasyDict(class_name='dataset.ImageFolderDataset', path=path_to_cifar10, use_labels=False, cache=True, resolution=32, max_size=50000)
-    data_loader_kwargs = dnnlib.EasyDict(pin_memory=True, num_workers=4, prefetch_factor=2)
-    dataset_obj = dnnlib.util.construct_class_by_name(**dataset_kwargs) # subclass of training.dataset.Dataset
-    dataset_sampler = misc.InfiniteSampler(dataset=dataset_obj, rank=dist.get_rank(), num_replicas=dist.get_world_size(), seed=0, shuffle=False)
-    dataset_iterator = iter(torch.utils.data.DataLoader(dataset=dataset_obj, sampler=dataset_sampler, batch_size=50000, **data_loader_kwargs))
-
-    cifar10_dataset, _ = next(dataset_iterator)
+    # Zip archives and image folders are decoded once per node into shared memory
+    # that all ranks attach to, memory-mapped datasets are sliced directly. The
+    # images are a view of the mapped pages, only read by the conversion below.
+    dataset_obj = dataset.open_image_dataset(path_to_cifar10, shared=True, resolution=32, max_size=50000)
+    images, _ = dataset_obj.get_batch(slice(None))
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+        cifar10_dataset = torch.from_numpy(images)
     cifar10_dataset = cifar10_dataset.to(device).to(torch.float32) / 127.5 - 1
     dist.print0(f'Finished.') if accelerator is None else accelerator.print(f'Finished.')
 
@@ -172,6 +176,38 @@ def cifar10_prepare(path_to_cifar10, device, accelerator=None):
 
 #----------------------------------------------------------------------------
 
+def barrier(accelerator=None):
+    if accelerator is not None:
+        accelerator.wait_for_everyone()
+    elif torch.distributed.is_initialized():
+        torch.distributed.barrier()
+
+#----------------------------------------------------------------------------
+# Load the index over the dataset for the optimal denoiser from `cache_dir`,
+# or build it once and save it there. The cache is keyed by the dataset size
+# and a checksum of its pixels. Rank 0 goes first and builds the index, the
+# other ranks load it afterwards. Must be called by all ranks.
+
+def opt_index_prepare(dataset, cache_dir='./outputs/opt_index', num_lists=256, device=None, accelerator=None):
+    checksum = int((dataset.reshape(dataset.shape[0], -1)[:, ::97].to(torch.float64) * 127.5).sum().round().item())
+    cache_path = os.path.join(cache_dir, f'opt-index-{dataset.shape[0]}-{num_lists}-{checksum & 0xffffffff:08x}.pt')
+    is_main_process = (dist.get_rank() == 0) if accelerator is None else accelerator.is_main_process
+    if not is_main_process:
+        barrier(accelerator)
+    if os.path.isfile(cache_path):
+        dist.print0(f'Loading the index for the optimal denoiser from "{cache_path}"...') if accelerator is None else accelerator.print(f'Loading the index for the optimal denoiser from "{cache_path}"...')
+        index = OptimalDenoiserIndex.load(cache_path, device)
+    else:
+        dist.print0('Building the index for the optimal denoiser...') if accelerator is None else accelerator.print('Building the index for the optimal denoiser...')
+        index = OptimalDenoiserIndex.build(dataset, num_lists=num_lists).to(device)
+        index.save(cache_path)
+        dist.print0(f'Finished.') if accelerator is None else accelerator.print(f'Finished.')
+    if is_main_process:
+        barrier(accelerator)
+    return index
+
+#----------------------------------------------------------------------------
+
 def configure_solver(solver_kwargs, net, device, accelerator=None):
     # Get the time schedule
     solver_kwargs['sigma_min'] = net.sigma_min
@@ -245,25 +281,30 @@ def configure_solver(solver_kwargs, net, device, accelerator=None):
 #----------------------------------------------------------------------------
 # Calculate the deviation of the sampling trajectory
 
-def cal_deviation(traj, ch, r, bs=1):
+def cal_deviation(traj, ch, r, bs=1, chunk_size=None):
     traj = traj.transpose(0, 1)
     # intermedia points, start point, end point
     a, b, c = traj[:, 1:-1], traj[:, 0].unsqueeze(1), traj[:, -1].unsqueeze(1)
 
-    ac = c - a                                                                          # (bs, num_steps-1, ch, r, r)
     bc = c - b                                                                          # (bs, 1, ch, r, r)
     bc_unit = bc / torch.norm(bc, p=2, dim=(1, 2, 3, 4)).reshape(bs, 1, 1, 1, 1)        # (bs, 1, ch, r, r)
-    
-    # Calculate projection vector
-    bc_unit_bcasted = bc_unit.expand_as(ac)                                             # (bs, num_steps-1, ch, r, r)
-    temp = torch.sum(ac * bc_unit_bcasted, dim=(2, 3, 4))                               # (bs, num_steps-1,)
-    temp_expanded = temp.unsqueeze(2).unsqueeze(3).unsqueeze(4).repeat(1, 1, ch, r, r)  # (bs, num_steps-1, ch, r, r)
-    ac_projection = temp_expanded * bc_unit
-    
-    # Calculate the deviation
-    perp = ac - ac_projection                                                           # (bs, num_steps-1, ch, r, r)
-    norm = torch.norm(perp, p=2, dim=(2, 3, 4))
-    return norm  
+
+    # The intermediate points are processed `chunk_size` at a time (all at once by default).
+    # The only tensor of the size of the chunk is ac: the projection is a batched dot product
+    # and the perpendicular component is written into ac by a fused in-place addcmul.
+    num_inters = a.shape[1]
+    chunk_size = max(num_inters, 1) if chunk_size is None else chunk_size
+    norm = []
+    for start in range(0, max(num_inters, 1), chunk_size):
+        ac = c - a[:, start:start+chunk_size]                                           # (bs, chunk_size, ch, r, r)
+
+        # Calculate projection vector
+        temp = torch.einsum('bkd,bd->bk', ac.flatten(2), bc_unit.flatten(1))            # (bs, chunk_size)
+        
+        # Calculate the deviation, the perpendicular component overwrites ac
+        ac.addcmul_(temp.reshape(*temp.shape, 1, 1, 1), bc_unit, value=-1)             # (bs, chunk_size, ch, r, r)
+        norm.append(torch.norm(ac, p=2, dim=(2, 3, 4)))
+    return torch.cat(norm, dim=1)  
 
 #----------------------------------------------------------------------------
 
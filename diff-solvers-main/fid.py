@@ -22,7 +22,7 @@ import dataset
 
 def calculate_inception_stats(
     image_path, num_expected=None, seed=0, max_batch_size=64,
-    num_workers=3, prefetch_factor=2, device=torch.device('cuda'),
+    num_workers=3, prefetch_factor=2, device=torch.device('cuda'), shared_cache=False,
 ):
     # Rank 0 goes first.
     if dist.get_rank() != 0:
@@ -39,7 +39,7 @@ def calculate_inception_stats(
 
     # List images.
     dist.print0(f'Loading images from "{image_path}"...')
-    dataset_obj = dataset.ImageFolderDataset(path=image_path, max_size=num_expected, random_seed=seed)
+    dataset_obj = dataset.open_image_dataset(image_path, shared=shared_cache, max_size=num_expected, random_seed=seed)
     assert len(dataset_obj) in [10000, 30000, 50000]
     if num_expected is not None and len(dataset_obj) < num_expected:
         raise click.ClickException(f'Found {len(dataset_obj)} images, but expected at least {num_expected}')
@@ -142,13 +142,14 @@ def calc(image_path, ref_path, num_expected, seed, batch):
 @click.option('--data', 'dataset_path', help='Path to the dataset', metavar='PATH|ZIP', type=str, required=True)
 @click.option('--dest', 'dest_path',    help='Destination .npz file', metavar='NPZ',    type=str, required=True)
 @click.option('--batch',                help='Maximum batch size', metavar='INT',       type=click.IntRange(min=1), default=500, show_default=True)
+@click.option('--shm',                  help='Decode the dataset once per node into shared memory', is_flag=True)
 
-def ref(dataset_path, dest_path, batch):
+def ref(dataset_path, dest_path, batch, shm):
     """Calculate dataset reference statistics needed by 'calc'."""
     torch.multiprocessing.set_start_method('spawn')
     dist.init()
 
-    mu, sigma = calculate_inception_stats(image_path=dataset_path, max_batch_size=batch)
+    mu, sigma = calculate_inception_stats(image_path=dataset_path, max_batch_size=batch, shared_cache=shm)
     dist.print0(f'Saving dataset reference statistics to "{dest_path}"...')
     if dist.get_rank() == 0:
         if os.path.dirname(dest_path):
@@ -7,9 +7,12 @@ import tqdm
 import pickle
 import torch
 import PIL.Image
+import numpy as np
 import dnnlib
 import solvers
 import solver_utils
+from traj_store import TrajectoryWriter
+from step_metrics import METRICS
 from torch import autocast
 from torch_utils import distributed as dist
 from torchvision.utils import make_grid, save_image
@@ -160,8 +163,12 @@ def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, devi
 @click.option('--outdir',                  help='Where to save the output images', metavar='DIR',                   type=str)
 @click.option('--grid',                    help='Whether to make grid',                                             type=bool, default=False)
 @click.option('--subdirs',                 help='Create subdirectory for every 1000 seeds',                         type=bool, default=True, is_flag=True)
+@click.option('--metrics',                 help='Per-step metrics collected during sampling (e.g. d_norm,curvature)', metavar='LIST', type=str, default=None)
+@click.option('--traj_dir',                help='Where to store the trajectories, see traj_store.py', metavar='DIR', type=str, default=None)
+@click.option('--traj_dtype',              help='Storage precision of the trajectories', metavar='STR',             type=click.Choice(['float16', 'bfloat16']), default='float16', show_default=True)
+@click.option('--traj_compress',           help='Whether to compress the stored trajectories', metavar='BOOL',      type=bool, default=False, show_default=True)
 
-def main(dataset_name, max_batch_size, seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **solver_kwargs):
+def main(dataset_name, max_batch_size, seeds, grid, outdir, subdirs, t_steps, metrics, traj_dir, traj_dtype, traj_compress, device=torch.device('cuda'), **solver_kwargs):
 
     dist.init()
     num_batches = ((len(seeds) - 1) // (max_batch_size * dist.get_world_size()) + 1) * dist.get_world_size()
@@ -257,6 +264,22 @@ def main(dataset_name, max_batch_size, seeds, grid, outdir, subdirs, t_steps, de
             continue
         dist.print0(f"\t{key}: {value}")
 
+    # Collect the per-step metrics during sampling, see step_metrics.py.
+    callbacks = None
+    if metrics is not None:
+        for name in metrics.split(','):
+            if name not in METRICS:
+                raise click.ClickException(f'Unknown metric "{name}", one of {list(METRICS.keys())}')
+        callbacks = [METRICS[name]() for name in metrics.split(',')]
+        solver_kwargs['callbacks'] = callbacks
+
+    # Store the trajectories of every batch, one set of chunks per rank.
+    traj_writer = None
+    if traj_dir is not None:
+        traj_writer = TrajectoryWriter(traj_dir, dtype=traj_dtype, compress=traj_compress, rank=dist.get_rank())
+        sampler_fn = solvers.record_trajectories(sampler_fn, traj_writer)
+        dist.print0(f'Storing the trajectories to "{traj_dir}"...')
+
     # Loop over batches.
     if outdir is None:
         if grid:
@@ -291,6 +314,8 @@ def main(dataset_name, max_batch_size, seeds, grid, outdir, subdirs, t_steps, de
                 class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[batch_size], device=device)]
 
         # Generate images.
+        if traj_writer is not None:
+            solver_kwargs['batch_seeds'] = batch_seeds.tolist()
         with torch.no_grad():
             if solver_kwargs['model_source'] == 'ldm':
                 with autocast("cuda"):
@@ -316,6 +341,16 @@ def main(dataset_name, max_batch_size, seeds, grid, outdir, subdirs, t_steps, de
                 PIL.Image.fromarray(image_np, 'RGB').save(image_path)
     
     # Done.
+    if traj_writer is not None:
+        traj_writer.close()
+    if callbacks is not None:
+        stat = dict()
+        for callback in callbacks:
+            stat.update(callback.reduce(device).summary())
+        if dist.get_rank() == 0:
+            os.makedirs(outdir, exist_ok=True)
+            np.savez(os.path.join(outdir, 'step-metrics.npz'), **stat)
+            dist.print0(f'Saved the per-step metrics to "{os.path.join(outdir, "step-metrics.npz")}"')
     torch.distributed.barrier()
     dist.print0('Done.')
 
@@ -13,6 +13,35 @@ def get_denoised(net, x, t, class_labels=None, condition=None, unconditional_con
         denoised = net(x, t, class_labels=class_labels)
     return denoised
 
+#----------------------------------------------------------------------------
+# Call the per-step metric callbacks, see step_metrics.py. When AFS skips
+# the first model evaluation, the denoised output is derived from d_cur.
+
+def run_callbacks(callbacks, i, t_cur, t_next, x_cur, denoised, d_cur):
+    if denoised is None:
+        denoised = x_cur - t_cur * d_cur
+    for callback in callbacks:
+        callback(i, t_cur, t_next, x_cur, denoised, d_cur)
+
+#----------------------------------------------------------------------------
+# Wrap a sampler to write the trajectory (and the gradients, if provided by
+# the sampler) of every batch to `traj_writer`, see traj_store.py. The
+# wrapped sampler takes the seeds of the batch in `batch_seeds` and returns
+# what the original sampler returns for the given `return_inters` and
+# `return_eps`.
+
+def record_trajectories(sampler_fn, traj_writer):
+    def sampler_with_writer(net, latents, batch_seeds, return_inters=False, return_eps=False, **kwargs):
+        outputs = sampler_fn(net, latents, return_inters=True, return_eps=True, **kwargs)
+        inters, inters_eps = outputs if isinstance(outputs, tuple) else (outputs, None)    # UniPC does not return gradients
+        traj_writer.write(batch_seeds, inters, inters_eps)
+        if not return_inters:
+            return inters[-1]
+        if return_eps and inters_eps is not None:
+            return inters, inters_eps
+        return inters
+    return sampler_with_writer
+
 #----------------------------------------------------------------------------
 
 @torch.no_grad()
@@ -31,6 +60,7 @@ def euler_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     t_steps=None,
     **kwargs
 ):  
@@ -56,6 +86,7 @@ def euler_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
@@ -78,6 +109,8 @@ def euler_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
         x_next = x_cur + (t_next - t_cur) * d_cur
         if return_inters:
             inters.append(x_next.unsqueeze(0))
@@ -113,6 +146,7 @@ def heun_sampler(
     denoise_to_zero=False, 
     return_inters=False,
     return_eps=False, 
+    callbacks=None, 
     t_steps=None, 
     **kwargs
 ):
@@ -138,6 +172,7 @@ def heun_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
@@ -160,6 +195,8 @@ def heun_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
         x_next = x_cur + (t_next - t_cur) * d_cur
 
         # Apply 2nd order correction.
@@ -200,6 +237,7 @@ def dpm_2_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     r=0.5, 
     t_steps=None,
     **kwargs
@@ -226,6 +264,7 @@ def dpm_2_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
         r: A `float`. The hyperparameter controlling the location of the intermediate time step. r=0.5 recovers the original DPM-Solver-2.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
@@ -249,6 +288,8 @@ def dpm_2_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
         t_mid = (t_next ** r) * (t_cur ** (1 - r))
         x_next = x_cur + (t_mid - t_cur) * d_cur
 
@@ -290,6 +331,7 @@ def ipndm_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     max_order=4, 
     t_steps=None,
     **kwargs
@@ -316,6 +358,7 @@ def ipndm_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
@@ -340,6 +383,8 @@ def ipndm_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
             
         order = min(max_order, i+1)
         if order == 1:      # First Euler step.
@@ -391,6 +436,7 @@ def ipndm_v_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     max_order=4, 
     t_steps=None,
     **kwargs
@@ -417,6 +463,7 @@ def ipndm_v_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
@@ -443,6 +490,8 @@ def ipndm_v_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
         
         order = min(max_order, i+1)
         if order == 1:      # First Euler step.
@@ -516,6 +565,7 @@ def deis_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     max_order=4, 
     coeff_list=None, 
     t_steps=None,
@@ -543,6 +593,7 @@ def deis_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
         coeff_list: A `list`. The pre-calculated coefficients for DEIS sampling.
     Returns:
@@ -570,6 +621,8 @@ def deis_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
         
         order = min(max_order, i+1)
         if order == 1:          # First Euler step.
@@ -625,6 +678,7 @@ def dpm_pp_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     max_order=3, 
     predict_x0=True, 
     lower_order_final=True, 
@@ -653,6 +707,7 @@ def dpm_pp_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 3
         predict_x0: A `bool`. Whether to use the data prediction formulation. 
         lower_order_final: A `bool`. Whether to lower the order at the final stages of sampling. 
@@ -681,6 +736,8 @@ def dpm_pp_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callbacks is not None:
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, None if use_afs else denoised, d_cur)
         
         buffer_model.append(dynamic_thresholding_fn(denoised)) if predict_x0 else buffer_model.append(d_cur)
         buffer_t.append(t_cur)
@@ -730,6 +787,7 @@ def unipc_sampler(
     denoise_to_zero=False, 
     return_inters=False, 
     return_eps=False, 
+    callbacks=None, 
     max_order=3, 
     predict_x0=True, 
     lower_order_final=True, 
@@ -758,6 +816,7 @@ def unipc_sampler(
         afs: A `bool`. Whether to use analytical first step (AFS) at the beginning of sampling.
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
+        callbacks: A list of callables. Called at every step with (i, t_cur, t_next, x_cur, denoised, d_cur), e.g. the accumulators in step_metrics.py.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 3
         predict_x0: A `bool`. Whether to use the data prediction formulation. 
         lower_order_final: A `bool`. Whether to lower the order at the final stages of sampling. 
@@ -787,6 +846,11 @@ def unipc_sampler(
     buffer_t = [t_steps[0]]
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):                # 0, ..., N-1
         x_cur = x_next
+        if callbacks is not None:
+            # The last model output is the one at t_cur
+            model_cur = buffer_model[-1]
+            denoised, d_cur = (model_cur, (x_cur - model_cur) / t_cur) if predict_x0 else (x_cur - t_cur * model_cur, model_cur)
+            run_callbacks(callbacks, i, t_cur, t_next, x_cur, denoised, d_cur)
         
         if i + 1 < max_order:
             order = i + 1
@@ -0,0 +1,128 @@
+# Per-step diagnostics collected during sampling. Every metric is a callback
+# for the `callbacks` argument of the samplers in solvers.py, and accumulates
+# the count, mean, std, min and max of a per-sample value at every step in
+# constant memory, without storing the trajectories.
+
+import numpy as np
+import torch
+
+#----------------------------------------------------------------------------
+# Streaming statistics of `fn(i, t_cur, t_next, x_cur, denoised, d_cur)`, a
+# tensor of shape (batch_size,), per step. Batches are merged with the
+# parallel variant of Welford's algorithm.
+
+class StepMetric:
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.state = None       # (num_steps, 6): t_cur, count, mean, M2, min, max
+
+    def _grow(self, num_steps, device):
+        init = torch.tensor([0, 0, 0, 0, float('inf'), -float('inf')], dtype=torch.float64, device=device)
+        rows = init.repeat(num_steps if self.state is None else num_steps - self.state.shape[0], 1)
+        self.state = rows if self.state is None else torch.cat([self.state, rows])
+
+    @torch.no_grad()
+    def __call__(self, i, t_cur, t_next, x_cur, denoised, d_cur):
+        values = self.fn(i, t_cur, t_next, x_cur, denoised, d_cur)
+        if values is None:
+            return
+        values = values.detach().to(torch.float64).flatten()
+        if self.state is None or i >= self.state.shape[0]:
+            self._grow(i + 1, values.device)
+        t, count, mean, m2, vmin, vmax = self.state[i].unbind()
+        batch_count, batch_mean = values.shape[0], values.mean()
+        total = count + batch_count
+        delta = batch_mean - mean
+        self.state[i] = torch.stack([torch.as_tensor(t_cur, dtype=torch.float64, device=values.device), total, \
+                                     mean + delta * batch_count / total, m2 + ((values - batch_mean) ** 2).sum() + delta ** 2 * count * batch_count / total, \
+                                     torch.minimum(vmin, values.min()), torch.maximum(vmax, values.max())])
+
+    @torch.no_grad()
+    def reduce(self, device=None):
+        # Merge the statistics of all ranks. A rank may have run fewer steps, or no batch at all since sample.py
+        # pads the batches to a multiple of the world size, so the states are first grown to the largest number
+        # of steps. `device` is where the state of such a rank is allocated.
+        device = self.state.device if self.state is not None else device
+        if not torch.distributed.is_initialized() or torch.distributed.get_world_size() == 1:
+            if self.state is None:
+                self._grow(0, device)
+            return self
+        num_steps = torch.tensor([0 if self.state is None else self.state.shape[0]], device=device)
+        torch.distributed.all_reduce(num_steps, op=torch.distributed.ReduceOp.MAX)
+        if self.state is None or self.state.shape[0] < int(num_steps):
+            self._grow(int(num_steps), device)
+        states = [torch.empty_like(self.state) for _ in range(torch.distributed.get_world_size())]
+        torch.distributed.all_gather(states, self.state.contiguous())
+        t, count, mean, m2, vmin, vmax = torch.stack(states).unbind(dim=2)     # (world_size, num_steps)
+        total = count.sum(dim=0)
+        merged_mean = (count * mean).sum(dim=0) / total.clamp(min=1)
+        merged_m2 = (m2 + count * (mean - merged_mean) ** 2).sum(dim=0)
+        # The time of a step is 0 on the ranks that did not run it.
+        self.state = torch.stack([t.max(dim=0).values, total, merged_mean, merged_m2, vmin.min(dim=0).values, vmax.max(dim=0).values], dim=1)
+        return self
+
+    def summary(self):
+        t, count, mean, m2, vmin, vmax = self.state.cpu().numpy().T
+        std = np.sqrt(m2 / np.maximum(count, 1))
+        return {f'{self.name}_t': t, f'{self.name}_count': count, f'{self.name}_mean': mean, f'{self.name}_std': std, \
+                f'{self.name}_min': vmin, f'{self.name}_max': vmax}
+
+#----------------------------------------------------------------------------
+# Built-in metrics.
+
+def norm(x):
+    return x.flatten(1).norm(dim=1)
+
+class DenoisedNorm(StepMetric):
+    # L2 norm of the denoised output r_theta(x_t).
+    def __init__(self, name='denoised_norm'):
+        super().__init__(name, lambda i, t_cur, t_next, x_cur, denoised, d_cur: norm(denoised))
+
+class GradientNorm(StepMetric):
+    # L2 norm of the gradient d_cur = (x_t - r_theta(x_t)) / t.
+    def __init__(self, name='d_norm'):
+        super().__init__(name, lambda i, t_cur, t_next, x_cur, denoised, d_cur: norm(d_cur))
+
+class Curvature(StepMetric):
+    # Cosine similarity between the gradients of two consecutive steps, 1 for a
+    # straight trajectory. Keeps the gradient of the previous step.
+    def __init__(self, name='curvature'):
+        super().__init__(name, self.cos_to_prev)
+        self.prev = None
+
+    def cos_to_prev(self, i, t_cur, t_next, x_cur, denoised, d_cur):
+        prev, self.prev = (None if i == 0 else self.prev), d_cur
+        return None if prev is None else torch.nn.functional.cosine_similarity(d_cur.flatten(1), prev.flatten(1), dim=1)
+
+class DenoisedShift(StepMetric):
+    # L2 distance between the denoised outputs of two consecutive steps, i.e.
+    # how far the predicted final sample moves during one step.
+    def __init__(self, name='denoised_shift'):
+        super().__init__(name, self.dist_to_prev)
+        self.prev = None
+
+    def dist_to_prev(self, i, t_cur, t_next, x_cur, denoised, d_cur):
+        prev, self.prev = (None if i == 0 else self.prev), denoised
+        return None if prev is None else norm(denoised - prev)
+
+class Deviation(StepMetric):
+    # Distance from x_t to the chord between the starting point x_T and the
+    # denoised output r_theta(x_t), the current estimate of the end point of
+    # the trajectory. Keeps x_T of the current batch.
+    def __init__(self, name='deviation'):
+        super().__init__(name, self.dist_to_chord)
+        self.x_start = None
+
+    def dist_to_chord(self, i, t_cur, t_next, x_cur, denoised, d_cur):
+        if i == 0:
+            self.x_start = x_cur
+        chord = (denoised - self.x_start).flatten(1)
+        chord_unit = chord / chord.norm(dim=1, keepdim=True)
+        ac = (denoised - x_cur).flatten(1)
+        return (ac - (ac * chord_unit).sum(dim=1, keepdim=True) * chord_unit).norm(dim=1)
+
+METRICS = {'denoised_norm': DenoisedNorm, 'd_norm': GradientNorm, 'curvature': Curvature, 'denoised_shift': DenoisedShift, \
+           'deviation': Deviation}
+
+#----------------------------------------------------------------------------
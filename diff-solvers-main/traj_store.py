@@ -0,0 +1,196 @@
+"""Chunked on-disk store of sampling trajectories, indexed by (seed, step).
+
+A store is a directory written by one or more ranks. Every rank appends the
+trajectories of its batches to `TrajectoryWriter`, which flushes them in
+chunks of `chunk_size` seeds:
+
+    meta-r{rank}.json                   shapes, dtype and the seeds of every chunk
+    chunk-r{rank}-{idx}-{key}.npy       uncompressed, memory-mapped by the reader
+    chunk-r{rank}-{idx}.npz             losslessly compressed (zlib), decompressed per chunk
+
+Every array has the layout [num_seeds, num_steps, ch, r, r], so that one
+seed across all steps is contiguous and one step across many seeds is a
+strided read that touches only the rows it needs. float16 is stored
+natively and bfloat16 as its raw 16 bits. The keys are 'xt' for the
+trajectory (return_inters) and 'eps' for the gradients (return_eps).
+"""
+
+import os
+import re
+import json
+import numpy as np
+import torch
+
+#----------------------------------------------------------------------------
+
+STORAGE_DTYPES = {'float16': (torch.float16, np.float16), 'bfloat16': (torch.bfloat16, np.uint16)}
+
+def to_storage(tensor, dtype):
+    tensor = tensor.detach().to(STORAGE_DTYPES[dtype][0]).cpu()
+    return tensor.view(torch.int16).numpy().view(np.uint16) if dtype == 'bfloat16' else tensor.numpy()
+
+def from_storage(array, dtype):
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+    return tensor.view(torch.bfloat16) if dtype == 'bfloat16' else tensor
+
+def save_atomic(path, write_fn, mode='wb'):
+    temp_path = path + '.tmp'
+    with open(temp_path, mode) as f:
+        write_fn(f)
+    os.replace(temp_path, path) # atomic, the file is either complete or missing
+
+#----------------------------------------------------------------------------
+# Write trajectories of one rank. `write` takes a batch in the layout
+# returned by the samplers, i.e. [num_steps, batch_size, ch, r, r].
+
+class TrajectoryWriter:
+    def __init__(self, path, chunk_size=1000, dtype='float16', compress=False, rank=0):
+        assert dtype in STORAGE_DTYPES
+        self.path = path
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.compress = compress
+        self.rank = rank
+        self.shapes = None
+        self.chunks = []
+        self.buffer_seeds = []
+        self.buffers = dict()
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.path, f'meta-r{self.rank}.json')
+
+    def write(self, seeds, inters, eps=None):
+        seeds = [int(seed) for seed in seeds]
+        arrays = dict(xt=inters) if eps is None else dict(xt=inters, eps=eps)
+        shapes = {key: list(value.shape[:1]) + list(value.shape[2:]) for key, value in arrays.items()}
+        if self.shapes is None:
+            self.shapes = shapes
+        assert shapes == self.shapes, f'Got trajectories of shapes {shapes}, expected {self.shapes}'
+        assert all(value.shape[1] == len(seeds) for value in arrays.values())
+
+        for key, value in arrays.items():
+            self.buffers.setdefault(key, []).append(to_storage(value.transpose(0, 1), self.dtype))
+        self.buffer_seeds += seeds
+        while len(self.buffer_seeds) >= self.chunk_size:
+            self._flush_chunk(self.chunk_size)
+
+    def _flush_chunk(self, num_seeds):
+        buffers = {key: np.concatenate(value) for key, value in self.buffers.items()}
+        idx = len(self.chunks)
+        arrays = {key: value[:num_seeds] for key, value in buffers.items()}
+        if self.compress:
+            file_name = f'chunk-r{self.rank}-{idx:05d}.npz'
+            save_atomic(os.path.join(self.path, file_name), lambda f: np.savez_compressed(f, **arrays))
+            files = {key: file_name for key in arrays}
+        else:
+            files = {key: f'chunk-r{self.rank}-{idx:05d}-{key}.npy' for key in arrays}
+            for key, value in arrays.items():
+                save_atomic(os.path.join(self.path, files[key]), lambda f: np.save(f, value))
+        self.chunks.append(dict(seeds=self.buffer_seeds[:num_seeds], files=files))
+        self.buffers = {key: [value[num_seeds:]] for key, value in buffers.items()}
+        self.buffer_seeds = self.buffer_seeds[num_seeds:]
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = dict(dtype=self.dtype, compress=self.compress, shapes=self.shapes, chunks=self.chunks)
+        save_atomic(self.meta_path, lambda f: json.dump(meta, f), mode='wt')
+
+    def close(self):
+        if len(self.buffer_seeds) > 0:
+            self._flush_chunk(len(self.buffer_seeds))
+
+#----------------------------------------------------------------------------
+# Read slices of a store written by any number of ranks. Uncompressed chunks
+# are memory-mapped; the most recently used compressed chunk is cached.
+
+class TrajectoryReader:
+    def __init__(self, path):
+        self.path = path
+        meta_files = sorted(f for f in os.listdir(path) if re.fullmatch(r'meta-r\d+\.json', f))
+        if len(meta_files) == 0:
+            raise FileNotFoundError(f'No trajectory store found at "{path}"')
+        self.chunks = []
+        for meta_file in meta_files:
+            with open(os.path.join(path, meta_file), 'rt') as f:
+                meta = json.load(f)
+            if len(self.chunks) == 0:
+                self.dtype, self.shapes = meta['dtype'], meta['shapes']
+            assert (meta['dtype'], meta['shapes']) == (self.dtype, self.shapes), f'Got inconsistent metadata in "{meta_file}"'
+            self.chunks += [dict(chunk, compress=meta['compress']) for chunk in meta['chunks']]
+        self.index = {seed: (chunk_idx, row) for chunk_idx, chunk in enumerate(self.chunks) for row, seed in enumerate(chunk['seeds'])}
+        self._mmaps = dict()
+        self._cached_npz = (None, None)
+
+    @property
+    def seeds(self):
+        return [seed for chunk in self.chunks for seed in chunk['seeds']]
+
+    @property
+    def keys(self):
+        return list(self.shapes.keys())
+
+    def num_steps(self, key='xt'):
+        return self.shapes[key][0]
+
+    def __len__(self):
+        return len(self.index)
+
+    def _chunk_array(self, chunk_idx, key):
+        chunk = self.chunks[chunk_idx]
+        file_path = os.path.join(self.path, chunk['files'][key])
+        if not chunk['compress']:
+            if file_path not in self._mmaps:
+                self._mmaps[file_path] = np.load(file_path, mmap_mode='r')
+            return self._mmaps[file_path]
+        if self._cached_npz[0] != file_path:
+            with np.load(file_path) as data:
+                self._cached_npz = (file_path, {k: data[k] for k in data.files})
+        return self._cached_npz[1][key]
+
+    def get(self, seeds=None, steps=None, key='xt', dtype=torch.float32, device=None):
+        """
+        Read the trajectories of `seeds` at `steps` (all of them if None).
+
+        Args:
+            seeds: A list of `int`. The seeds to read, in any order.
+            steps: A `int`, a `slice` or a list of `int`. The time steps to read.
+            key: A `str`. 'xt' for the trajectories or 'eps' for the gradients.
+            dtype: A pytorch dtype. The returned dtype.
+            device: A pytorch device. The returned device.
+        Returns:
+            A pytorch tensor of shape [num_steps, len(seeds), ch, r, r], the same layout as the samplers.
+        """
+        seeds = self.seeds if seeds is None else [int(seed) for seed in seeds]
+        all_steps = range(self.num_steps(key))
+        squeeze = isinstance(steps, int)
+        if steps is None or isinstance(steps, slice):
+            steps = list(all_steps[steps or slice(None)])
+        else:
+            steps = [all_steps[step] for step in ([steps] if squeeze else steps)]
+
+        # Read the (row, step) pairs of every chunk at once, in increasing order of rows.
+        by_chunk = dict()
+        for pos, seed in enumerate(seeds):
+            chunk_idx, row = self.index[seed]
+            by_chunk.setdefault(chunk_idx, []).append((row, pos))
+        out = None
+        for chunk_idx, rows in by_chunk.items():
+            rows.sort()
+            array = self._chunk_array(chunk_idx, key)
+            values = from_storage(array[np.ix_([row for row, _ in rows], steps)], self.dtype)
+            if out is None:
+                out = torch.empty([len(seeds), *values.shape[1:]], dtype=dtype)
+            out[[pos for _, pos in rows]] = values.to(dtype)
+        out = out.transpose(0, 1)
+        out = out[0] if squeeze else out
+        return out.to(device) if device is not None else out
+
+    def get_seed(self, seed, key='xt', **kwargs):
+        return self.get([seed], key=key, **kwargs)[:, 0]                  # [num_steps, ch, r, r]
+
+    def get_step(self, step, seeds=None, key='xt', **kwargs):
+        return self.get(seeds, steps=step, key=key, **kwargs)             # [len(seeds), ch, r, r]
+
+#----------------------------------------------------------------------------
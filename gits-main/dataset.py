@@ -12,6 +12,11 @@ import numpy as np
 import zipfile
 import PIL.Image
 import json
+import atexit
+import glob
+import hashlib
+import shutil
+import tempfile
 import torch
 import dnnlib
 from torchvision import transforms
@@ -21,6 +26,11 @@ try:
 except ImportError:
     pyspng = None
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 #----------------------------------------------------------------------------
 # Abstract base class for datasets.
 
@@ -273,3 +283,207 @@ class ImageFolderDataset(Dataset):
         return labels
 
 #----------------------------------------------------------------------------
+# Dataset subclass that slices images from a memory-mapped uint8 array of
+# shape [N, C, H, W], created with `dataset_tool.py --dest=path.mmap`. The
+# directory contains the raw array (images.bin), the labels (labels.npy, if
+# any) and the shape (dataset.json). No image is decoded.
+
+class MemmapDataset(Dataset):
+    def __init__(self,
+        path,                   # Path to the directory.
+        resolution      = None, # Ensure specific resolution, None = any.
+        **super_kwargs,         # Additional arguments for the Dataset base class.
+    ):
+        self._path = path
+        self._images = None
+        if not self.is_memmap(path):
+            raise IOError('Path must point to a directory created with dataset_tool.py --dest=path.mmap')
+        with open(os.path.join(path, 'dataset.json'), 'r') as f:
+            raw_shape = json.load(f)['shape']
+
+        name = os.path.splitext(os.path.basename(os.path.normpath(self._path)))[0]
+        if resolution is not None and (raw_shape[2] != resolution or raw_shape[3] != resolution):
+            raise IOError('Images do not match the specified resolution')
+        super().__init__(name=name, raw_shape=raw_shape, **super_kwargs)
+
+    @staticmethod
+    def is_memmap(path):
+        return os.path.isfile(os.path.join(path, 'images.bin')) and os.path.isfile(os.path.join(path, 'dataset.json'))
+
+    def _get_images(self):
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self._path, 'images.bin'), dtype=np.uint8, mode='r', shape=tuple(self._raw_shape))
+        return self._images
+
+    def close(self):
+        self._images = None
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), _images=None)
+
+    def _load_raw_image(self, raw_idx):
+        return self._get_images()[raw_idx]
+
+    def _load_raw_labels(self):
+        fname = os.path.join(self._path, 'labels.npy')
+        if not os.path.isfile(fname):
+            return None
+        labels = np.load(fname)
+        labels = labels.astype({1: np.int64, 2: np.float32}[labels.ndim])
+        return labels
+
+    def get_batch(self, indices):
+        # Images [N, C, H, W] and labels of many items at once, e.g. get_batch(slice(None)) for the whole dataset.
+        # A contiguous range of images is returned as a read-only view of the mapped pages instead of a copy.
+        indices = np.arange(len(self))[indices]
+        raw_idx = self._raw_idx[indices]
+        flip = self._xflip[indices] != 0
+        if raw_idx.size > 0 and not flip.any() and np.array_equal(raw_idx, np.arange(raw_idx[0], raw_idx[0] + raw_idx.size)):
+            images = self._get_images()[raw_idx[0]:raw_idx[0] + raw_idx.size]
+        else:
+            images = self._get_images()[raw_idx]
+        if flip.any():
+            images[flip] = images[flip][:, :, :, ::-1]
+        labels = self._get_raw_labels()[raw_idx]
+        if labels.dtype == np.int64:
+            labels = np.eye(self.label_dim, dtype=np.float32)[labels]
+        return images, labels
+
+#----------------------------------------------------------------------------
+# Node-local shared-memory cache of a zip or image folder dataset. The first
+# process on the node decodes the dataset once into the MemmapDataset format
+# under /dev/shm, and every rank and DataLoader worker maps the same pages
+# read-only, so host memory does not grow with the number of processes.
+# Every attached process holds a shared lock on '<cache_dir>.lock' until it
+# exits, and the last one to exit removes the cache.
+
+_shared_caches = dict() # {cache_dir: lock file descriptor, ...}
+
+def get_shared_cache_dir(path, shm_dir=None):
+    # Keyed by the path and modification time, so that a changed dataset gets a new cache.
+    if shm_dir is None:
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    stat = os.stat(path)
+    key = hashlib.md5(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf8')).hexdigest()
+    return os.path.join(shm_dir, f'dataset-cache-{key}')
+
+def _lock_file(lock_path, operation):
+    # Retry if the lock file was removed by the last process of a previous run in the meantime.
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, operation)
+            if os.path.exists(lock_path) and os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+def _populate_shared_cache(path, cache_dir):
+    # Remove the partial caches of processes that died while populating, the exclusive lock is held.
+    disk_dir = tempfile.gettempdir()
+    for base_dir in {os.path.dirname(cache_dir), disk_dir}:
+        for stale_dir in glob.glob(os.path.join(glob.escape(base_dir), glob.escape(os.path.basename(cache_dir)) + '.tmp-*')):
+            shutil.rmtree(stale_dir, ignore_errors=True)
+    if os.path.lexists(cache_dir):
+        _remove_shared_cache(cache_dir) # e.g. a symlink to a disk cache that was removed
+    src = ImageFolderDataset(path, use_labels=True)
+    labels = src._load_raw_labels()
+
+    # A write past the end of a full tmpfs kills the process with SIGBUS instead of raising (Docker limits
+    # /dev/shm to 64 MB by default), so the free space is checked first. If it is too small, the cache is
+    # stored in the temporary directory on disk, which every process maps through the page cache, and
+    # `cache_dir` is a symlink to it.
+    needed = int(np.prod(src._raw_shape)) + (0 if labels is None else labels.nbytes) + 2**20
+    target_dir = cache_dir
+    if shutil.disk_usage(os.path.dirname(cache_dir)).free < needed:
+        target_dir = os.path.join(disk_dir, os.path.basename(cache_dir))
+        if shutil.disk_usage(disk_dir).free < needed:
+            src.close()
+            raise RuntimeError(f'Not enough space for the dataset cache of "{path}" ({needed / 2**20:.0f} MB) in "{os.path.dirname(cache_dir)}" or "{disk_dir}", '
+                               'set shm_dir to a larger node-local directory')
+    temp_dir = f'{target_dir}.tmp-{os.getpid()}'
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        images = np.memmap(os.path.join(temp_dir, 'images.bin'), dtype=np.uint8, mode='w+', shape=tuple(src._raw_shape))
+        for raw_idx in range(images.shape[0]):
+            images[raw_idx] = src._load_raw_image(raw_idx)
+        images.flush()
+        del images
+        if labels is not None:
+            np.save(os.path.join(temp_dir, 'labels.npy'), labels)
+        with open(os.path.join(temp_dir, 'dataset.json'), 'w') as f:
+            json.dump({'format': 'memmap', 'dtype': 'uint8', 'shape': src._raw_shape}, f)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    finally:
+        src.close()
+    if target_dir != cache_dir:
+        shutil.rmtree(target_dir, ignore_errors=True) # left by a run that did not detach
+        os.rename(temp_dir, target_dir)
+        os.symlink(target_dir, cache_dir)
+    else:
+        os.rename(temp_dir, cache_dir) # atomic, the cache is either complete or missing
+
+def _remove_shared_cache(cache_dir):
+    if os.path.islink(cache_dir):
+        target_dir = os.path.realpath(cache_dir)
+        os.remove(cache_dir)
+        shutil.rmtree(target_dir, ignore_errors=True)
+    else:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def _detach_shared_cache(cache_dir):
+    os.close(_shared_caches.pop(cache_dir))
+    try:
+        fd = _lock_file(cache_dir + '.lock', fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return # still attached by another process
+    _remove_shared_cache(cache_dir)
+    os.remove(cache_dir + '.lock')
+    os.close(fd)
+
+def attach_shared_cache(path, shm_dir=None):
+    """
+    Attach to the shared-memory cache of the dataset at `path`, populating it first if needed.
+
+    Args:
+        path: A `str`. Path to a zip archive or an image folder created with dataset_tool.py.
+        shm_dir: A `str`. Node-local directory to store the cache in, /dev/shm if None.
+    Returns:
+        A `str`. Path to the cache, to be opened with MemmapDataset.
+    """
+    if fcntl is None:
+        raise RuntimeError('The shared-memory dataset cache requires fcntl, which is not available on this platform')
+    cache_dir = get_shared_cache_dir(path, shm_dir)
+    if cache_dir in _shared_caches:
+        return cache_dir
+    lock_path = cache_dir + '.lock'
+    while True:
+        fd = _lock_file(lock_path, fcntl.LOCK_SH)
+        if MemmapDataset.is_memmap(cache_dir):
+            break
+        os.close(fd)
+        fd = _lock_file(lock_path, fcntl.LOCK_EX) # the other processes wait here while the first one populates the cache
+        if not MemmapDataset.is_memmap(cache_dir):
+            _populate_shared_cache(path, cache_dir)
+        os.close(fd)
+    _shared_caches[cache_dir] = fd
+    atexit.register(_detach_shared_cache, cache_dir)
+    return cache_dir
+
+#----------------------------------------------------------------------------
+# Open a dataset created with dataset_tool.py in any of its formats. With
+# shared=True, zip archives and image folders are read through the
+# shared-memory cache above.
+
+def open_image_dataset(path, shared=False, **kwargs):
+    if os.path.isdir(path) and MemmapDataset.is_memmap(path):
+        return MemmapDataset(path, **kwargs)
+    if shared:
+        return MemmapDataset(attach_shared_cache(path), **kwargs)
+    return ImageFolderDataset(path, **kwargs)
+
+#----------------------------------------------------------------------------
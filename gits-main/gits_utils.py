@@ -1,5 +1,9 @@
+import os
 import csv
 import copy
+import json
+import fcntl
+import hashlib
 import random
 import torch
 from torch_utils import distributed as dist
@@ -36,6 +40,193 @@ def get_sampler_fn(solver, device, dp_list=None, net=None, **kwargs):
         raise NotImplementedError(f"Unknown solver: {solver}")
     return sampler_fn, None
 
+#----------------------------------------------------------------------------
+# Description string of the teacher trajectories, the cost matrix only depends on these settings
+
+def get_desc(dataset_name, solver_tea, schedule_type, schedule_rho, num_steps_tea, num_warmup, metric, **kwargs):
+    if schedule_type == 'polynomial':
+        schedule_str = 'poly' + str(schedule_rho)
+    elif schedule_type == 'logsnr':
+        schedule_str = 'logsnr'
+    elif schedule_type == 'time_uniform':
+        schedule_str = 'uni' + str(schedule_rho)
+    elif schedule_type == 'discrete':
+        schedule_str = 'discrete'
+    return f"{dataset_name}-{solver_tea}-{schedule_str}-{num_steps_tea}-warmup{num_warmup}-{metric}"
+
+def get_cache_key(guidance_type=None, guidance_rate=None, prompt=None, max_order=None, deis_mode=None, max_batch_size=None, \
+                  afs=False, denoise_to_zero=False, predict_x0=True, lower_order_final=True, **kwargs):
+    # Every setting passed to the teacher sampler and the batch split over ranks also change the trajectories and
+    # the warmup count. AFS skips the first model evaluation of the teacher, and denoise_to_zero changes its end point.
+    key = get_desc(**kwargs) + f"-order{max_order}-{deis_mode}-bs{max_batch_size}x{dist.get_world_size()}"
+    key += f"-afs{int(bool(afs))}-dtz{int(bool(denoise_to_zero))}"
+    if kwargs['solver_tea'] == 'dpmpp':
+        key += f"-x0{int(bool(predict_x0))}-lof{int(bool(lower_order_final))}"
+    if guidance_type is not None:
+        key += f"-{guidance_type}{guidance_rate}"
+    if prompt is not None:
+        key += '-prompt' + hashlib.md5(prompt.encode('utf-8')).hexdigest()[:8]
+    return key
+
+#----------------------------------------------------------------------------
+# Load and save the cost matrix together with the teacher time schedule
+
+def load_cost_mat(cache_path):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return None, None
+    data = np.load(cache_path)
+    return data['cost_mat'], data['t_steps']
+
+def save_cost_mat(cache_path, cost_mat, t_steps):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = cache_path + f'.tmp{os.getpid()}.npz'
+    np.savez(temp_path, cost_mat=cost_mat, t_steps=t_steps)
+    os.replace(temp_path, cache_path) # atomic
+
+#----------------------------------------------------------------------------
+# Registry of optimized time schedules that can be loaded by name without warmup
+
+def get_registry_path(cache_dir):
+    return os.path.join(cache_dir, 'schedules.json')
+
+# The settings a registered schedule is only valid for
+SCHEDULE_KEYS = ['dataset_name', 'solver', 'num_steps', 'afs', 'solver_tea', 'num_steps_tea']
+
+def load_schedule(name, cache_dir):
+    registry_path = get_registry_path(cache_dir)
+    if not os.path.isfile(registry_path):
+        return None
+    with open(registry_path, 'r') as f:
+        registry = json.load(f)
+    return registry.get(name, None)
+
+def check_schedule(schedule, **solver_kwargs):
+    # Return the settings of the current run that differ from the ones the schedule was searched with
+    return [f"{key}={schedule.get(key)} (current: {solver_kwargs[key]})" for key in SCHEDULE_KEYS if schedule.get(key) != solver_kwargs[key]]
+
+def save_schedule(name, cache_dir, **schedule):
+    registry_path = get_registry_path(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Lock the read-modify-write so that concurrent searches do not drop each other's entries
+    with open(registry_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        registry = {}
+        if os.path.isfile(registry_path):
+            with open(registry_path, 'r') as f:
+                registry = json.load(f)
+        registry[name] = schedule
+        temp_path = registry_path + f'.tmp{os.getpid()}'
+        with open(temp_path, 'w') as f:
+            json.dump(registry, f, indent=2)
+        os.replace(temp_path, registry_path) # atomic
+
+#----------------------------------------------------------------------------
+# Generate latents and conditions for a warmup batch
+
+@torch.no_grad()
+def get_warmup_batch(net, device, warmup_seed, batch_size, sample_captions=None, **kwargs):
+    dataset_name = kwargs['dataset_name']
+    model_source = kwargs['model_source']
+    rnd = torch.Generator(device).manual_seed(warmup_seed)
+    latents = torch.randn([batch_size, net.img_channels, net.img_resolution, net.img_resolution], generator=rnd, device=device)
+    class_labels = c = uc = None
+    if net.label_dim:
+        if model_source == 'adm':
+            class_labels = torch.randint(net.label_dim, size=(batch_size,), generator=rnd, device=device)
+        elif model_source == 'ldm' and dataset_name == 'ms_coco':
+            if kwargs['prompt'] is None:
+                prompts = random.Random(warmup_seed).sample(sample_captions, batch_size)
+            else:
+                prompts = [kwargs['prompt'] for i in range(batch_size)]
+            if kwargs['guidance_rate'] != 1.0:
+                uc = net.model.get_learned_conditioning(batch_size * [""])
+            if isinstance(prompts, tuple):
+                prompts = list(prompts)
+            c = net.model.get_learned_conditioning(prompts)
+        else:
+            class_labels = torch.eye(net.label_dim, device=device)[torch.randint(net.label_dim, size=[batch_size], generator=rnd, device=device)]
+    return latents, class_labels, c, uc
+
+#----------------------------------------------------------------------------
+# Run a sampler on the given latents and conditions
+
+def run_sampler(sampler_fn, net, latents, class_labels=None, c=None, uc=None, **kwargs):
+    with torch.no_grad():
+        if kwargs['model_source'] == 'ldm':
+            with autocast("cuda"):
+                with net.model.ema_scope():
+                    return sampler_fn(net, latents, condition=c, unconditional_condition=uc, **kwargs)
+        return sampler_fn(net, latents, class_labels=class_labels, **kwargs)
+
+#----------------------------------------------------------------------------
+# Sampler callback that moves the teacher states and gradients to host memory at
+# every step, so the GPU only holds the current step of the teacher trajectory.
+# The host still holds the whole trajectory, O(batch_size * num_steps_tea).
+
+class TeacherTrajStore:
+    def __init__(self, num_steps):
+        self.x = [None] * (num_steps - 1)
+        self.d = [None] * (num_steps - 1)
+
+    def _offload(self, buffer, src):
+        if buffer is None or buffer.shape != src.shape or buffer.dtype != src.dtype:
+            buffer = torch.empty(src.shape, dtype=src.dtype, pin_memory=(src.device.type == 'cuda'))
+        buffer.copy_(src, non_blocking=True)
+        return buffer
+
+    def __call__(self, i, t_cur, t_next, x_cur, denoised, d_cur):
+        self.x[i] = self._offload(self.x[i], x_cur)
+        self.d[i] = self._offload(self.d[i], d_cur)
+
+#----------------------------------------------------------------------------
+# Calculate the cost matrix of one warmup batch. Each row compares the one-step
+# predictions from a teacher state with all later teacher states. The rows are
+# processed `block_size` at a time: the states and gradients of a block stay on
+# the device while the later states are uploaded once for the whole block, so
+# a round takes about num_steps_tea / block_size passes over the trajectory and
+# the device holds 2 * block_size + 3 states.
+
+@torch.no_grad()
+def get_cost_mat(traj_store, x_last, t_steps, metric, ch, r, block_size=8):
+    num_steps_tea = len(traj_store.x) + 1
+    device, bs = x_last.device, x_last.shape[0]
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    get_x = lambda j: x_last if j == num_steps_tea - 1 else traj_store.x[j].to(device, non_blocking=True)
+    get_d = lambda j: traj_store.d[j].to(device, non_blocking=True)
+    x_first = get_x(0)
+
+    # Deviation of the teacher states, filled during the first pass. The last state has zero deviation
+    if metric == 'dev':
+        dev_tea = torch.zeros(num_steps_tea - 1, device=device)
+
+    cost_mat = torch.zeros((num_steps_tea, num_steps_tea), device=device)
+    for start in range(0, num_steps_tea - 1, block_size):
+        rows = range(start, min(start + block_size, num_steps_tea - 1))
+        xs = [x_first if i == 0 else get_x(i) for i in rows]
+        ds = [get_d(i) for i in rows]
+        for j in range(start + 1, num_steps_tea):
+            x_tea = xs[j - start] if j in rows else get_x(j)
+            if metric == 'dev' and start == 0 and j < num_steps_tea - 1:
+                temp = torch.stack((x_first, x_tea, x_last), dim=0)
+                dev_tea[j - 1] = cal_deviation(temp, ch, r, bs=bs).mean()
+
+            for i in rows:
+                if i >= j:
+                    break
+                x_next = xs[i - start] + (t_steps[j] - t_steps[i]) * ds[i - start]
+                if metric == 'l1':
+                    cost_mat[i][j] = torch.norm(x_next - x_tea, p=1, dim=(1,2,3)).mean()
+                elif metric == 'l2':
+                    cost_mat[i][j] = torch.norm(x_next - x_tea, p=2, dim=(1,2,3)).mean()
+                elif metric == 'dev':
+                    temp = torch.stack((x_first, x_next, x_last), dim=0)
+                    dev_stu = cal_deviation(temp, ch, r, bs=bs).mean(dim=0)
+                    cost_mat[i][j] = (dev_stu - dev_tea[j - 1]).mean()
+                else:
+                    raise NotImplementedError(f"Unknown metric: {metric}")
+    return cost_mat
+
 #----------------------------------------------------------------------------
 # dp_list is a list of indices to be selected from the longer teacher time schedule
 
@@ -53,13 +244,14 @@ def get_dp_list(net, device, **solver_kwargs):
     afs = kwargs['afs']
     metric = kwargs['metric']
     coeff = kwargs['coeff']
-    model_source = kwargs['model_source']
+    cache_dir = kwargs['cache_dir']
 
     kwargs['solver'] = solver_kwargs['solver_tea']
     sampler_fn_tea, coeff_list = get_sampler_fn(device=device, net=net, dp_list=[i for i in range(kwargs['num_steps_tea'])], **kwargs)
     kwargs['t_steps'] = t_steps = solvers.get_schedule(num_steps_tea, sigma_min, sigma_max, device=device, schedule_type=schedule_type, schedule_rho=schedule_rho, net=net)
     kwargs['coeff_list'] = coeff_list
 
+    sample_captions = None
     if dataset_name in ['ms_coco'] and solver_kwargs['prompt'] is None:
         # Loading MS-COCO captions for FID-30k evaluaion
         # We use the selected 30k captions from https://github.com/boomb0om/text2image-benchmark
@@ -70,83 +262,60 @@ def get_dp_list(net, device, **solver_kwargs):
             for row in reader:
                 text = row['text']
                 sample_captions.append(text)
-    
-    # Calculate the cost matrix
-    kwargs['return_inters'] = True
-    kwargs['return_eps'] = True
+
+    # Load the cost matrix if the same teacher trajectories have been processed before. Rank 0 decides
+    # and broadcasts the result, so that all ranks take the same branch below.
+    cache_path = os.path.join(cache_dir, 'cost_mat', get_cache_key(**solver_kwargs) + '.npz') if cache_dir is not None else None
+    cost_mat = None
+    if dist.get_rank() == 0:
+        cost_mat, t_steps_cached = load_cost_mat(cache_path)
+        if cost_mat is not None and (t_steps_cached.shape != t_steps.shape or not np.allclose(t_steps_cached, t_steps.cpu().numpy())):
+            dist.print0(f'The time schedule of the cached cost matrix "{cache_path}" does not match, recalculating it')
+            cost_mat = None
+    if dist.get_world_size() > 1:
+        cost_mat_obj = [cost_mat]
+        torch.distributed.broadcast_object_list(cost_mat_obj, src=0)
+        cost_mat = cost_mat_obj[0]
+
     kwargs['num_steps'] = solver_kwargs['num_steps_tea']
-    num_accumulation_rounds = num_warmup // (max_batch_size + 1) + 1
     batch_gpu = max_batch_size // dist.get_world_size()
-    dist.print0(f'Accumulate {num_accumulation_rounds} rounds to collect {num_warmup} trajectories...')
-    cost_mat = torch.zeros((num_steps_tea, num_steps_tea), device=device)
-    for r in range(num_accumulation_rounds):
-        with torch.no_grad():
-            # Generate latents and labels
-            latents = torch.randn([batch_gpu, net.img_channels, net.img_resolution, net.img_resolution], device=device)
-            class_labels = c = uc = None
-            if net.label_dim:
-                if model_source == 'adm':
-                    class_labels = torch.randint(net.label_dim, size=(batch_gpu,), device=device)
-                elif model_source == 'ldm' and dataset_name == 'ms_coco':
-                    if solver_kwargs['prompt'] is None:
-                        prompts = random.sample(sample_captions, batch_gpu)
-                    else:
-                        prompts = [solver_kwargs['prompt'] for i in range(batch_gpu)]
-                    if solver_kwargs['guidance_rate'] != 1.0:
-                        uc = net.model.get_learned_conditioning(batch_gpu * [""])
-                    if isinstance(prompts, tuple):
-                        prompts = list(prompts)
-                    c = net.model.get_learned_conditioning(prompts)
-                else:
-                    class_labels = torch.eye(net.label_dim, device=device)[torch.randint(net.label_dim, size=[batch_gpu], device=device)]
-            
+    # The warmup trajectories of every round are split across ranks, max_batch_size in total.
+    # Each rank uses a different seed in every round to draw distinct trajectories.
+    num_accumulation_rounds = num_warmup // (max_batch_size + 1) + 1
+    get_warmup_seed = lambda r: r * dist.get_world_size() + dist.get_rank()
+    if cost_mat is not None:
+        dist.print0(f'Loaded the cached cost matrix from "{cache_path}"')
+        if afs:
+            # AFS still requires the teacher samples of the last warmup batch, the same one as without the cache
+            dist.print0('Generating the teacher samples for AFS...')
+            latents, class_labels, c, uc = get_warmup_batch(net, device, get_warmup_seed(num_accumulation_rounds - 1), batch_gpu, sample_captions, **solver_kwargs)
+            x_tea = run_sampler(sampler_fn_tea, net, latents, class_labels, c, uc, **kwargs)
+    else:
+        # Calculate the cost matrix, the teacher trajectory is streamed to host memory step by step
+        traj_store = TeacherTrajStore(num_steps_tea)
+        dist.print0(f'Accumulate {num_accumulation_rounds} rounds to collect {num_warmup} trajectories on {dist.get_world_size()} GPUs...')
+        cost_mat = torch.zeros((num_steps_tea, num_steps_tea), device=device)
+        for r in range(num_accumulation_rounds):
+            warmup_seed = get_warmup_seed(r)
+            latents, class_labels, c, uc = get_warmup_batch(net, device, warmup_seed, batch_gpu, sample_captions, **solver_kwargs)
+
             dist.print0(f'Round {r+1}/{num_accumulation_rounds} | Generating the teacher trajectory...')
-            with torch.no_grad():
-                if model_source == 'ldm':
-                    with autocast("cuda"):
-                        with net.model.ema_scope():
-                            teacher_traj, eps_traj = sampler_fn_tea(net, latents, condition=c, unconditional_condition=uc, **kwargs)
-                else:
-                    teacher_traj, eps_traj = sampler_fn_tea(net, latents, class_labels=class_labels, **kwargs)
-            dev_tea = cal_deviation(teacher_traj, net.img_channels, net.img_resolution, bs=batch_gpu).mean(dim=0)
-            dev_tea = torch.cat([dev_tea, torch.zeros_like(dev_tea[:1])])
-            
+            x_tea = run_sampler(sampler_fn_tea, net, latents, class_labels, c, uc, callback=traj_store, **kwargs)
+
             dist.print0(f'Round {r+1}/{num_accumulation_rounds} | Calculating the cost matrix...')
-            for i in range(num_steps_tea - 1):
-                x_cur = teacher_traj[i]
-                t_cur = t_steps[i]
-                d_cur = eps_traj[i]
-
-                for j in range(i+1, num_steps_tea):
-                    t_next = t_steps[j]
-                    x_next = x_cur + (t_next - t_cur) * d_cur
-                    if metric == 'l1':
-                        cost_mat[i][j] += torch.norm(x_next - teacher_traj[j], p=1, dim=(1,2,3)).mean()
-                    elif metric == 'l2':
-                        cost_mat[i][j] += torch.norm(x_next - teacher_traj[j], p=2, dim=(1,2,3)).mean()
-                    elif metric == 'dev':
-                        temp = torch.cat((teacher_traj[0].unsqueeze(0), x_next.unsqueeze(0), teacher_traj[-1].unsqueeze(0)), dim=0)
-                        dev_stu = cal_deviation(temp, net.img_channels, net.img_resolution, bs=batch_gpu).mean(dim=0)
-                        cost_mat[i][j] += (dev_stu - dev_tea[j - 1]).mean()
-                    else:
-                        raise NotImplementedError(f"Unknown metric: {metric}")
-
-    # torch.distributed.all_reduce(cost_mat)
-    cost_mat /= num_accumulation_rounds
-    cost_mat = cost_mat.detach().cpu().numpy()
-
-    # Description string.
-    if schedule_type == 'polynomial':
-        schedule_str = 'poly' + str(schedule_rho)
-    elif schedule_type == 'logsnr':
-        schedule_str = 'logsnr'
-    elif schedule_type == 'time_uniform':
-        schedule_str = 'uni' + str(schedule_rho)
-    elif schedule_type == 'discrete':
-        schedule_str = 'discrete'
-    desc = f"{dataset_name}-{solver_kwargs['solver_tea']}-{schedule_str}-{num_steps_tea}-warmup{num_warmup}-{metric}"
+            cost_mat += get_cost_mat(traj_store, x_tea, t_steps, metric, net.img_channels, net.img_resolution)
+
+        # Average the cost matrix over all rounds and ranks so that every rank runs DP on the same matrix
+        if dist.get_world_size() > 1:
+            torch.distributed.all_reduce(cost_mat)
+        cost_mat /= num_accumulation_rounds * dist.get_world_size()
+        cost_mat = cost_mat.detach().cpu().numpy()
+        if cache_path is not None and dist.get_rank() == 0:
+            save_cost_mat(cache_path, cost_mat, t_steps.cpu().numpy())
+            dist.print0(f'Saved the cost matrix to "{cache_path}"')
 
     # dynamic programming
+    desc = get_desc(**solver_kwargs)
     multiple_coeff = True if dataset_name == 'ms_coco' else False
     dp_list = phi = dp(cost_mat, num_steps, num_steps_tea, coeff, multiple_coeff, desc, t_steps)
     
@@ -155,27 +324,49 @@ def get_dp_list(net, device, **solver_kwargs):
     kwargs['solver'] = solver_kwargs['solver']
     kwargs['num_steps'] = solver_kwargs['num_steps']
     if afs:
+        # Insert a new 'free' step between the first two time steps
         dist.print0('Selecting the AFS step...')
-        dist_min = 999999
-        for k in range(1, phi[1]):
-            dp_slice_temp = copy.deepcopy(phi)
-            dp_slice_temp.insert(1, k)
-            sampler_fn, solver_kwargs['coeff_list'] = get_sampler_fn(device=device, dp_list=dp_slice_temp, **kwargs)
-            kwargs['t_steps'] = solvers.get_schedule(num_steps_tea, sigma_min, sigma_max, device=device, schedule_type=schedule_type, \
-                                                     schedule_rho=schedule_rho, net=net, dp_list=dp_slice_temp)
-            with torch.no_grad():
-                if model_source == 'ldm':
-                    with autocast("cuda"):
-                        with net.model.ema_scope():
-                            images_afs = sampler_fn(net, latents, condition=c, unconditional_condition=uc, **kwargs)
-                else:
-                    images_afs = sampler_fn(net, latents, class_labels=class_labels, **kwargs)
-            dist_temp = torch.norm(images_afs - teacher_traj[-1], p=2, dim=(1,2,3)).mean()
-            torch.distributed.all_reduce(dist_temp)
-            dist_temp /= dist.get_world_size()
-            if dist_temp < dist_min:
-                dist_min = dist_temp
-                dp_list = dp_slice_temp
+        candidates = [phi[:1] + [k] + phi[1:] for k in range(1, phi[1])]
+        if solver_kwargs['solver'] in ['deis', 'unipc']:
+            # The coefficients of these solvers can not be computed per sample, evaluate the candidates one by one
+            dist_min = 999999
+            for dp_slice_temp in candidates:
+                sampler_fn, kwargs['coeff_list'] = get_sampler_fn(device=device, net=net, dp_list=dp_slice_temp, **kwargs)
+                kwargs['t_steps'] = solvers.get_schedule(num_steps_tea, sigma_min, sigma_max, device=device, schedule_type=schedule_type, \
+                                                         schedule_rho=schedule_rho, net=net, dp_list=dp_slice_temp)
+                images_afs = run_sampler(sampler_fn, net, latents, class_labels, c, uc, **kwargs)
+                dist_temp = torch.norm(images_afs - x_tea, p=2, dim=(1,2,3)).mean()
+                if dist.get_world_size() > 1:
+                    torch.distributed.all_reduce(dist_temp)
+                dist_temp /= dist.get_world_size()
+                if dist_temp < dist_min:
+                    dist_min = dist_temp
+                    dp_list = dp_slice_temp
+        elif len(candidates) > 0:
+            # Evaluate the candidates in batched sampling passes with per-sample time steps, at most
+            # max_batch_size samples (i.e. max_batch_size // batch_gpu candidates) per pass
+            sampler_fn, _ = get_sampler_fn(device=device, net=net, dp_list=candidates[0], **kwargs)
+            repeat_fn = lambda x, n: None if x is None else x.repeat(n, *([1] * (x.ndim - 1)))
+            chunk_size = max(max_batch_size // batch_gpu, 1)
+            dist_afs = []
+            for start in range(0, len(candidates), chunk_size):
+                chunk = candidates[start:start+chunk_size]
+                n = len(chunk)
+                t_steps_afs = torch.stack([t_steps[dp_slice_temp] for dp_slice_temp in chunk], dim=1)                # (num_steps+1, n)
+                kwargs['t_steps'] = t_steps_afs.repeat_interleave(batch_gpu, dim=1).reshape(-1, n * batch_gpu, 1, 1, 1)
+                images_afs = run_sampler(sampler_fn, net, repeat_fn(latents, n), repeat_fn(class_labels, n), repeat_fn(c, n), repeat_fn(uc, n), **kwargs)
+                dist_afs.append(torch.norm(images_afs - repeat_fn(x_tea, n), p=2, dim=(1,2,3)).reshape(n, batch_gpu).mean(dim=1))
+            dist_afs = torch.cat(dist_afs)
+            if dist.get_world_size() > 1:
+                torch.distributed.all_reduce(dist_afs)
+            dist_afs /= dist.get_world_size()
+            dp_list = candidates[dist_afs.argmin().item()]
+
+    # Rank 0 decides the final schedule to guarantee a consistent dp_list across ranks
+    if dist.get_world_size() > 1:
+        dp_list_obj = [dp_list]
+        torch.distributed.broadcast_object_list(dp_list_obj, src=0)
+        dp_list = dp_list_obj[0]
 
     return dp_list
 
@@ -234,22 +425,27 @@ def dp(cost_mat, num_steps, num_steps_tea, coeff, multiple_coeff=False, desc=Non
 #----------------------------------------------------------------------------
 # Calculate the deviation of the sampling trajectory
 
-def cal_deviation(traj, ch, r, bs=1):
+def cal_deviation(traj, ch, r, bs=1, chunk_size=None):
     traj = traj.transpose(0, 1)
     # intermedia points, start point, end point
     a, b, c = traj[:, 1:-1], traj[:, 0].unsqueeze(1), traj[:, -1].unsqueeze(1)
 
-    ac = c - a                                                                          # (bs, num_steps-1, ch, r, r)
     bc = c - b                                                                          # (bs, 1, ch, r, r)
     bc_unit = bc / torch.norm(bc, p=2, dim=(1, 2, 3, 4)).reshape(bs, 1, 1, 1, 1)        # (bs, 1, ch, r, r)
-    
-    # Calculate projection vector
-    bc_unit_bcasted = bc_unit.expand_as(ac)                                             # (bs, num_steps-1, ch, r, r)
-    temp = torch.sum(ac * bc_unit_bcasted, dim=(2, 3, 4))                               # (bs, num_steps-1,)
-    temp_expanded = temp.unsqueeze(2).unsqueeze(3).unsqueeze(4).repeat(1, 1, ch, r, r)  # (bs, num_steps-1, ch, r, r)
-    ac_projection = temp_expanded * bc_unit
-    
-    # Calculate the deviation
-    perp = ac - ac_projection                                                           # (bs, num_steps-1, ch, r, r)
-    norm = torch.norm(perp, p=2, dim=(2, 3, 4))
-    return norm  
+
+    # The intermediate points are processed `chunk_size` at a time (all at once by default).
+    # The only tensor of the size of the chunk is ac: the projection is a batched dot product
+    # and the perpendicular component is written into ac by a fused in-place addcmul.
+    num_inters = a.shape[1]
+    chunk_size = max(num_inters, 1) if chunk_size is None else chunk_size
+    norm = []
+    for start in range(0, max(num_inters, 1), chunk_size):
+        ac = c - a[:, start:start+chunk_size]                                           # (bs, chunk_size, ch, r, r)
+
+        # Calculate projection vector
+        temp = torch.einsum('bkd,bd->bk', ac.flatten(2), bc_unit.flatten(1))            # (bs, chunk_size)
+        
+        # Calculate the deviation, the perpendicular component overwrites ac
+        ac.addcmul_(temp.reshape(*temp.shape, 1, 1, 1), bc_unit, value=-1)             # (bs, chunk_size, ch, r, r)
+        norm.append(torch.norm(ac, p=2, dim=(2, 3, 4)))
+    return torch.cat(norm, dim=1)  
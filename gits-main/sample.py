@@ -14,7 +14,7 @@ from torch import autocast
 from torch_utils import distributed as dist
 from torchvision.utils import make_grid, save_image
 from torch_utils.download_util import check_file_by_key
-from gits_utils import get_dp_list
+from gits_utils import get_dp_list, load_schedule, check_schedule, save_schedule
 
 #----------------------------------------------------------------------------
 # Wrapper for torch.Generator that allows specifying a different random seed
@@ -60,7 +60,7 @@ def load_ldm_model(config, ckpt, verbose=False):
     from models.ldm.util import instantiate_from_config
     pl_sd = torch.load(ckpt, map_location="cpu")
     if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
+        dist.print0(f"Global Step: {pl_sd['global_step']}")
     sd = pl_sd["state_dict"]
     model = instantiate_from_config(config.model)
     m, u = model.load_state_dict(sd, strict=False)
@@ -76,10 +76,10 @@ def load_ldm_model(config, ckpt, verbose=False):
 
 def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, device=None):
     model_path, classifier_path = check_file_by_key(dataset_name)
-    print(f'Loading the pre-trained diffusion model from "{model_path}"...')
+    dist.print0(f'Loading the pre-trained diffusion model from "{model_path}"...')
 
     if dataset_name in ['cifar10', 'ffhq', 'afhqv2', 'imagenet64']:         # models from EDM
-        with dnnlib.util.open_url(model_path, verbose=(0 == 0)) as f:
+        with dnnlib.util.open_url(model_path, verbose=(dist.get_rank() == 0)) as f:
             net = pickle.load(f)['ema'].to(device)
         net.sigma_min = 0.002
         net.sigma_max = 80.0
@@ -91,7 +91,6 @@ def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, devi
         net = CMPrecond(net).to(device)
         model_source = 'cm'
     else:
-        breakpoint()
         if guidance_type == 'cg':            # clssifier guidance           # models from ADM
             assert classifier_path is not None
             from models.guided_diffusion.cg_model_loader import load_cg_model
@@ -106,8 +105,6 @@ def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, devi
                 config = OmegaConf.load('./models/ldm/configs/latent-diffusion/lsun_bedrooms-ldm-vq-4.yaml')
                 net = load_ldm_model(config, model_path)
                 net = CFGPrecond(net, img_resolution=64, img_channels=3, guidance_rate=1., guidance_type='uncond', label_dim=0).to(device)
-                print(net)
-                breakpoint()
             elif dataset_name in ['ffhq_ldm']:
                 config = OmegaConf.load('./models/ldm/configs/latent-diffusion/ffhq-ldm-vq-4.yaml')
                 net = load_ldm_model(config, model_path)
@@ -166,6 +163,8 @@ def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, devi
 @click.option('--num_warmup',              help='How many warmup samples for dp', metavar='INT',                    type=click.IntRange(min=1), default=256, show_default=True)
 @click.option('--solver_tea',              help='Teacher solver', metavar='STR',                                    type=click.Choice(['euler', 'ipndm', 'ipndm_v', 'heun', 'dpm', 'dpmpp', 'deis']), default='ipndm', show_default=True)
 @click.option('--num_steps_tea',           help='Number of timestamps for teacher', metavar='INT',                  type=click.IntRange(min=1), default=21, show_default=True)
+@click.option('--cache_dir',               help='Where to cache cost matrices and optimized schedules', metavar='DIR', type=str, default='./gits_cache', show_default=True)
+@click.option('--schedule_name',           help='Name of an optimized schedule in the registry', metavar='STR',      type=str)
 
 # Options for saving
 @click.option('--outdir',                  help='Where to save the output images', metavar='DIR',                   type=str)
@@ -174,10 +173,10 @@ def create_model(dataset_name=None, guidance_type=None, guidance_rate=None, devi
 
 def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **solver_kwargs):
 
-    # dist.init()
-    num_batches = ((len(seeds) - 1) // (solver_kwargs['max_batch_size'] *1) + 1) *1
+    dist.init()
+    num_batches = ((len(seeds) - 1) // (solver_kwargs['max_batch_size'] * dist.get_world_size()) + 1) * dist.get_world_size()
     all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
-    rank_batches = all_batches[0 ::1]
+    rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
 
     dataset_name = solver_kwargs['dataset_name']
     if dataset_name in ['ms_coco'] and solver_kwargs['prompt'] is None:
@@ -195,43 +194,59 @@ def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **s
         sample_captions = hpsv2.benchmark_prompts(dataset_name) 
 
         seeds = list(range(len(sample_captions)))
-        num_batches = ((len(seeds) - 1) // (solver_kwargs['max_batch_size'] *1) + 1) *1
+        num_batches = ((len(seeds) - 1) // (solver_kwargs['max_batch_size'] * dist.get_world_size()) + 1) * dist.get_world_size()
         all_batches = torch.as_tensor(seeds).tensor_split(num_batches)
-        rank_batches = all_batches[0 ::1]
+        rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
 
     # Rank 0 goes first
-    # if 0 != 0:
-    #     torch.distributed.barrier()
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
 
     # Load pre-trained diffusion models.
     net, solver_kwargs['model_source'] = create_model(dataset_name if dataset_name not in ['anime', 'concept-art', 'paintings', 'photo'] else "ms_coco", solver_kwargs['guidance_type'], solver_kwargs['guidance_rate'], device)
 
     # Other ranks follow.
-    # if 0 == 0:
-    #     torch.distributed.barrier()
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
 
     # Get the time schedule
     solver_kwargs['sigma_min'] = net.sigma_min
     solver_kwargs['sigma_max'] = net.sigma_max
-    if t_steps is None:
+    schedule = None
+    if t_steps is None and solver_kwargs['schedule_name'] is not None:
+        schedule = load_schedule(solver_kwargs['schedule_name'], solver_kwargs['cache_dir'])
+        if schedule is None:
+            dist.print0(f'Schedule "{solver_kwargs["schedule_name"]}" is not found in the registry, searching it with DP')
+        elif len(check_schedule(schedule, **solver_kwargs)) > 0:
+            mismatches = ', '.join(check_schedule(schedule, **solver_kwargs))
+            raise click.ClickException(f'Schedule "{solver_kwargs["schedule_name"]}" was searched with different settings: {mismatches}')
+    if schedule is not None:
+        # Optimized schedule from the registry, no warmup is needed
+        dp_list = schedule['dp_list']
+        t_steps = torch.tensor(schedule['t_steps'], device=device)
+        solver_kwargs['dp'] = True
+        dist.print0(f'Loaded schedule "{solver_kwargs["schedule_name"]}" from the registry')
+        dist.print0('Selected dp_list:', dp_list)
+        dist.print0('Selected time schedule: ', [round(num.item(), 4) for num in t_steps])
+    elif t_steps is None:
         dp_list = get_dp_list(net, device, **solver_kwargs) if solver_kwargs['dp'] else None
         num_steps_in = solver_kwargs['num_steps'] if dp_list is None else solver_kwargs['num_steps_tea']
         t_steps = solver_utils.get_schedule(num_steps_in, solver_kwargs['sigma_min'], solver_kwargs['sigma_max'], device=device, \
                                             schedule_type=solver_kwargs["schedule_type"], schedule_rho=solver_kwargs["schedule_rho"], \
                                             net=net, dp_list=dp_list)
         if solver_kwargs['dp']:
-            print('Selected dp_list:', dp_list)
-            print('Selected time schedule: ', [round(num.item(), 4) for num in t_steps])
+            dist.print0('Selected dp_list:', dp_list)
+            dist.print0('Selected time schedule: ', [round(num.item(), 4) for num in t_steps])
     else:
         if solver_kwargs['dp']:
-            print('t_steps is specified, ignored DP')
+            dist.print0('t_steps is specified, ignored DP')
         t_steps_list = ast.literal_eval(t_steps)
         t_steps = torch.tensor(t_steps_list, device=device)
         solver_kwargs['num_steps'] = t_steps.shape[0]
         solver_kwargs['sigma_max'], solver_kwargs['sigma_min'] = t_steps_list[0], t_steps_list[-1]
         solver_kwargs['schedule_type'] = solver_kwargs['schedule_rho'] = None
         solver_kwargs['dp'] = False
-        print('Pre-specified t_steps:', t_steps_list)
+        dist.print0('Pre-specified t_steps:', t_steps_list)
     solver_kwargs['t_steps'] = t_steps
     # Calculate the exact NFE
     solver = solver_kwargs['solver']
@@ -252,6 +267,14 @@ def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **s
         nfe = 2 * nfe
     solver_kwargs['nfe'] = nfe
 
+    # Record the optimized schedule in the registry for later use with --schedule_name
+    if solver_kwargs['dp'] and schedule is None and dist.get_rank() == 0:
+        schedule_name = solver_kwargs['schedule_name'] or f"{dataset_name}-{solver}-nfe{nfe}"
+        save_schedule(schedule_name, solver_kwargs['cache_dir'], dp_list=dp_list, t_steps=[num.item() for num in t_steps], \
+                      num_steps=solver_kwargs['num_steps'], afs=solver_kwargs['afs'], dataset_name=dataset_name, solver=solver, \
+                      solver_tea=solver_kwargs['solver_tea'], num_steps_tea=solver_kwargs['num_steps_tea'], metric=solver_kwargs['metric'], coeff=solver_kwargs['coeff'])
+        dist.print0(f'Saved schedule "{schedule_name}" to the registry')
+
     # Construct solver, 8 solvers are provided
     if solver == 'euler':
         sampler_fn = solvers.euler_sampler
@@ -273,7 +296,7 @@ def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **s
         solver_kwargs['coeff_list'] = solver_utils.get_deis_coeff_list(t_steps, solver_kwargs['max_order'], deis_mode=solver_kwargs["deis_mode"])
 
     # Print solver settings.
-    print("Solver settings:")
+    dist.print0("Solver settings:")
     for key, value in solver_kwargs.items():
         if value is None:
             continue
@@ -289,9 +312,9 @@ def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **s
             continue
         elif key in ['t_steps', 'coeff_list']:
             continue
-        elif key in ['dp', 'metric', 'coeff', 'num_warmup', 'num_steps_tea', 'solver_tea'] and solver_kwargs['dp'] is False:
+        elif key in ['dp', 'metric', 'coeff', 'num_warmup', 'num_steps_tea', 'solver_tea', 'cache_dir', 'schedule_name'] and solver_kwargs['dp'] is False:
             continue
-        print(f"\t{key}: {value}")
+        dist.print0(f"\t{key}: {value}")
 
     # Loop over batches.
     if outdir is None:
@@ -300,10 +323,9 @@ def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **s
         else:
             outdir = os.path.join(f"./samples/{dataset_name}", f"{solver}_nfe{nfe}")
     os.makedirs(outdir, exist_ok=True)
-    print(f'Generating {len(seeds)} images to "{outdir}"...')
-    exit()
-    for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(0 != 0)):
-        # torch.distributed.barrier()
+    dist.print0(f'Generating {len(seeds)} images to "{outdir}"...')
+    for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
+        torch.distributed.barrier()
         batch_size = len(batch_seeds)
         if batch_size == 0:
             continue
@@ -357,8 +379,8 @@ def main(seeds, grid, outdir, subdirs, t_steps, device=torch.device('cuda'), **s
                 PIL.Image.fromarray(image_np, 'RGB').save(image_path)
     
     # Done.
-    # torch.distributed.barrier()
-    print('Done.')
+    torch.distributed.barrier()
+    dist.print0('Done.')
 
 #----------------------------------------------------------------------------
 
@@ -32,6 +32,7 @@ def euler_sampler(
     return_inters=False, 
     return_eps=False, 
     t_steps=None,
+    callback=None,
     **kwargs
 ):  
     """
@@ -56,6 +57,7 @@ def euler_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
@@ -75,9 +77,12 @@ def euler_sampler(
         use_afs = (afs and i == 0)
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
+            denoised = x_cur - t_cur * d_cur
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
         x_next = x_cur + (t_next - t_cur) * d_cur
         if return_inters:
             inters.append(x_next.unsqueeze(0))
@@ -113,7 +118,8 @@ def heun_sampler(
     denoise_to_zero=False, 
     return_inters=False,
     return_eps=False, 
-    t_steps=None, 
+    t_steps=None,
+    callback=None,
     **kwargs
 ):
     """
@@ -138,6 +144,7 @@ def heun_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
     """
@@ -157,9 +164,12 @@ def heun_sampler(
         use_afs = (afs and i == 0)
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
+            denoised = x_cur - t_cur * d_cur
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
         x_next = x_cur + (t_next - t_cur) * d_cur
 
         # Apply 2nd order correction.
@@ -202,6 +212,7 @@ def dpm_2_sampler(
     return_eps=False, 
     r=0.5, 
     t_steps=None,
+    callback=None,
     **kwargs
 ):
     """
@@ -226,6 +237,7 @@ def dpm_2_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
         r: A `float`. The hyperparameter controlling the location of the intermediate time step. r=0.5 recovers the original DPM-Solver-2.
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
@@ -246,9 +258,12 @@ def dpm_2_sampler(
         use_afs = (afs and i == 0)
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
+            denoised = x_cur - t_cur * d_cur
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
         t_mid = (t_next ** r) * (t_cur ** (1 - r))
         x_next = x_cur + (t_mid - t_cur) * d_cur
 
@@ -292,6 +307,7 @@ def ipndm_sampler(
     return_eps=False, 
     max_order=4, 
     t_steps=None,
+    callback=None,
     **kwargs
 ):
     """
@@ -316,6 +332,7 @@ def ipndm_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
@@ -337,9 +354,12 @@ def ipndm_sampler(
         use_afs = (afs and i == 0)
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
+            denoised = x_cur - t_cur * d_cur
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
             
         order = min(max_order, i+1)
         if order == 1:      # First Euler step.
@@ -393,6 +413,7 @@ def ipndm_v_sampler(
     return_eps=False, 
     max_order=4, 
     t_steps=None,
+    callback=None,
     **kwargs
 ):
     """
@@ -417,6 +438,7 @@ def ipndm_v_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
     Returns:
         A pytorch tensor. A batch of generated samples or sampling trajectories if return_inters=True.
@@ -440,9 +462,12 @@ def ipndm_v_sampler(
         use_afs = (afs and len(buffer_model) == 0)
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
+            denoised = x_cur - t_cur * d_cur
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
         
         order = min(max_order, i+1)
         if order == 1:      # First Euler step.
@@ -519,6 +544,7 @@ def deis_sampler(
     max_order=4, 
     coeff_list=None, 
     t_steps=None,
+    callback=None,
     **kwargs
 ):
     """
@@ -543,6 +569,7 @@ def deis_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 4
         coeff_list: A `list`. The pre-calculated coefficients for DEIS sampling.
     Returns:
@@ -567,9 +594,12 @@ def deis_sampler(
         use_afs = (afs and len(buffer_model) == 0)
         if use_afs:
             d_cur = x_cur / ((1 + t_cur**2).sqrt())
+            denoised = x_cur - t_cur * d_cur
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
         
         order = min(max_order, i+1)
         if order == 1:          # First Euler step.
@@ -629,6 +659,7 @@ def dpm_pp_sampler(
     predict_x0=True, 
     lower_order_final=True, 
     t_steps=None,
+    callback=None,
     **kwargs
 ):
     """
@@ -653,6 +684,7 @@ def dpm_pp_sampler(
         denoise_to_zero: A `bool`. Whether to denoise the sample to from `sigma_min` to `0` at the end of sampling.
         return_inters: A `bool`. Whether to save intermediate results, i.e. the whole sampling trajectory.
         return_eps: A `bool`. Whether to save intermediate d_cur, i.e. the gradient.
+        callback: A function called at every step with `(i, t_cur, t_next, x_cur, denoised, d_cur)`, e.g. to stream the trajectory.
         max_order: A `int`. Maximum order of the solver. 1 <= max_order <= 3
         predict_x0: A `bool`. Whether to use the data prediction formulation. 
         lower_order_final: A `bool`. Whether to lower the order at the final stages of sampling. 
@@ -681,6 +713,8 @@ def dpm_pp_sampler(
         else:
             denoised = get_denoised(net, x_cur, t_cur, class_labels=class_labels, condition=condition, unconditional_condition=unconditional_condition)
             d_cur = (x_cur - denoised) / t_cur
+        if callback is not None:
+            callback(i, t_cur, t_next, x_cur, denoised, d_cur)
         
         buffer_model.append(dynamic_thresholding_fn(denoised)) if predict_x0 else buffer_model.append(d_cur)
         buffer_t.append(t_cur)